@@ -6,13 +6,13 @@ import httpx
 import time
 from _socket import gethostname
 from typing import Dict, List, Optional
-import json
 
 import pytz
 from starlette.requests import Request
 
 from backend.config import get_schema_name
-from backend.db.utils import get_db_connection, insert_from_dict, run_sql, sql_query, sql_query_single_col
+from backend.db.utils import async_insert_from_dict, async_run_sql, async_sql_query_single_col, \
+    get_async_db_connection
 from backend.utils import dump
 
 API_CALL_LOGGING_ON=False
@@ -70,8 +70,8 @@ class Api_logger:
 
         rpt['params'] = '; '.join(params_list)
         self.rpt = rpt
-        with get_db_connection() as con:
-            insert_from_dict(con, 'public.api_runs', rpt, skip_if_already_exists=False)
+        async with get_async_db_connection() as con:
+            await async_insert_from_dict(con, 'public.api_runs', rpt)
 
 
     async def finish(self, rows: int = 0):
@@ -94,8 +94,8 @@ class Api_logger:
         process_seconds = end_time - self.start_time
         self.rpt['process_seconds'] = process_seconds
 
-        with get_db_connection() as con:
-            run_sql(con, """
+        async with get_async_db_connection() as con:
+            await async_run_sql(con, """
                         UPDATE public.api_runs
                         SET process_seconds = :process_seconds, result = :result
                         WHERE timestamp = :timestamp""", self.rpt)
@@ -125,8 +125,8 @@ async def get_ip_from_request(request: Request) -> str:
 
 async def client_location(ip: str) -> str:
     """Get user geolocation"""
-    with get_db_connection() as con:
-        ip_info = sql_query_single_col(con, 'SELECT info FROM public.ip_info WHERE ip = :ip', {'ip': ip})
+    async with get_async_db_connection() as con:
+        ip_info = await async_sql_query_single_col(con, 'SELECT info FROM public.ip_info WHERE ip = :ip', {'ip': ip})
     if ip_info:
         if len(ip_info) > 1:
             warnings.warn(f"more than one ip_info for {ip}; just using first)")
@@ -190,8 +190,9 @@ async def client_location(ip: str) -> str:
                 location = f"{ip}: {city}, {region}"
 
                 # del loc['location'] # this is nested json, won't work in insert_from_dict
-                with get_db_connection() as con:
-                    insert_from_dict(con, 'public.ip_info', {'ip': ip, 'info': json.dumps(loc)}, skip_if_already_exists=True)
+                # info is json: the async connection's codec encodes it
+                async with get_async_db_connection() as con:
+                    await async_insert_from_dict(con, 'public.ip_info', {'ip': ip, 'info': loc})
 
                 return location
 
@@ -3,18 +3,31 @@
 Resources
 - https://github.com/tiangolo/fastapi
 """
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.gzip import GZipMiddleware
 
 from backend.config import CONFIG, override_schema
 CONFIG['importer'] = 'app.py'
 from backend.routes import cset_crud, db, graph
+from backend.metrics import get_metrics
+
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Start loading the concept graph in the background, so the server accepts requests right away"""
+    graph.start_graph_loading()
+    yield
+
 
 # users on the same server
 # APP = FastAPI()
-APP = FastAPI(client_max_size=100_000_000) # trying this, but it shouldn't be necessary
+APP = FastAPI(client_max_size=100_000_000, lifespan=lifespan) # trying this, but it shouldn't be necessary
 APP.include_router(cset_crud.router)
 APP.include_router(graph.router)
 APP.include_router(db.router)
@@ -53,6 +66,22 @@ def read_root():
     return url_list
 
 
+@APP.get("/ready")
+def ready():
+    """Readiness probe: 200 once the concept graph is loaded, else 503. Routes that don't need the graph are served
+    either way."""
+    status = graph.graph_status()
+    if status['ready']:
+        return status
+    return JSONResponse(status, status_code=503, headers={'Retry-After': str(graph.GRAPH_RETRY_AFTER_SECONDS)})
+
+
+@APP.get("/metrics")
+def metrics():
+    """In-process metrics, e.g. cache hit / miss counters, of the worker that handles the request"""
+    return get_metrics()
+
+
 # from fastapi import HTTPException
 # import asyncio
 # from starlette.responses import JSONResponse
@@ -0,0 +1,83 @@
+"""Bounded in-process cache for route responses"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class ResponseCache:
+    """LRU cache with a TTL, cleared whenever the data version changes
+
+    :param maxsize: Max entries. The least recently used entry is evicted beyond that.
+    :param ttl: Seconds an entry stays valid.
+    :param get_version: Returns a value identifying the current version of the underlying data, e.g. DB refresh
+    timestamps. When it changes, all entries are dropped. Since it may query the DB, it is called at most once every
+    `version_check_interval` seconds rather than on every lookup."""
+
+    def __init__(
+        self, maxsize: int = 256, ttl: float = 3600, get_version: Optional[Callable[[], Hashable]] = None,
+        version_check_interval: float = 30
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.get_version = get_version
+        self.version_check_interval = version_check_interval
+        self.version: Hashable = None
+        self.version_checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check_version(self):
+        """Clear the cache if the data version changed since last checked"""
+        now = time.monotonic()
+        if not self.get_version or now - self.version_checked_at < self.version_check_interval:
+            return
+        version = self.get_version()
+        with self._lock:
+            self.version_checked_at = now
+            if version != self.version:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.version = version
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Look up key. Returns (found, value)."""
+        self._check_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key: Hashable, value: Any):
+        """Store value under key"""
+        self._check_version()
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit / miss counters and size"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None,
+            'invalidations': self.invalidations, 'size': len(self._entries), 'maxsize': self.maxsize}
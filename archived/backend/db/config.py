@@ -39,10 +39,12 @@ def recursify_list_dict(d1: Dict[str, List[str]]) -> Dict[str, Dict]:
         d2[key] = recursify_key_in_list_dict(d1, key)
     return d2
 
-def get_pg_connect_url(local=False):
-    """Get URL to connect to the database server"""
+def get_pg_connect_url(local=False, driver: str = None):
+    """Get URL to connect to the database server
+
+    :param driver: DBAPI driver, if not the configured one, e.g. 'asyncpg' for async connections"""
     config = CONFIG_LOCAL if local else CONFIG
-    return f'{config["server"]}+{config["driver"]}://' \
+    return f'{config["server"]}+{driver or config["driver"]}://' \
            f'{config["user"]}:{config["pass"]}@{config["host"]}:{config["port"]}' \
            f'/{config["db"]}'
 
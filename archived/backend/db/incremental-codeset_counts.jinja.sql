@@ -0,0 +1,23 @@
+-- Table: codeset_counts: rows of changed codesets only ----------------------------------------------------------------
+-- Same rows as ddl-10-codeset_counts, for the codesets in the temp table changed_codesets
+DELETE FROM {{schema}}codeset_counts WHERE codeset_id IN (SELECT codeset_id FROM changed_codesets);
+
+INSERT INTO {{schema}}codeset_counts (codeset_id, counts, flag_cnts)
+WITH mis AS (
+  SELECT * FROM {{schema}}members_items_summary WHERE codeset_id IN (SELECT codeset_id FROM changed_codesets)
+), m1 AS (
+  SELECT m1.codeset_id, json_object_agg(m1.grp, m1.cnt) AS counts
+  FROM mis m1
+  GROUP BY codeset_id
+), m2 AS (
+    SELECT codeset_id, json_object_agg(flags, cnt) AS flag_cnts
+    FROM (
+        SELECT codeset_id, flags, cnt
+        FROM mis
+        WHERE length(flags) > 0
+    ) nf
+    GROUP BY codeset_id
+)
+SELECT m1.*, m2.flag_cnts
+FROM m1
+LEFT JOIN m2 ON m1.codeset_id = m2.codeset_id;
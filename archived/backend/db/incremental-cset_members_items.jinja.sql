@@ -0,0 +1,69 @@
+-- Table: cset_members_items: rows of changed codesets only ------------------------------------------------------------
+-- Same rows as ddl-6-cset_members_items, for the codesets in the temp table changed_codesets. Run by
+-- refresh_cset_derived_tables_incremental(), in one transaction with the other incremental-*.jinja.sql.
+DELETE FROM {{schema}}cset_members_items WHERE codeset_id IN (SELECT codeset_id FROM changed_codesets);
+
+INSERT INTO {{schema}}cset_members_items (
+    codeset_id, concept_id, csm, item, flags, item_flags, "isExcluded", "includeDescendants", "includeMapped",
+    vocabulary_id, standard_concept, concept_code, concept_name, concept_class_id)
+WITH csvi AS (
+    SELECT DISTINCT
+       csv.codeset_id,
+       csv.concept_id,
+       csv."isExcluded",
+       csv."includeDescendants",
+       csv."includeMapped"
+    FROM {{schema}}concept_set_version_item csv
+    WHERE csv.codeset_id IN (SELECT codeset_id FROM changed_codesets)
+), csm AS (
+    SELECT codeset_id, concept_id
+    FROM {{schema}}concept_set_members
+    WHERE codeset_id IN (SELECT codeset_id FROM changed_codesets)
+), csmi1 AS (
+    SELECT DISTINCT
+        csvi.codeset_id,
+        csvi.concept_id,
+        csm.concept_id IS NOT NULL AS "csm",
+        true AS "item",
+        concat_ws('',
+            CASE WHEN "includeDescendants" THEN 'D' ELSE '' END,
+            CASE WHEN "includeMapped" THEN 'M' ELSE '' END,
+            CASE WHEN "isExcluded" THEN 'X' ELSE '' END
+        ) AS flags,
+        NULLIF(concat_ws(',',
+            CASE WHEN "isExcluded" THEN 'isExcluded' ELSE NULL END,
+            CASE WHEN "includeDescendants" THEN 'includeDescendants' ELSE NULL END,
+            CASE WHEN "includeMapped" THEN 'includeMapped' ELSE NULL END
+        ), '') AS item_flags,
+        "isExcluded",
+        "includeDescendants",
+        "includeMapped"
+    FROM csvi
+    LEFT JOIN csm ON csvi.codeset_id = csm.codeset_id AND csvi.concept_id = csm.concept_id
+), csmi2 AS (
+    SELECT DISTINCT
+        csm.codeset_id,
+        csm.concept_id,
+        true AS "csm",
+        false AS "item",
+        NULL::text AS flags,
+        NULL::text AS item_flags,
+        NULL::bool AS "isExcluded",
+        NULL::bool AS "includeDescendants",
+        NULL::bool AS "includeMapped"
+    FROM csm
+    LEFT JOIN csmi1 ON csm.codeset_id = csmi1.codeset_id AND csm.concept_id = csmi1.concept_id
+    WHERE csmi1.concept_id IS NULL
+    UNION
+    SELECT * FROM csmi1
+)
+SELECT
+    csmi2.*,
+    c.vocabulary_id,
+    c.standard_concept,
+    c.concept_code,
+    c.concept_name,
+    c.concept_class_id
+FROM {{schema}}code_sets cs
+JOIN csmi2 ON cs.codeset_id = csmi2.codeset_id
+JOIN {{schema}}concept c ON csmi2.concept_id = c.concept_id;
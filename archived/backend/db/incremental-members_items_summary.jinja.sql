@@ -0,0 +1,30 @@
+-- Table: members_items_summary: rows of changed codesets only ---------------------------------------------------------
+-- Same rows as ddl-9-members_items_summary, for the codesets in the temp table changed_codesets
+DELETE FROM {{schema}}members_items_summary WHERE codeset_id IN (SELECT codeset_id FROM changed_codesets);
+
+INSERT INTO {{schema}}members_items_summary (codeset_id, grp, flags, cnt)
+WITH csmi AS (
+    SELECT * FROM {{schema}}cset_members_items WHERE codeset_id IN (SELECT codeset_id FROM changed_codesets)
+)
+SELECT
+    codeset_id,
+    CASE
+        WHEN item AND csm THEN 'Expression item and member'
+        WHEN item THEN 'Expression item only'
+        WHEN csm THEN 'Member only'
+        ELSE 'WHAT IS THIS?' END
+    ||
+    CASE
+        WHEN item THEN ' -- '
+                        ||
+                        CASE WHEN LENGTH(item_flags) > 0 THEN item_flags ELSE 'no flags' END
+        ELSE '' END
+    AS grp,
+    flags,
+    COUNT(*) AS cnt
+FROM csmi
+GROUP by 1,2,3
+UNION
+SELECT codeset_id, 'Members' AS grp, NULL, SUM(CASE WHEN csm THEN 1 ELSE 0 END) AS cnt FROM csmi GROUP by 1,2
+UNION
+SELECT codeset_id, 'Expression items' AS grp, NULL, SUM(CASE WHEN item THEN 1 ELSE 0 END) AS cnt FROM csmi GROUP by 1,2;
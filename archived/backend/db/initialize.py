@@ -19,7 +19,7 @@ PROJECT_ROOT = Path(THIS_DIR).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
 from backend.db.config import CONFIG
 from backend.db.load import download_artefacts, make_derived_tables_and_more, initialize_test_schema, seed
-from backend.db.utils import database_exists, run_sql, list_schema_objects, get_db_connection, DB
+from backend.db.utils import LOAD_CSV_WORKERS, database_exists, run_sql, list_schema_objects, get_db_connection, DB
 
 SCHEMA = CONFIG['schema']
 
@@ -133,11 +133,13 @@ def _delete_rxnorm_extension_records(con: Connection):
 
 def initialize(
     clobber=False, replace_rule=None, schema: str = SCHEMA, local=False, create_db=False, download=True, download_force_if_exists=False,
-    test_schema=True, test_schema_only=False, hours_threshold_for_updates=24, optimization_experiment=None
+    test_schema=True, test_schema_only=False, hours_threshold_for_updates=24, optimization_experiment=None,
+    workers: int = LOAD_CSV_WORKERS
 ):
     """Initialize set up of DB
 
-    :param local: If True, does this on local instead of production database."""
+    :param local: If True, does this on local instead of production database.
+    :param workers: Number of tables to load at once when seeding."""
     with get_db_connection(local=local, schema=schema) as con:
         if test_schema_only:
             return initialize_test_schema(con, schema, local=local)
@@ -148,7 +150,7 @@ def initialize(
 
         run_sql(con, f"""CREATE SCHEMA IF NOT EXISTS {schema};""")
 
-        seed(con, schema, clobber, replace_rule, hours_threshold_for_updates, local=local)
+        seed(con, schema, clobber, replace_rule, hours_threshold_for_updates, local=local, workers=workers)
 
         if optimization_experiment == 'n3c_no_rxnorm':
             _delete_rxnorm_extension_records(con)
@@ -197,6 +199,9 @@ def cli():
              'as uploading data to the DB.\n'
              'This is useful if expecting errors to happen during table creation / seeding process, and you don\'t want'
              ' to start over from the beginning.')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=LOAD_CSV_WORKERS,
+        help='Number of tables to load at once, each on its own DB connection. Use 1 to load them one at a time.')
     initialize(**vars(parser.parse_args()))
 
 
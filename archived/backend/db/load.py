@@ -5,9 +5,9 @@ from typing import Dict, List
 from sqlalchemy.engine.base import Connection
 
 from backend.db.config import CONFIG
-from backend.db.utils import get_ddl_statements, check_if_updated, current_datetime, insert_from_dict, \
-    is_table_up_to_date, load_csv, refresh_any_dependent_tables, run_sql, get_db_connection, sql_in, \
-    sql_query, update_db_status_var
+from backend.db.utils import LOAD_CSV_WORKERS, get_ddl_statements, check_if_updated, current_datetime, \
+    insert_from_dict, is_table_up_to_date, load_csvs, refresh_any_dependent_tables, run_sql, get_db_connection, \
+    sql_in, sql_query, update_db_status_var
 from enclave_wrangler.config import DATASET_REGISTRY
 from enclave_wrangler.datasets import download_datasets
 from enclave_wrangler.objects_api import download_favorite_objects
@@ -106,24 +106,26 @@ def initialize_test_schema(con_initial: Connection, schema: str = SCHEMA, local=
 
 def seed(
     con: Connection, schema: str = SCHEMA, clobber=False, replace_rule=None, skip_if_updated_within_hours: int = None,
-    dataset_tables: List[str] = DATASET_TABLES, object_tables: List[str] = OBJECT_TABLES, test_tables=False, local=False
-):
-    """Seed the database with some data"""
+    dataset_tables: List[str] = DATASET_TABLES, object_tables: List[str] = OBJECT_TABLES, test_tables=False,
+    local=False, workers: int = LOAD_CSV_WORKERS
+) -> Dict[str, Dict]:
+    """Seed the database with some data
+
+    :param workers: Number of tables to load at once. They're independent of one another; keys and indexes come later,
+    in make_derived_tables_and_more().
+    :returns Per-table progress: status, rows loaded and seconds taken. See load_csvs()."""
     if not replace_rule:
         replace_rule = 'do not replace' if not clobber else None
 
-    for table in dataset_tables:
-        if is_table_up_to_date(table, skip_if_updated_within_hours):
-            print(f'INFO: Skipping upload of table "{table}" because it is up to date.')
-            continue
-        load_csv(con, table, replace_rule=replace_rule, schema=schema, is_test_table=test_tables, local=local)
-    for table in object_tables:
-        if is_table_up_to_date(table, skip_if_updated_within_hours):
-            print(f'INFO: Skipping upload of table "{table}" because it is up to date.')
-            continue
-        load_csv(
-            con, table, table_type='object', replace_rule=replace_rule, schema=schema, is_test_table=test_tables,
-            local=local)
+    jobs: List[Dict] = []
+    for table_type, tables in (('dataset', dataset_tables), ('object', object_tables)):
+        for table in tables:
+            if is_table_up_to_date(table, skip_if_updated_within_hours):
+                print(f'INFO: Skipping upload of table "{table}" because it is up to date.')
+                continue
+            jobs.append({'table': table, 'table_type': table_type, 'replace_rule': replace_rule,
+                         'is_test_table': test_tables})
+    return load_csvs(jobs, workers, schema, local, con)
 
 
 # TODO: This function and more needs to be renamed and checked for any bugs. This is no longer just about derived
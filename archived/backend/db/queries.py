@@ -4,22 +4,56 @@ from typing import List, Dict, Set, Union
 from fastapi import Query
 from sqlalchemy import Connection
 
-from backend.db.utils import sql_query, sql_query_single_col, get_db_connection, sql_in
+from backend.db.utils import async_sql_query, get_async_db_connection, sql_query, sql_query_single_col, \
+    get_db_connection, sql_in
 
 
-def get_concepts(concept_ids: Union[List[int], Set[int]], con: Connection = None, table:str='concepts_with_counts') -> List:
-    """Get information about concept sets the user has selected"""
-    conn = con if con else get_db_connection()
-    q = f"""
+def concepts_query(concept_ids: Union[List[int], Set[int]], table: str = 'concepts_with_counts') -> str:
+    """Query for get_concepts()"""
+    return f"""
           SELECT *
           FROM {table}
           WHERE concept_id {sql_in(concept_ids)};"""
-    rows: List = sql_query(conn, q)
+
+
+def get_concepts(concept_ids: Union[List[int], Set[int]], con: Connection = None, table:str='concepts_with_counts') -> List:
+    """Get information about concept sets the user has selected"""
+    conn = con if con else get_db_connection()
+    rows: List = sql_query(conn, concepts_query(concept_ids, table))
     if not con:
         conn.close()
     return rows
 
 
+async def async_get_concepts(concept_ids: Union[List[int], Set[int]], table: str = 'concepts_with_counts') -> List:
+    """Async counterpart of get_concepts(), for async routes"""
+    async with get_async_db_connection() as con:
+        return await async_sql_query(con, concepts_query(concept_ids, table))
+
+
+def expression_items_query(codeset_ids: Union[List[int], Set[int]]) -> str:
+    """Query for get_expression_items()"""
+    return f"""
+          SELECT codeset_id, concept_id, "includeDescendants", "includeMapped", "isExcluded"
+          FROM concept_set_version_item
+          WHERE codeset_id {sql_in(codeset_ids)};"""
+
+
+def get_expression_items(codeset_ids: Union[List[int], Set[int]], con: Connection = None) -> List:
+    """Get the expression items of concept set versions, with the flags needed to expand them"""
+    conn = con if con else get_db_connection()
+    rows: List = sql_query(conn, expression_items_query(codeset_ids))
+    if not con:
+        conn.close()
+    return rows
+
+
+async def async_get_expression_items(codeset_ids: Union[List[int], Set[int]]) -> List:
+    """Async counterpart of get_expression_items(), for async routes"""
+    async with get_async_db_connection() as con:
+        return await async_sql_query(con, expression_items_query(codeset_ids))
+
+
 def get_vocab_of_concepts(id: List[int] = Query(...), con: Connection = None, table:str='concept') -> List:
     """Expecting only one vocab for the list of concepts"""
     conn = con if con else get_db_connection()
@@ -25,8 +25,8 @@ BACKEND_DIR = os.path.join(DB_DIR, '..')
 PROJECT_ROOT = os.path.join(BACKEND_DIR, '..')
 sys.path.insert(0, str(PROJECT_ROOT))
 from backend.db.analysis import counts_update
-from backend.db.utils import SCHEMA, check_db_status_var, current_datetime, get_db_connection, get_ddl_statements, \
-    load_csv, refresh_derived_tables, reset_temp_refresh_tables, run_sql, update_db_status_var
+from backend.db.utils import LOAD_CSV_WORKERS, SCHEMA, check_db_status_var, current_datetime, get_db_connection, \
+    get_ddl_statements, load_csvs, refresh_derived_tables, reset_temp_refresh_tables, run_sql, update_db_status_var
 from enclave_wrangler.config import DATASET_GROUPS_CONFIG
 from enclave_wrangler.datasets import download_datasets, get_datetime_dataset_last_updated
 
@@ -36,21 +36,29 @@ class NotAnError(Exception):
     pass
 
 
-def load_dataset_group(dataset_group_name: str, schema: str = SCHEMA, alternate_dataset_dir: Union[Path, str] = None):
+def load_dataset_group(
+    dataset_group_name: str, schema: str = SCHEMA, alternate_dataset_dir: Union[Path, str] = None,
+    workers: int = LOAD_CSV_WORKERS
+):
     """Load data
 
-    :param alternate_dataset_dir: Designed mainly for automated tests to load input files to test schema."""
+    :param alternate_dataset_dir: Designed mainly for automated tests to load input files to test schema.
+    :param workers: Number of tables to load at once. Each is loaded as <table>_new, so the live tables are untouched
+    until they are all loaded and swapped in."""
     config: Dict = DATASET_GROUPS_CONFIG[dataset_group_name]
     # noinspection PyBroadException
     try:
         with get_db_connection(schema=schema) as con:
-            for table in config['tables']:  # tables themselves (non-derived)
-                print(f' - loading {table}...')
+            jobs: List[Dict] = [{
+                'table': table, 'replace_rule': 'do not replace', 'optional_suffix': '_new',
+                'path_override': Path(alternate_dataset_dir) / f'{table}.csv' if alternate_dataset_dir else None,
+                'is_test_table': bool(alternate_dataset_dir),
+            } for table in config['tables']]  # tables themselves (non-derived)
+            print(f' - loading {", ".join(config["tables"])}...')
+            progress: Dict[str, Dict] = load_csvs(jobs, workers, schema, con=con)
+
+            for table in config['tables']:
                 t0 = datetime.now()
-                load_csv(
-                    con, table, replace_rule='do not replace', schema=schema, optional_suffix='_new',
-                    path_override=Path(alternate_dataset_dir) / f'{table}.csv' if alternate_dataset_dir else None,
-                    is_test_table=bool(alternate_dataset_dir))
                 run_sql(con, f'ALTER TABLE IF EXISTS {schema}.{table} RENAME TO {table}_old;')
                 run_sql(con, f'ALTER TABLE {schema}.{table}_new RENAME TO {table};')
 
@@ -69,7 +77,8 @@ def load_dataset_group(dataset_group_name: str, schema: str = SCHEMA, alternate_
                 t1 = datetime.now()
                 # todo: set variable for 'last updated' for each table (look at load())
                 #  - consider: check if table already updated sooner than last_updated_them. if so, skip. and add a param to CLI for this
-                print(f'   done in {(t1 - t0).seconds} seconds')
+                print(f' - {table}: loaded in {progress[table]["seconds"]} seconds; keys and indexes in '
+                      f'{(t1 - t0).seconds} seconds')
 
             print('Recreating derived tables')  # derived tables
             refresh_derived_tables(con, config['tables'], schema)
@@ -83,7 +92,8 @@ def load_dataset_group(dataset_group_name: str, schema: str = SCHEMA, alternate_
 
 
 def refresh_dataset_group_tables(
-    dataset_group: List[str], skip_downloads: bool = False, download_only: bool = False, schema=SCHEMA
+    dataset_group: List[str], skip_downloads: bool = False, download_only: bool = False, schema=SCHEMA,
+    workers: int = LOAD_CSV_WORKERS
 ):
     """Refresh tables by dataset group (e.g. vocabulary and counts)"""
     print(f'Refreshing tables for the following dataset groups: {",".join(dataset_group)}')
@@ -106,7 +116,7 @@ def refresh_dataset_group_tables(
         # Load data
         if not download_only:
             print('Loading downloaded datasets into DB tables')
-            load_dataset_group(group_name, schema)
+            load_dataset_group(group_name, schema, workers=workers)
 
             # Mark complete
             update_db_status_var(config['last_updated_termhub_var'], current_datetime())
@@ -138,6 +148,9 @@ def cli():
     parser.add_argument(
         '-D', '--download-only', action='store_true',
         help='Use if you want to download the dataset files and upload them later.')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=LOAD_CSV_WORKERS,
+        help='Number of tables to load at once, each on its own DB connection. Use 1 to load them one at a time.')
     refresh_dataset_group_tables(**vars(parser.parse_args()))
 
 
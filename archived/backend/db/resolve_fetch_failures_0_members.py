@@ -24,8 +24,11 @@ PROJECT_ROOT = os.path.join(BACKEND_DIR, "..")
 sys.path.insert(0, str(PROJECT_ROOT))
 from backend.utils import call_github_action
 from backend.db.resolve_fetch_failures_excess_items import resolve_fetch_failures_excess_items
-from backend.db.utils import SCHEMA, fetch_status_set_success, get_db_connection, reset_temp_refresh_tables,\
-    run_sql, select_failed_fetches, refresh_derived_tables, sql_in, sql_query
+from backend.db.queries import get_concepts, get_expression_items
+from backend.db.utils import SCHEMA, fetch_status_set_success, get_db_connection, insert_from_dicts, \
+    reset_temp_refresh_tables, run_sql, select_failed_fetches, refresh_derived_tables, sql_in, sql_query
+from backend.graph.expansion import expand_csets
+from backend.graph.reachability import ReachabilityIndex
 from enclave_wrangler.objects_api import csets_and_members_to_db, fetch_cset_and_member_objects, fetch_cset_version, \
     get_csets_over_threshold, sync_expressions_for_csets, update_cset_metadata_from_objs
 from enclave_wrangler.utils import EnclaveWranglerErr
@@ -204,6 +207,47 @@ def filter_cset_id_where_0_expanded_members(cset_ids: List[int], schema=SCHEMA,
         return list(set(zero_expr_ids + all_excluded_ids))
 
 
+def backfill_members_locally(cset_ids: List[int], schema=SCHEMA, use_local_db=False) -> Dict[int, int]:
+    """Fill in concept_set_members for csets that the enclave hasn't expanded yet, by expanding their expression items
+    locally (see backend/graph/expansion.py). Any members they already have are replaced.
+
+    These members are replaced by the enclave's expansion once it is fetched, in resolve_fetch_failures_0_members().
+    :return: Map of codeset_id to number of members backfilled"""
+    from backend.routes.graph import get_maps_to_index, load_relationship_graph  # slow; only needed here
+    if not cset_ids:
+        return {}
+    graph = load_relationship_graph(save=False)
+    index = ReachabilityIndex.for_graph(graph)
+    maps_to = get_maps_to_index(graph)
+    with get_db_connection(schema=schema, local=use_local_db) as con:
+        members = expand_csets(index, maps_to, get_expression_items(cset_ids, con))
+        cset_lookup: Dict[int, Dict] = {row['codeset_id']: row for row in sql_query(con, f"""
+            SELECT cs.codeset_id, cs.concept_set_name, cs.is_most_recent_version, cs.version, csc.archived
+            FROM code_sets cs
+            LEFT JOIN concept_set_container csc ON cs.concept_set_name = csc.concept_set_name
+            WHERE cs.codeset_id {sql_in(cset_ids)};""")}
+        members = {k: v for k, v in members.items() if k in cset_lookup}
+        concept_ids: Set[int] = set().union(*[set(ids.tolist()) for ids in members.values()])
+        concept_names: Dict[int, str] = {
+            row['concept_id']: row['concept_name'] for row in get_concepts(concept_ids, con, 'concept')} \
+            if concept_ids else {}
+        rows: List[Dict] = [{
+            'codeset_id': codeset_id,
+            'concept_id': concept_id,
+            'concept_set_name': cset_lookup[codeset_id]['concept_set_name'],
+            'is_most_recent_version': cset_lookup[codeset_id]['is_most_recent_version'],
+            'version': cset_lookup[codeset_id]['version'],
+            'concept_name': concept_names.get(concept_id),
+            'archived': cset_lookup[codeset_id]['archived'] or False,
+        } for codeset_id, ids in members.items() for concept_id in ids.tolist()]
+        if members:
+            run_sql(con, f'DELETE FROM concept_set_members WHERE codeset_id {sql_in(list(members.keys()))};')
+        if rows:
+            insert_from_dicts(con, 'concept_set_members', rows, skip_if_already_exists=False)
+            refresh_derived_tables(con, independent_tables=['concept_set_members'], schema=schema)
+    return {codeset_id: len(ids) for codeset_id, ids in members.items()}
+
+
 def get_failures_0_members(
     version_ids: Union[int, List[int]] = None, use_local_db=False, force=False
 ) -> Tuple[Set[int], Dict[int, Dict]]:
@@ -234,7 +278,7 @@ def get_failures_0_members(
 
 def resolve_fetch_failures_0_members(
     version_ids: Union[int, List[int]] = None, use_local_db=False, polling_interval_seconds=30, schema=SCHEMA,
-    expansion_threshold_seconds=3 * 60 * 60, loop=False, force=False
+    expansion_threshold_seconds=3 * 60 * 60, loop=False, force=False, backfill_locally=False
 ):
     """Resolve situations where we tried to fetch data from the Enclave, but failed due to the concept set being too new
     resulting in initial fetch of concept set members being 0.
@@ -248,6 +292,8 @@ def resolve_fetch_failures_0_members(
     :param loop: If True, will run in a loop to keep attempting to fetch. If this is set to False, it's probably
     because the normal DB refresh rate is already high, and this action runs at the end of every refresh (if there are
     any outstanding issus), so it's not really necessary to run these two concurrently.
+    :param backfill_locally: For csets that still have no members from the enclave, e.g. drafts, expand their
+    expression items locally in the meantime. See backfill_members_locally().
     todo: version_id: support list of IDs (comma-delimited)
     todo: Performance: Fetch only members, ideally: Even though we are fetching 'members', adding to the cset members
      table requires cset version and container metadata, and the function that does this expects them to be formaatted
@@ -343,6 +389,8 @@ def resolve_fetch_failures_0_members(
             try:
                 with get_db_connection(schema=schema, local=use_local_db) as con:
                     update_cset_metadata_from_objs(finalized_drafts, con)
+                    # Replace any members backfilled locally (see backfill_members_locally()) with the enclave's
+                    run_sql(con, f'DELETE FROM concept_set_members WHERE codeset_id {sql_in(success_cset_ids)};')
                     csets_and_members_to_db(con, success_cases, ['OmopConceptSetVersionItem', 'OMOPConcept'], schema)
                 print(f"Successfully fetched concept set members for concept set versions: "
                       f"{', '.join([str(x) for x in success_cset_ids])}")
@@ -378,6 +426,10 @@ def resolve_fetch_failures_0_members(
         print(f"Fetch attempted for the following csets, but they still remain drafts and thus still have not had their"
               f" members expanded yet: {', '.join([str(x) for x in still_draft_cset_ids])}")
     non_draft_failure_ids: Set[int] = set(failed_cset_ids) - still_draft_cset_ids
+    if backfill_locally and failed_cset_ids:
+        backfilled: Dict[int, int] = backfill_members_locally(list(failed_cset_ids), schema, use_local_db)
+        print(f"Backfilled members by local expansion, until the enclave's expansion is available: "
+              f"{', '.join([f'{k} ({v} members)' for k, v in backfilled.items()])}")
 
     # - Filter by only if has been finalized longer than we would expect it should take for expansion to be available
     # AI-generated: For finalized codesets that still have 0 members, check if they've been waiting too long (>3 hours)
@@ -442,6 +494,13 @@ def cli():
         required=False,
         help="If any csets are encountered which have already been resolved, will execute the fetch/import process "
              "instead of skipping.")
+    parser.add_argument(
+        "-b",
+        "--backfill-locally",
+        action="store_true",
+        required=False,
+        help="For csets that still have no members from the enclave, e.g. drafts, expand their expression items "
+             "locally in the meantime.")
     resolve_fetch_failures_0_members(**vars(parser.parse_args()))
 
 
@@ -5,9 +5,16 @@ todo's
   2. Making 'Connection' optional: Can write a wrapper function and decorate all functions that need, where all it does
   is `conn = con if con else get_db_connection()`, run the inner function, and then close conn if not con.
 """
+import asyncio
+import csv
+import heapq
+import io
 import json
 import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from contextlib import asynccontextmanager, contextmanager
 import sys
+import threading
 import time
 from argparse import ArgumentParser
 from pathlib import Path
@@ -21,23 +28,27 @@ import re
 
 import pandas as pd
 from jinja2 import Template
+from psycopg2 import Error as Psycopg2Error
 # noinspection PyUnresolvedReferences
 from psycopg2.errors import UndefinedTable
 from sqlalchemy import create_engine, event, CursorResult
-from sqlalchemy.engine import Row, RowMapping
+from sqlalchemy.engine import Engine, Row, RowMapping
 from sqlalchemy.engine.base import Connection
-from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.exc import OperationalError, ProgrammingError, TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import text
 from sqlalchemy.sql.elements import TextClause
-from typing import Any, Dict, Set, Tuple, Union, List
+from typing import Any, AsyncIterator, BinaryIO, Collection, Dict, Iterator, Optional, Set, Tuple, Union, List
 
 
 DB_DIR = os.path.dirname(os.path.realpath(__file__))
 PROJECT_ROOT = Path(DB_DIR).parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
-from backend.db.config import CORE_CSET_TABLES, PG_DATATYPES_BY_GROUP, RECURSIVE_DEPENDENT_TABLE_MAP, \
-    REFRESH_JOB_MAX_HRS, get_pg_connect_url
+from backend.db.config import CORE_CSET_TABLES, DERIVED_TABLE_DEPENDENCY_MAP, PG_DATATYPES_BY_GROUP, \
+    RECURSIVE_DEPENDENT_TABLE_MAP, REFRESH_JOB_MAX_HRS, get_pg_connect_url
 from backend.config import CONFIG, DATASETS_PATH, OBJECTS_PATH
+from backend.metrics import incr, register_collector
 from backend.utils import commify
 from enclave_wrangler.models import pkey
 
@@ -47,6 +58,7 @@ TIMEZONE_DEFAULT = ['UTC/GMT', 'EST/EDT'][1]
 DEBUG = False
 DB = CONFIG["db"]
 SCHEMA = CONFIG["schema"]
+DERIVED_REFRESH_WORKERS = int(os.getenv('TERMHUB_DERIVED_REFRESH_WORKERS', 3))
 
 
 def dedupe_dicts(list_of_dicts: List[Dict]) -> List[Dict]:
@@ -72,6 +84,48 @@ def extract_keys_from_nested_dict(d: Dict[str, Dict]) -> List[str]:
     return ordered_unique_keys
 
 
+def get_derived_table_dependencies(derived_tables: List[str]) -> Dict[str, List[str]]:
+    """For each of derived_tables, those of the others it is derived from, directly or via tables not listed
+
+    :return: Map of table to its dependencies, in the order of derived_tables"""
+    tables: Set[str] = set(derived_tables)
+    dependencies: Dict[str, List[str]] = {}
+    for table in derived_tables:
+        upstream: Set[str] = set()
+        stack: List[str] = list(DERIVED_TABLE_DEPENDENCY_MAP.get(table, []))
+        while stack:
+            dependency = stack.pop()
+            if dependency not in upstream:
+                upstream.add(dependency)
+                stack.extend(DERIVED_TABLE_DEPENDENCY_MAP.get(dependency, []))
+        dependencies[table] = [x for x in derived_tables if x in upstream and x != table]
+    return dependencies
+
+
+def order_derived_tables(derived_tables: List[str]) -> List[str]:
+    """Order derived_tables so that each comes after those it's derived from
+
+    Deterministic: of the tables whose dependencies are already placed, the one with the earliest DDL file comes next.
+    """
+    rank: Dict[str, int] = {t: i for i, t in enumerate(order_modules_by_ddl_order(derived_tables))}
+    remaining: Dict[str, Set[str]] = {t: set(d) for t, d in get_derived_table_dependencies(derived_tables).items()}
+    ready: List[Tuple[int, str]] = [(rank[t], t) for t, deps in remaining.items() if not deps]
+    heapq.heapify(ready)
+    order: List[str] = []
+    while ready:
+        table: str = heapq.heappop(ready)[1]
+        order.append(table)
+        for dependent, deps in remaining.items():
+            if table in deps:
+                deps.remove(table)
+                if not deps:
+                    heapq.heappush(ready, (rank[dependent], dependent))
+    if len(order) < len(derived_tables):
+        raise ValueError('Circular dependencies among derived tables: '
+                         + ', '.join(t for t in derived_tables if t not in order))
+    return order
+
+
 def get_dependent_tables_queue(independent_tables: Union[List[str], str], _filter: str = None) -> List[str]:
     """From independent_tables, get a list of all tables that depend on those tables.
 
@@ -80,110 +134,78 @@ def get_dependent_tables_queue(independent_tables: Union[List[str], str], _filte
     which derived tables need to be updated in the correct order.
     :param _filter: One of 'table' or 'views'.
     :return: A list in the correct order such that for every entry in the list, any tables that depend on that entry
-    will appear further down in the list.
-
-    TODO: Replace heuristic w/ a correct algorithm.
-     I originally had no steps 2&3, and only 1&4 combined. But the result was out of order. This algorithm below is
-     based on a quick (but messy/long) heuristic. Basically, the longer dependency trees go first. This corrected the
-     problem that I had. But this is just a heuristic. I feel confident that there is some correct algorithm for this
-     solvable in polynomial time.
-     2024/11/09: Determined that this often returns incorrect result. Non-deterministic. For now, have a patch if
-     independent_tables == CORE_CSET_TABLES.
-     - DDL: For now: I have a fix at the bottom, where we go by the order of the DDL. However if the DDL order ever
-     becomes incorrect, this will break.
+    will appear further down in the list. See order_derived_tables().
     """
     if _filter not in [None, 'tables', 'views']:
         raise ValueError(f'Invalid _filter value: {_filter}. Must be one of "tables" or "views".')
-
-    queue: List[str] = []
-    pre_queue1: List[List[str]] = []
-    pre_queue2: List[List[str]] = []
-    queues_by_len: Dict[int, List[List[str]]] = {}
     independent_tables: List[str] = [independent_tables] if isinstance(independent_tables, str) else independent_tables
 
-    # 1 & 4: Get a queue of dependent tables
-    # 1. Build up a list of queues; queue is dependent tables
+    queue: List[str] = []
     for table in independent_tables:
-        dependent_tree: Dict = RECURSIVE_DEPENDENT_TABLE_MAP.get(table, {})
-        if not dependent_tree:
-            continue
-        q: List[str] = extract_keys_from_nested_dict(dependent_tree)
-        pre_queue1.append(q)
-
-    # 2-3: Heuristic: Reorder the queue
-    # 2. Group by queue lengths
-    # - some dependency trees are the same for multiple tables; dedupe for simplicity
-    pre_queue1 = [list(x) for x in set([tuple(x) for x in pre_queue1])]
-    for q in pre_queue1:
-        l = len(q)
-        if l not in queues_by_len:
-            queues_by_len[l] = []
-        queues_by_len[l].append(q)
-
-    # 3. Reorganize list of queues, sorted by longest queues first
-    queue_len_keys = list(queues_by_len.keys())
-    queue_len_keys.sort(reverse=True)
-    for k in queue_len_keys:
-        queues: List[List[str]] = queues_by_len[k]
-        for q in queues:
-            pre_queue2.append(q)
-
-    # 4. Flatten to single list queue of dependent tables
-    for q in pre_queue2:
-        for i in q:
-            if i not in queue:
-                queue.append(i)
-
-    # 5. Optional: Filtering
+        for dependent in extract_keys_from_nested_dict(RECURSIVE_DEPENDENT_TABLE_MAP.get(table, {})):
+            if dependent not in queue:
+                queue.append(dependent)
+    queue = order_derived_tables(queue)
+
+    # Optional: Filtering
     if _filter:
-        views: List[str] = [x for x in list_views() if x in queue]
+        all_views: List[str] = list_views()
+        views: List[str] = [x for x in queue if x in all_views]
         if _filter == 'views':
             return views
         elif _filter == 'tables':
             return [x for x in queue if x not in views]
+    return queue
 
-    # todo - temporary fix: see "DDL" comment in docstring
-    ddl_order_based_queue: List[str] = order_modules_by_ddl_order(queue)
 
-    return ddl_order_based_queue
-
-
-def refresh_any_dependent_tables(con: Connection, independent_tables: List[str] = CORE_CSET_TABLES, schema=SCHEMA):
+def refresh_any_dependent_tables(
+    con: Connection, independent_tables: List[str] = CORE_CSET_TABLES, schema=SCHEMA,
+    workers: int = DERIVED_REFRESH_WORKERS
+) -> Dict[str, Dict[str, float]]:
     """Refresh all derived tables that depend on independent_tables
 
     :param independent_tables: Any tables that changed for which we now want to update any dependent tables.
+    :param workers: Number of derived tables to refresh at once. See refresh_derived_tables_exec().
+    :returns Timings of each derived table refreshed
     """
     derived_tables: List[str] = get_dependent_tables_queue(independent_tables)
     if not derived_tables:
         print(f'No derived tables found for: {", ".join(independent_tables)}')
-        return
-    refresh_derived_tables_exec(con, derived_tables, schema)
+        return {}
+    return refresh_derived_tables_exec(con, derived_tables, schema, workers)
 
 
 def refresh_derived_tables_exec(
-    con: Connection, derived_tables_queue: List[str], schema=SCHEMA
-):
+    con: Connection, derived_tables_queue: List[str], schema=SCHEMA, workers: int = DERIVED_REFRESH_WORKERS
+) -> Dict[str, Dict[str, float]]:
     """Refresh TermHub core cset derived tables
 
     This can also work to initially create the tables if they don't already exist.
 
+    Each module is made as <module>_new, then swapped in, keeping the old one as <module>_old until all are done. Up to
+    `workers` modules are made at once, each on its own connection from con's engine. A module is only started once
+    those it's derived from have been swapped in. Of the modules ready to start, they're started in queue order.
+
     :param derived_tables_queue: Should be ordered such that for every entry in the list, any tables that depend on that
-     entry will appear further down in the list."""
+     entry will appear further down in the list.
+    :param workers: Number of modules made at once, at most the connections con's pool has beyond con itself. If 1,
+    they're made one after another on con, in queue order.
+    :returns Map of module to when it started, relative to the start of the refresh, and how long it took, in seconds
+    """
     temp_table_suffix = '_new'
-    ddl_modules_queue = derived_tables_queue
+    ddl_modules_queue = list(derived_tables_queue)
     views = [x for x in list_views(schema=schema) if x in ddl_modules_queue]
+    timings: Dict[str, Dict[str, float]] = {}
 
-    # Create new tables/views and backup old ones
-    print('Derived tables')
-    t0 = datetime.now()
-    for module in ddl_modules_queue:
-        t0_2 = datetime.now()
+    def refresh_module(module: str, module_con: Connection):
+        """Make a module's new table/view and swap it in"""
+        t0_2 = time.time()
         table_or_view = 'view' if module in views else 'table'
         print(f' - creating new {table_or_view}: {module}...')
         statements: List[str] = get_ddl_statements(schema, module, temp_table_suffix, 'flat')
         for statement in statements:
             try:
-                run_sql(con, statement)
+                run_sql(module_con, statement)
             except ProgrammingError as err:
                 # Context: https://github.com/jhu-bids/TermHub/issues/792
                 if schema == 'test_n3c' and 'does not exist for access method' in str(err):
@@ -193,9 +215,48 @@ def refresh_derived_tables_exec(
                     continue
                 raise err
         # todo: warn if counts in _new table not >= _old table (if it exists)?
-        run_sql(con, f'ALTER TABLE IF EXISTS {schema}.{module} RENAME TO {module}_old;')
-        run_sql(con, f'ALTER TABLE {schema}.{module}{temp_table_suffix} RENAME TO {module};')
-        print(f'   - completed in {(datetime.now() - t0_2).seconds} seconds')
+        run_sql(module_con, f'ALTER TABLE IF EXISTS {schema}.{module} RENAME TO {module}_old;')
+        run_sql(module_con, f'ALTER TABLE {schema}.{module}{temp_table_suffix} RENAME TO {module};')
+        timings[module] = {'started': round(t0_2 - t0, 1), 'seconds': round(time.time() - t0_2, 1)}
+        print(f'   - {module} completed in {timings[module]["seconds"]} seconds')
+
+    def refresh_module_on_own_connection(module: str):
+        """refresh_module(), on a connection of its own"""
+        with con.engine.connect() as module_con:
+            refresh_module(module, module_con)
+
+    # Create new tables/views and backup old ones
+    print('Derived tables')
+    t0 = time.time()
+    # Less con, which is held throughout, so that workers don't wait on the pool
+    workers = max(1, min(workers, len(ddl_modules_queue), DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW - 1))
+    if workers == 1:
+        for module in ddl_modules_queue:
+            refresh_module(module, con)
+    else:
+        waiting_on: Dict[str, Set[str]] = {
+            m: set(deps) for m, deps in get_derived_table_dependencies(ddl_modules_queue).items()}
+        running: Dict[Future, str] = {}
+        error: Optional[BaseException] = None
+        with ThreadPoolExecutor(workers, thread_name_prefix='derived_refresh') as executor:
+            while waiting_on or running:
+                if not error:
+                    ready: List[str] = [m for m, deps in waiting_on.items() if not deps]
+                    for module in ready[:workers - len(running)]:
+                        del waiting_on[module]
+                        running[executor.submit(refresh_module_on_own_connection, module)] = module
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    module = running.pop(future)
+                    error = error or future.exception()
+                    for deps in waiting_on.values():
+                        deps.discard(module)
+        if error:  # modules being made when it happened were left to finish, so none is left half swapped in
+            raise error
+        if waiting_on:
+            raise ValueError('Circular dependencies among derived tables: ' + ', '.join(waiting_on))
 
     # Delete old tables/views. Because of view dependencies, order & commands are different
     print(f' - Removing older, temporarily backed up tables/views...')
@@ -205,8 +266,68 @@ def refresh_derived_tables_exec(
 
     for module in ddl_modules_queue:
         run_sql(con, f'DROP TABLE IF EXISTS {schema}.{module}_old;')
-    t1 = datetime.now()
-    print(f' - completed in {(t1 - t0).seconds} seconds')
+    print(f' - completed in {round(time.time() - t0)} seconds')
+    return timings
+
+
+# Derived tables that refresh_cset_derived_tables_incremental() updates, in order. All tables derived from only
+# CORE_CSET_TABLES (views aside, which need nothing), as test_utils checks.
+INCREMENTAL_DERIVED_TABLES = ['cset_members_items', 'members_items_summary', 'codeset_counts', 'all_csets']
+INCREMENTAL_SQL_PATH_PATTERN = os.path.join(DB_DIR, 'incremental-{}.jinja.sql')
+
+
+def can_refresh_incrementally(con: Connection, independent_tables: List[str], schema=SCHEMA) -> bool:
+    """Can the derived tables of independent_tables be brought up to date by refresh_cset_derived_tables_incremental()?
+    Only if all are core cset tables, so no vocab, and the derived tables already exist to be updated."""
+    if not set(independent_tables) <= set(CORE_CSET_TABLES):
+        return False
+    existing: List = sql_query_single_col(
+        con, 'SELECT to_regclass(x) FROM unnest(CAST(:tables AS text[])) x;',
+        {'tables': [f'{schema}.{t}' for t in INCREMENTAL_DERIVED_TABLES]})
+    return all(existing)
+
+
+def refresh_cset_derived_tables_incremental(
+    con: Connection, codeset_ids: Collection[int], concept_set_names: Collection[str] = (), schema=SCHEMA
+) -> Dict[str, float]:
+    """Update only the rows of changed codesets in the derived tables of the core cset tables, in one transaction
+
+    Deletes and reinserts those codesets' rows of each of INCREMENTAL_DERIVED_TABLES, with the same queries as their
+    DDL, so takes seconds rather than the minutes a full refresh_derived_tables_exec() takes. Readers see the old rows
+    until it commits.
+
+    :param codeset_ids: Codesets whose versions, expression items or members changed, e.g. in a cset refresh
+    :param concept_set_names: Containers that changed. all_csets has container fields, so all their codesets are
+    updated.
+    :returns Seconds taken per table
+    """
+    timings: Dict[str, float] = {}
+    if not codeset_ids and not concept_set_names:
+        return timings
+    print(f'Derived tables: updating {len(codeset_ids)} codesets and the codesets of {len(concept_set_names)} '
+          f'containers')
+    t0 = time.time()
+    run_sql(con, 'BEGIN;')
+    try:
+        run_sql(con, f"""
+            CREATE TEMP TABLE changed_codesets ON COMMIT DROP AS
+            SELECT DISTINCT codeset_id FROM (
+                SELECT unnest(CAST(:codeset_ids AS int[])) AS codeset_id
+                UNION
+                SELECT codeset_id FROM {schema}.code_sets WHERE concept_set_name = ANY(:concept_set_names)
+            ) x;""", {'codeset_ids': [int(x) for x in codeset_ids], 'concept_set_names': list(concept_set_names)})
+        for table in INCREMENTAL_DERIVED_TABLES:
+            t1 = time.time()
+            for statement in sql_template_statements(INCREMENTAL_SQL_PATH_PATTERN.format(table), schema=schema + '.'):
+                run_sql(con, statement)
+            timings[table] = round(time.time() - t1, 1)
+            print(f' - {table}: updated in {timings[table]} seconds')
+        run_sql(con, 'COMMIT;')
+    except Exception as err:
+        run_sql(con, 'ROLLBACK;')
+        raise err
+    print(f' - completed in {round(time.time() - t0, 1)} seconds')
+    return timings
 
 
 # todo: move this somewhere else, possibly load.py or db_refresh.py
@@ -217,7 +338,8 @@ def refresh_derived_tables_exec(
 #  to take a very long time to run, especially during the wee hours when vocab/counts refreshes are running.
 def refresh_derived_tables(
     con: Connection, independent_tables: Union[str, List[str]] = CORE_CSET_TABLES, schema=SCHEMA, local=False,
-    polling_interval_seconds: int = 30
+    polling_interval_seconds: int = 30, workers: int = DERIVED_REFRESH_WORKERS, codeset_ids: Collection[int] = None,
+    concept_set_names: Collection[str] = ()
 ):
     """Refresh TermHub core cset derived tables: wrapper function
 
@@ -225,6 +347,10 @@ def refresh_derived_tables(
     refresh_derived_tables_exec()
 
     :param independent_tables: Any tables that changed for which we now want to update any dependent tables.
+    :param workers: Number of derived tables to refresh at once. See refresh_derived_tables_exec().
+    :param codeset_ids: Codesets that changed, if known. If so, and only core cset tables changed, just the rows of
+    those codesets and of the codesets of `concept_set_names` (changed containers) are updated, rather than the derived
+    tables being rebuilt. See refresh_cset_derived_tables_incremental().
     """
     i = 0
     t0 = datetime.now()
@@ -242,56 +368,37 @@ def refresh_derived_tables(
         else:
             try:
                 update_db_status_var('last_derived_refresh_request', current_datetime(), local)
-                refresh_any_dependent_tables(con, independent_tables, schema)
+                if codeset_ids is not None and can_refresh_incrementally(con, independent_tables, schema):
+                    refresh_cset_derived_tables_incremental(con, codeset_ids, concept_set_names, schema)
+                else:
+                    refresh_any_dependent_tables(con, independent_tables, schema, workers)
             finally:
                 update_db_status_var('last_derived_refresh_exited', current_datetime(), local)
             break
 
 
-# todo: Any use to having this? If not, remove. Otherwise, needs fixing. It was working when in get_db_connection() we
-#  were not passing schema... but that's not really working. We need to be able to control the schema. After changing to
-#  pass schema, sometimes it worked, and sometimes we got err: AttributeError: 'dict' object has no attribute 'cursor',
-#  indicating that the kwargs weren't getting passed appropriately.
-# from functools import partial
-# from sqlalchemy.pool import QueuePool
-# def set_search_path(dbapi_connection, schema=SCHEMA, connection_record=None):
-#     """Set the search_path when connecting.
-#
-#     Source: https://chat.openai.com/share/0472ba44-0e58-44ad-bbcb-5eabffae3d39
-#
-#     Note: This hasn't helped w/ a problem we were having. If it continues to not help, we could rever to the old
-#     version of get_db_connection().
-#     """
-#     cursor = dbapi_connection.cursor()
-#     cursor.execute(f"SET SESSION search_path='{schema}'")
-#     cursor.close()
-#
-#
-# def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Connection:
-#     """Get database connection object
-#
-#     :param local: If True, connection is on local instead of production database.
-#     """
-#     if schema == None:
-#         raise ValueError('Must pass schema to get_db_connection()')
-#     engine = create_engine(
-#         get_pg_connect_url(local),
-#         poolclass=QueuePool,
-#         isolation_level=isolation_level,
-#     )
-#     # event.listen(engine, "connect", set_search_path)
-#     event.listen(engine, "connect", partial(set_search_path, {'schema': schema}))
-#     return engine.connect()
-
-
-# todo: make 'isolation_level' the final param, since we never override it. this would it so we dont' have to pass the
-#  other params as named params.
-def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Connection:
-    """Get DB connection object.
-
-    :param local: If True, connection is on local instead of production database.
-    """
-    engine = create_engine(get_pg_connect_url(local), isolation_level=isolation_level)
+# Connection pooling
+# One engine, and so one pool of connections, per process and (local, schema, isolation_level). search_path is set once
+# per pooled connection, when it's opened, so checkouts after the first cost no round trips beyond a pre-ping. Sizes are
+# per process: under gunicorn, each worker has its own pool.
+# Metrics: db_pool_checkout_seconds is the total checkout latency: waiting for a free connection, but also the pre-ping
+# and, when the pool grows or replaces a connection, opening a new one (also counted, in db_connections_opened). So it's
+# an upper bound on the time spent waiting on the pool; db_pool_timeouts counts checkouts that gave up waiting.
+DB_POOL_SIZE = int(os.getenv('TERMHUB_DB_POOL_SIZE', 5))
+DB_POOL_MAX_OVERFLOW = int(os.getenv('TERMHUB_DB_POOL_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT_SECONDS = int(os.getenv('TERMHUB_DB_POOL_TIMEOUT_SECONDS', 30))
+DB_POOL_RECYCLE_SECONDS = int(os.getenv('TERMHUB_DB_POOL_RECYCLE_SECONDS', 30 * 60))
+_engines: Dict[Tuple[bool, str, str], Engine] = {}
+_async_engines: Dict[Tuple[bool, str], Tuple[asyncio.AbstractEventLoop, AsyncEngine]] = {}
+_engines_lock = [threading.Lock()]
+
+
+def _create_pooled_engine(isolation_level: str, schema: str, local: bool) -> Engine:
+    """Create an engine with a QueuePool, whose connections get search_path set to schema when opened"""
+    engine = create_engine(
+        get_pg_connect_url(local), isolation_level=isolation_level, poolclass=QueuePool, pool_size=DB_POOL_SIZE,
+        max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT_SECONDS, pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True)  # the server drops idle connections; replace those rather than fail the query
 
     # noinspection PyUnusedLocal
     @event.listens_for(engine, "connect", insert=True)
@@ -300,9 +407,10 @@ def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=
         https://docs.sqlalchemy.org/en/14/dialects/postgresql.html#setting-alternate-search-paths-on-connect
         :param connection_record: Part of the example but we're not using yet.
 
-        Ideally, we'd want to be able to call this whenever we want. But cannot be called outside of context of
-        initializing a connection.
+        Runs once per pooled connection, not per checkout. Connections are kept by an engine for a single schema, so
+        search_path never needs changing afterwards.
         """
+        incr('db_connections_opened')
         if not schema:
             return
         existing_autocommit = dbapi_connection.autocommit
@@ -312,7 +420,136 @@ def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=
         cursor.close()
         dbapi_connection.autocommit = existing_autocommit
 
-    return engine.connect()
+    return engine
+
+
+def get_engine(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Engine:
+    """Get this process's engine for the given settings. Created on first use."""
+    key = (local, schema or '', isolation_level)
+    engine = _engines.get(key)
+    if engine is None:
+        with _engines_lock[0]:
+            engine = _engines.get(key)
+            if engine is None:
+                engine = _engines[key] = _create_pooled_engine(isolation_level, schema, local)
+    return engine
+
+
+def _create_async_pooled_engine(schema: str, local: bool) -> AsyncEngine:
+    """Create an asyncpg engine, pooled like those of _create_pooled_engine(), in autocommit mode"""
+    engine = create_async_engine(
+        get_pg_connect_url(local, driver='asyncpg'), isolation_level='AUTOCOMMIT', pool_size=DB_POOL_SIZE,
+        max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT_SECONDS, pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True, connect_args={'server_settings': {'search_path': schema}} if schema else {})
+
+    # noinspection PyUnusedLocal
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_json_codecs(dbapi_connection, connection_record):
+        """Decode json / jsonb columns to Python objects, as psycopg2 does. asyncpg would return them as strings."""
+        incr('db_connections_opened')
+        dbapi_connection.run_async(_set_json_codecs)
+
+    return engine
+
+
+async def _set_json_codecs(asyncpg_connection):
+    """Set json / jsonb codecs on an asyncpg connection"""
+    for type_name in ('json', 'jsonb'):
+        await asyncpg_connection.set_type_codec(
+            type_name, encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+def get_async_engine(schema: str = SCHEMA, local=False) -> AsyncEngine:
+    """Get this process's async engine for the given settings. Created on first use, and again if called from another
+    event loop than before, e.g. in a later asyncio.run(): asyncpg connections can't move between loops."""
+    key = (local, schema or '')
+    loop = asyncio.get_running_loop()
+    loop_engine = _async_engines.get(key)
+    if loop_engine is None or loop_engine[0] is not loop:
+        with _engines_lock[0]:
+            loop_engine = _async_engines.get(key)
+            if loop_engine is None or loop_engine[0] is not loop:
+                if loop_engine is not None:
+                    loop_engine[1].sync_engine.dispose(close=False)
+                loop_engine = _async_engines[key] = (loop, _create_async_pooled_engine(schema, local))
+    return loop_engine[1]
+
+
+def db_pool_stats() -> Dict[str, Dict[str, Any]]:
+    """Usage of each engine's pool, for /metrics
+
+    :returns Map of 'local|remote:schema:isolation_level' (or 'async:local|remote:schema') to connections checked out /
+    idle / in overflow, and utilization: the share of the most connections the pool allows that are checked out"""
+    pools: Dict[str, QueuePool] = {
+        f"{'local' if local else 'remote'}:{schema}:{isolation_level}": engine.pool
+        for (local, schema, isolation_level), engine in list(_engines.items())}
+    pools.update({f"async:{'local' if local else 'remote'}:{schema}": engine.pool
+                  for (local, schema), (_loop, engine) in list(_async_engines.items())})
+    stats: Dict[str, Dict[str, Any]] = {}
+    for name, pool in pools.items():
+        stats[name] = {
+            'checked_out': pool.checkedout(), 'checked_in': pool.checkedin(), 'overflow': max(pool.overflow(), 0),
+            'utilization': pool.checkedout() / (pool.size() + DB_POOL_MAX_OVERFLOW)}
+    return stats
+
+
+register_collector('db_pools', db_pool_stats)
+
+
+def _reset_engines_after_fork():
+    """Forked children, e.g. gunicorn workers, must not share their parent's pooled connections: drop them, without
+    closing them, which would close the parent's too"""
+    _engines_lock[0] = threading.Lock()
+    for engine in _engines.values():
+        engine.dispose(close=False)
+    for _loop, async_engine in _async_engines.values():
+        async_engine.sync_engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_engines_after_fork)
+
+
+# todo: make 'isolation_level' the final param, since we never override it. this would it so we dont' have to pass the
+#  other params as named params.
+def get_db_connection(isolation_level='AUTOCOMMIT', schema: str = SCHEMA, local=False) -> Connection:
+    """Get DB connection object, checked out from this process's pool for the given settings. Closing it, e.g. at the
+    end of a `with` block, returns it to the pool.
+
+    :param local: If True, connection is on local instead of production database.
+    """
+    engine: Engine = get_engine(isolation_level, schema, local)
+    t0 = time.monotonic()
+    try:
+        con = engine.connect()
+    except PoolTimeoutError:
+        incr('db_pool_timeouts')
+        raise
+    incr('db_pool_checkouts')
+    incr('db_pool_checkout_seconds', time.monotonic() - t0)
+    return con
+
+
+@asynccontextmanager
+async def get_async_db_connection(schema: str = SCHEMA, local=False) -> AsyncIterator[AsyncConnection]:
+    """Get an async DB connection, for async routes: queries on it don't block the event loop. Use as
+    `async with get_async_db_connection() as con:`. Connections are in autocommit mode, and returned to the pool on
+    exit. They belong to the event loop that opened them, so this is for the server's loop, not for asyncio.run().
+
+    :param local: If True, connection is on local instead of production database.
+    """
+    engine: AsyncEngine = get_async_engine(schema, local)
+    t0 = time.monotonic()
+    try:
+        con: AsyncConnection = await engine.connect()
+    except PoolTimeoutError:
+        incr('db_pool_timeouts')
+        raise
+    incr('db_pool_checkouts')
+    incr('db_pool_checkout_seconds', time.monotonic() - t0)
+    try:
+        yield con
+    finally:
+        await con.close()
 
 
 def chunk_list(input_list: List, chunk_size) -> List[List]:
@@ -353,6 +590,15 @@ def check_db_status_var(key: str,  local=False):
         return results[0] if results else None
 
 
+def check_db_status_vars(keys: List[str], local=False) -> Dict[str, Optional[str]]:
+    """Check the values of several variables in the `manage` table, in one query"""
+    with get_db_connection(schema='', local=local) as con:
+        results: List[RowMapping] = sql_query(
+            con, "SELECT key, value FROM public.manage WHERE key = ANY(:keys);", {'keys': keys})
+    values: Dict[str, str] = {r['key']: r['value'] for r in results}
+    return {k: values.get(k) for k in keys}
+
+
 def delete_db_status_var(key: str, local=False):
     """Delete information from the `manage` table """
     with get_db_connection(schema='', local=local) as con2:
@@ -563,12 +809,63 @@ def sql_query(
             f'Got an error [{err}] executing the following statement:\n{query}, {json.dumps(params, indent=2)}')
 
 
+@contextmanager
+def dbapi_cursor(con: Connection) -> Iterator:
+    """Raw DBAPI (psycopg2) cursor of con, for what SQLAlchemy can't do, e.g. COPY via copy_expert(). Closed on exit."""
+    cursor = con.connection.dbapi_connection.cursor()
+    try:
+        yield cursor
+    finally:
+        cursor.close()
+
+
+def copy_expert(cursor, statement: str, file) -> int:
+    """Run a COPY statement on a cursor from dbapi_cursor(), streaming from or to file
+
+    Errors are raised as by sql_query(): a RuntimeError with the statement.
+    :returns Number of rows copied"""
+    try:
+        cursor.copy_expert(statement, file)
+    except Psycopg2Error as err:
+        raise RuntimeError(f'Got an error [{err}] executing the following statement:\n{statement}')
+    return cursor.rowcount
+
+
 def sql_query_single_col(*argv) -> List:
     """Run SQL query on single column"""
     results: List = sql_query(*argv, return_with_keys=False)
     return [r[0] for r in results]
 
 
+async def async_run_sql(con: AsyncConnection, query: str, params: Dict[str, Any] = {}) -> CursorResult:
+    """Run a sql command on an async connection"""
+    query = text(query) if not isinstance(query, TextClause) else query
+    return await con.execute(query, params) if params else await con.execute(query)
+
+
+async def async_sql_query(
+    con: AsyncConnection, query: Union[text, str], params: Dict = {}, debug: bool = DEBUG, return_with_keys=True
+) -> Union[List[RowMapping], List[List[Any]]]:
+    """Async counterpart of sql_query(): while the query runs, the event loop serves other requests"""
+    try:
+        q: CursorResult = await async_run_sql(con, query, params)
+        if debug:
+            print(f'{query}\n{json.dumps(params, indent=2)}')
+        if return_with_keys:
+            # noinspection PyTypeChecker
+            return q.mappings().all()
+        return [list(x) for x in q.fetchall()]
+    except (ProgrammingError, OperationalError) as err:
+        raise RuntimeError(
+            f'Got an error [{err}] executing the following statement:\n{query}, {json.dumps(params, indent=2)}')
+
+
+async def async_sql_query_single_col(*argv) -> List:
+    """Run SQL query on single column, on an async connection"""
+    results: List = await async_sql_query(*argv, return_with_keys=False)
+    return [r[0] for r in results]
+
+
 # todo: consider adding 'schema' param
 def delete_obj_by_composite_key(con, table: str, key_ids: Dict[str, Union[str, int]]):
     """Delete object by ID"""
@@ -649,53 +946,95 @@ def fix_jagged_rows(rows: List[Dict]) -> List[Dict]:
     return [{field: row.get(field, None) for field in fields} for row in rows]
 
 
-def update_from_dicts(con: Connection, table: str, rows: List[Dict]):
-    """Update rows in table from a list of dictionaries"""
-    pk: str = pkey(table)
+BULK_WRITE_CHUNK_ROWS = 10000
+
+
+def _copy_csv_field(value: Any) -> str:
+    """A value as a CSV field for COPY: empty if None, so NULL; else quoted, so empty strings stay empty strings"""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def rows_to_copy_csv(rows: List[Dict], columns: List[str]) -> str:
+    """Rows as CSV, without header, for `COPY ... FROM STDIN WITH (FORMAT csv)`"""
+    return ''.join(','.join(_copy_csv_field(row.get(col)) for col in columns) + '\n' for row in rows)
+
+
+def _key_match(pk: Union[str, List[str]], left: str, right: str) -> str:
+    """SQL condition that rows aliased `left` and `right` have the same primary key, which may be composite"""
+    keys: List[str] = [pk] if isinstance(pk, str) else pk
+    return ' AND '.join(f'{left}.{quote_identifier(k)} = {right}.{quote_identifier(k)}' for k in keys)
+
+
+def bulk_write_from_dicts(
+    con: Connection, table: str, rows: List[Dict], statement: str, chunk_rows=BULK_WRITE_CHUNK_ROWS
+) -> int:
+    """Write rows to table with set-based statements: each chunk of rows is COPYed into a temporary staging table,
+    which has table's column types, and `statement` applies it to table.
+
+    This binds no parameters, so the number of rows isn't limited by Postgres' 65535 bind parameter limit, and each
+    chunk's statement is the same, whatever the rows.
+
+    :param statement: SQL with `{staging}` and `{columns}` placeholders: the staging table's name and its quoted columns
+    :returns Number of rows written"""
     rows = fix_jagged_rows(rows)
-    # todo: fully use parameterized queries to prevent SQL injection
-    key_vals: Dict[str, Any] = key_vals_for_sqlalchemy_query(rows)
-    values: str = value_str_for_sqlalchemy_query(rows)
-    fields: str = ', '.join([f'"{x}"' for x in rows[0].keys()])
-    field_set_str: str= ', '.join([f'"{x}" = v.{x}' for x in [x for x in rows[0].keys() if x != pk]])
+    columns: List[str] = list(rows[0].keys())
+    columns_str = ', '.join(quote_identifier(col) for col in columns)
+    staging = 'bulk_staging_' + re.sub(r'\W', '_', table)
+    run_sql(con, f'DROP TABLE IF EXISTS pg_temp.{staging}')
+    run_sql(con, f'CREATE TEMP TABLE {staging} AS SELECT {columns_str} FROM {table} WITH NO DATA')
+    statement = statement.format(staging=staging, columns=columns_str)
+    n = 0
+    try:
+        with dbapi_cursor(con) as cursor:
+            for chunk in chunk_list(rows, chunk_rows):
+                copy_expert(cursor, f'COPY {staging} ({columns_str}) FROM STDIN WITH (FORMAT csv)',
+                            io.StringIO(rows_to_copy_csv(chunk, columns)))
+                n += run_sql(con, statement).rowcount
+                run_sql(con, f'TRUNCATE {staging}')
+    finally:
+        run_sql(con, f'DROP TABLE IF EXISTS pg_temp.{staging}')
+    return n
+
+
+def update_from_dicts(con: Connection, table: str, rows: List[Dict], chunk_rows=BULK_WRITE_CHUNK_ROWS) -> int:
+    """Update rows in table from a list of dictionaries, matched on the table's primary key, which may be composite
+
+    :returns Number of rows updated"""
+    pk: Union[str, List[str]] = pkey(table)
+    if not pk:
+        raise ValueError(f'Cannot update rows of {table}: it has no primary key')
+    keys: List[str] = [pk] if isinstance(pk, str) else pk
+    fields: List[str] = sorted(set(k for row in rows for k in row.keys()) - set(keys))
+    if not fields:
+        return 0
+    field_set_str: str = ', '.join([f'{quote_identifier(x)} = v.{quote_identifier(x)}' for x in fields])
     statement = f"""
-        UPDATE {table}
+        UPDATE {table} AS t
         SET {field_set_str}
-        FROM (VALUES
-            {values}
-        ) AS v({fields})
-        WHERE {table}.{pk} = v.{pk};"""
-    run_sql_update(con, statement, key_vals, handle_none_as_null_on_table=table)
-
-
-def key_vals_for_sqlalchemy_query(rows: List[Dict]) -> Dict[str, Any]:
-    """Get key value pairs  for a non-idempotent SQL query."""
-    return {f'{k}{i}': v for i, d in enumerate(rows) for k, v in d.items()}
-
-
-def value_str_for_sqlalchemy_query(rows: List[Dict]) -> str:
-    """Get a string of values for a non-idempotent SQL query."""
-    return  ', '.join([f"({', '.join([':' + str(k) + str(i) for k in d.keys()])})" for i, d in enumerate(rows)])
-
-def insert_from_dicts(con: Connection, table: str, rows: List[Dict], skip_if_already_exists=True):
-    """Insert rows into table from a list of dictionaries"""
-    pk: str = pkey(table)
-    if skip_if_already_exists:
-        if pk and isinstance(pk, str):  # normal, single primary key
-            already_in_db: List[Dict] = get_objs_by_id(con, table, pk, [row[pk] for row in rows])
-            already_in_db_ids = set([row[pk] for row in already_in_db])
-            rows = [row for row in rows if row[pk] not in already_in_db_ids]
-        elif pk and isinstance(pk, list):  # composite key
-            already_in_db: List[Dict] = get_objs_by_composite_key(con, table, pk, rows)
-            already_in_db_ids = [[row[pk_n] for pk_n in pk] for row in already_in_db]
-            rows = [row for row in rows if [row[pk_n] for pk_n in pk] not in already_in_db_ids]
-    if rows:
-        rows = fix_jagged_rows(rows)
-        # todo: fully use parameterized queries to prevent SQL injection
-        key_vals: Dict[str, Any] = key_vals_for_sqlalchemy_query(rows)
-        values: str = value_str_for_sqlalchemy_query(rows)
-        statement = f"""INSERT INTO {table} ({', '.join([f'"{x}"' for x in rows[0].keys()])}) VALUES {values}"""
-        run_sql(con, statement, key_vals)
+        FROM {{staging}} AS v
+        WHERE {_key_match(pk, 't', 'v')};"""
+    return bulk_write_from_dicts(con, table, rows, statement, chunk_rows)
+
+
+def insert_from_dicts(
+    con: Connection, table: str, rows: List[Dict], skip_if_already_exists=True, chunk_rows=BULK_WRITE_CHUNK_ROWS
+) -> int:
+    """Insert rows into table from a list of dictionaries
+
+    :param skip_if_already_exists: Skip rows whose primary key, which may be composite, is already in the table. Works
+    whether or not the table has a primary key constraint.
+    :returns Number of rows inserted"""
+    if not rows:
+        return 0
+    pk: Union[str, List[str]] = pkey(table)
+    statement = f'INSERT INTO {table} ({{columns}}) SELECT {{columns}} FROM {{staging}} AS v'
+    if skip_if_already_exists and pk:
+        statement += f' WHERE NOT EXISTS (SELECT 1 FROM {table} AS t WHERE {_key_match(pk, "t", "v")})'
+    return bulk_write_from_dicts(con, table, rows, statement, chunk_rows)
 
 
 def insert_from_dict(con: Connection, table: str, d: Union[Dict, List[Dict]], skip_if_already_exists=True):
@@ -712,10 +1051,19 @@ def insert_from_dict(con: Connection, table: str, d: Union[Dict, List[Dict]], sk
                 already_in_db: List[RowMapping] = get_obj_by_composite_key(con, table, pk, d)
             if already_in_db:
                 return
-    query = f"""
+    run_sql(con, insert_from_dict_query(table, d), d)
+
+
+def insert_from_dict_query(table: str, d: Dict) -> str:
+    """INSERT statement for a row from a dictionary, with its values as bind params"""
+    return f"""
     INSERT INTO {table} ({', '.join([f'"{x}"' for x in d.keys()])})
     VALUES ({', '.join([':' + str(k) for k in d.keys()])})"""
-    run_sql(con, query, d)
+
+
+async def async_insert_from_dict(con: AsyncConnection, table: str, d: Dict):
+    """Async counterpart of insert_from_dict(), for tables without a primary key to skip existing rows by"""
+    await async_run_sql(con, insert_from_dict_query(table, d), d)
 
 
 def sql_count(con: Connection, table: str) -> int:
@@ -734,6 +1082,11 @@ def sql_in(lst: Union[List, Set], quote_items=False) -> str:
         s: str = ', '.join([str(x) for x in lst]) or 'NULL'
     return f' IN ({s}) '
 
+def quote_identifier(name: str) -> str:
+    """Quote a column / table name, so it's safe to put in a query even if user-supplied"""
+    return '"' + name.replace('"', '""') + '"'
+
+
 def sql_in_safe(lst: List) -> (str, dict):
     """Safe version of SQL 'in' statement."""
     bindparams = [":id{}".format(i) for i in range(len(lst))]
@@ -798,28 +1151,157 @@ def list_views(con: Connection = None, schema: str = None, filter_temp_refresh_v
     return list_schema_objects(con, schema, False, True, filter_temp_refresh_views, True, True, False)
 
 
+LOAD_CSV_CHUNK_BYTES = 64 * 1024 * 1024
+LOAD_CSV_WORKERS = int(os.getenv('TERMHUB_LOAD_CSV_WORKERS', 4))
+LOAD_CSV_TYPE_CHUNK_ROWS = 100000
+# information_schema data_types that can't be used as-is in CREATE TABLE; such columns' types are inferred instead
+PG_UNUSABLE_DATA_TYPES = ('ARRAY', 'USER-DEFINED')
+PANDAS_TO_PG_DATA_TYPES = {'int64': 'bigint', 'float64': 'double precision', 'bool': 'boolean'}
+
+
+def csv_record_end(data: bytes, last=True) -> int:
+    """Offset just past the last (or first) whole CSV record in data, which starts at a record boundary; 0 if none.
+
+    A newline ends a record unless it is inside a quoted field, i.e. an odd number of quotes precede it. (Quotes within
+    quoted fields are doubled, so don't change that parity.)"""
+    pos = data.rfind(b'\n') if last else data.find(b'\n')
+    while pos >= 0:
+        if data.count(b'"', 0, pos) % 2 == 0:
+            return pos + 1
+        pos = data.rfind(b'\n', 0, pos) if last else data.find(b'\n', pos + 1)
+    return 0
+
+
+def iter_csv_chunks(f: BinaryIO, chunk_bytes=LOAD_CSV_CHUNK_BYTES, limit: int = None) -> Iterator[bytes]:
+    """Read f, from its current position at a record boundary, as chunks of whole records of about chunk_bytes
+
+    :param limit: Read no more than this many bytes"""
+    carry = b''
+    remaining = limit if limit is not None else float('inf')
+    while True:
+        block = f.read(int(min(chunk_bytes, remaining)))
+        remaining -= len(block)
+        if not block:
+            if carry:
+                yield carry
+            return
+        data = carry + block
+        end = csv_record_end(data)
+        if end:
+            yield data[:end]
+        carry = data[end:]
+
+
+def count_csv_records(chunk: bytes) -> int:
+    """Number of records in a chunk of whole CSV records"""
+    if not chunk:
+        return 0
+    last_unterminated = int(not chunk.endswith(b'\n'))
+    if b'"' not in chunk:
+        return chunk.count(b'\n') + last_unterminated
+    n, quotes = 0, 0
+    for line in chunk.split(b'\n')[:-1]:
+        quotes += line.count(b'"')
+        n += quotes % 2 == 0
+    return n + last_unterminated
+
+
+def skip_csv_records(f: BinaryIO, n: int) -> int:
+    """Advance f, from a record boundary, past n records, or to the end of the file if it has fewer.
+
+    :returns Number of records skipped"""
+    skipped, quotes = 0, 0
+    while skipped < n:
+        line = f.readline()
+        if not line:
+            break
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            skipped += 1
+    return skipped
+
+
+def _combine_pandas_dtypes(dtypes: Set[str]) -> str:
+    """The dtype pandas would give a column, had it read it whole rather than in chunks with these dtypes"""
+    if len(dtypes) == 1:
+        return next(iter(dtypes))
+    return 'float64' if dtypes <= {'int64', 'float64'} else 'object'
+
+
+def csv_column_types(
+    con: Connection, path: str, columns: List[str], tables: List[str], schema: str = SCHEMA,
+    chunk_rows=LOAD_CSV_TYPE_CHUNK_ROWS
+) -> Dict[str, str]:
+    """Postgres data types for a CSV's columns: those of the first of `tables` having the column, else inferred from the
+    whole CSV, as pandas did when it loaded it whole before. It's read in chunks of `chunk_rows`, so memory stays flat.
+    """
+    types: Dict[str, str] = {}
+    for table in tables:
+        for col, data_type in get_field_data_types(table, schema, con).items():
+            if data_type not in PG_UNUSABLE_DATA_TYPES:
+                types.setdefault(col, data_type)
+    missing: List[str] = [c for c in columns if c not in types]
+    if missing:
+        dtypes: Dict[str, Set[str]] = {c: set() for c in missing}
+        for chunk in pd.read_csv(path, usecols=missing, chunksize=chunk_rows):
+            for c in missing:
+                dtypes[c].add(str(chunk[c].dtype))
+        types.update({
+            c: PANDAS_TO_PG_DATA_TYPES.get(_combine_pandas_dtypes(dtypes[c]), 'text') if dtypes[c] else 'text'
+            for c in missing})
+    return {c: types[c] for c in columns}
+
+
+@contextmanager
+def chunk_transaction(con: Connection, cursor):
+    """Transaction around statements run on cursor, a DBAPI cursor of con, e.g. one chunk of load_csv()
+
+    On an AUTOCOMMIT connection, the usual case, SQLAlchemy transactions don't reach the DB, so it's begun and committed
+    on the cursor. Otherwise, it's a SQLAlchemy transaction: a nested one (a savepoint) if con is in one already, so
+    that the caller's transaction is neither committed nor rolled back by this."""
+    if con.connection.dbapi_connection.autocommit:
+        cursor.execute('BEGIN')
+        try:
+            yield
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+    else:
+        with con.begin_nested() if con.in_transaction() else con.begin():
+            yield
+
+
 def load_csv(
     con: Connection, table: str, table_type: str = ['dataset', 'object'][0], replace_rule='replace if diff row count',
-    schema: str = SCHEMA, is_test_table=False, local=False, optional_suffix='', path_override: Union[Path, str] = None
+    schema: str = SCHEMA, is_test_table=False, local=False, optional_suffix='', path_override: Union[Path, str] = None,
+    chunk_bytes=LOAD_CSV_CHUNK_BYTES
 ):
     """Load CSV into table
     :param replace_rule:
         - 'replace if diff row count'
         - 'do not replace'
-        - 'finish aborted upload'   # useful if load_csv crashes before uploading the whole dataframe
+        - 'finish aborted upload'   # useful if load_csv crashes before uploading the whole file
 
       First, will replace table (that is, truncate and load records; will fail if table cols have changed, i think
      'do not replace'  will create new table or load table if table exists but is empty
     :param optional_suffix: Useful for when remaking tables when database is live. For example, you can upload a new
     'concept' table using the suffix '_new', then after 'concept_new' is successfully loaded, you can delete the old
     table and rename this table as just 'concept'.
+    :param chunk_bytes: Approximate size of the chunks the file is streamed in. Each is committed with the byte offset
+    it reached, in `public.manage`, so 'finish aborted upload' can resume from there.
 
-    - Uses: https://pandas.pydata.org/docs/reference/api/pandas.DataFrame.to_sql.html
+    The file is streamed straight into `COPY ... FROM STDIN`, so memory use doesn't grow with its size. Column types
+    are those the table (or, for a suffixed table, the live one) already has, else inferred from the whole file. As
+    with any CSV COPY, only unquoted empty fields become NULL.
+
+    :returns Number of rows loaded, or None if the table was left as it was.
     """
     table_name_no_suffix = table
     table = table + optional_suffix
     # Edge cases
     existing_rows = 0
+    table_exists = True
     try:
         r = con.execute(text(f'select count(*) from {schema}.{table}'))
         existing_rows = r.one()[0]
@@ -827,6 +1309,7 @@ def load_csv(
         # noinspection PyUnresolvedReferences
         if isinstance(err.orig, UndefinedTable):
             print(f'INFO: {schema}.{table} does not not exist; will create it')
+            table_exists = False
         else:
             raise err
 
@@ -840,36 +1323,141 @@ def load_csv(
     if not os.path.isfile(path):
         print(f'INFO: {path} does not exist; skipping')
         return
-    df = pd.read_csv(path)
-
+    path = str(path)
+    file_stat = os.stat(path)
+    with open(path, 'rb') as f:
+        head: bytes = f.read(min(chunk_bytes, file_stat.st_size))
+    header_end: int = csv_record_end(head, last=False) or len(head)
+    columns: List[str] = next(csv.reader([head[:header_end].decode('utf-8-sig').rstrip('\r\n')]))
+    end_offset = file_stat.st_size
     # todo: this could be replaced by using path_override and saving some static files with 1 line
     if is_test_table and not path_override:
-        df = df.head(1)
+        end_offset = header_end + (csv_record_end(head[header_end:], last=False) or len(head) - header_end)
+
+    print(f'INFO: loading {schema}.{table} ({commify(end_offset)} bytes) into {CONFIG["server"]}:{DB}')
+    if replace_rule == 'replace if diff row count' and existing_rows:
+        with open(path, 'rb') as f:
+            f.seek(header_end)
+            chunks = iter_csv_chunks(f, chunk_bytes, end_offset - header_end)
+            n_records = sum(count_csv_records(chunk) for chunk in chunks)
+        if existing_rows == n_records:
+            print(f'INFO: {schema}.{table} exists with same number of rows {existing_rows}; leaving it')
+            return
 
-    print(f'INFO: loading {schema}.{table} ({len(df)} rows) into {CONFIG["server"]}:{DB}')
-    if replace_rule == 'replace if diff row count' and existing_rows == len(df):
-        print(f'INFO: {schema}.{table} exists with same number of rows {existing_rows}; leaving it')
-        return
-    if replace_rule == 'finish aborted upload' and existing_rows < len(df):
-        print(f'INFO: {schema}.{table} exists with {commify(existing_rows)} rows; uploading remaining {commify(len(df)-existing_rows)} rows')
-        df = df.iloc[existing_rows: len(df)]
+    progress_key = f'load_csv_progress_{schema}.{table}'
+    start_offset, loaded_rows = header_end, 0
+    if replace_rule == 'finish aborted upload' and existing_rows:
+        progress: Dict[str, Any] = json.loads(check_db_status_var(progress_key, local) or '{}')
+        if progress.get('file') == [path, file_stat.st_size, file_stat.st_mtime] \
+                and progress.get('rows') == existing_rows:
+            start_offset, loaded_rows = progress['offset'], existing_rows
+        else:  # no usable marker, e.g. a table loaded by the old loader: skip as many records as it has
+            with open(path, 'rb') as f:
+                f.seek(header_end)
+                loaded_rows = skip_csv_records(f, existing_rows)
+                start_offset = min(f.tell(), end_offset)
+    if loaded_rows and loaded_rows == existing_rows and start_offset < end_offset:
+        print(f'INFO: {schema}.{table} exists with {commify(existing_rows)} rows; uploading the rest, from byte '
+              f'{commify(start_offset)} of {commify(end_offset)}')
     else:
+        start_offset, loaded_rows = header_end, 0
+        tables = ([table] if table_exists else []) + ([table_name_no_suffix] if optional_suffix else [])
+        types: Dict[str, str] = csv_column_types(con, path, columns, tables, schema)
         con.execute(text(f'DROP TABLE IF EXISTS {schema}.{table} CASCADE'))
+        con.execute(text(f'CREATE TABLE {schema}.{table} (' +
+                         ', '.join(f'{quote_identifier(c)} {types[c]}' for c in columns) + ')'))
 
     # - load
-    df.to_sql(table, con, **{'if_exists': 'append', 'index': False, 'schema': schema, 'chunksize': 1000})
+    copy_sql = f'COPY {schema}.{table} ({", ".join(quote_identifier(c) for c in columns)}) ' \
+               f"FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')"
+    offset = start_offset
+    with open(path, 'rb') as f, dbapi_cursor(con) as cursor:
+        f.seek(start_offset)
+        for chunk in iter_csv_chunks(f, chunk_bytes, end_offset - start_offset):
+            # The chunk and how far it got are committed together, so the marker never runs ahead of the table
+            with chunk_transaction(con, cursor):
+                copied: int = copy_expert(cursor, copy_sql, io.BytesIO(chunk))
+                cursor.execute('DELETE FROM public.manage WHERE key = %s', (progress_key,))
+                cursor.execute('INSERT INTO public.manage (key, value) VALUES (%s, %s)', (
+                    progress_key, json.dumps({
+                        'file': [path, file_stat.st_size, file_stat.st_mtime], 'offset': offset + len(chunk),
+                        'rows': loaded_rows + copied})))
+            loaded_rows += copied
+            offset += len(chunk)
+            print(f'INFO: {schema}.{table}: {commify(loaded_rows)} rows, {offset * 100 // max(end_offset, 1)}%')
+    delete_db_status_var(progress_key, local)
     # - update status
     if not is_test_table:
         update_db_status_var(f'last_updated_{table_name_no_suffix}', str(current_datetime()), local)
-
-
-def get_field_data_types(table: str, schema=SCHEMA) -> Dict[str, str]:
+    return loaded_rows
+
+
+def load_csvs(
+    jobs: List[Dict[str, Any]], workers: int = LOAD_CSV_WORKERS, schema: str = SCHEMA, local=False,
+    con: Connection = None
+) -> Dict[str, Dict[str, Any]]:
+    """Load several CSVs into their tables, up to `workers` at a time, each on its own connection
+
+    The tables must be independent of each other, e.g. not have foreign keys between them.
+
+    :param jobs: load_csv() kwargs (other than `con`, `schema` and `local`) for each table
+    :param workers: Tables loaded at once. At most the DB connection pool's size + overflow, less the connection the
+    caller holds, if `con` is passed, so that workers don't wait on the pool. If 1, tables are loaded one after another,
+    on `con` if passed.
+    :returns Map of table to its progress: status ('pending', 'loading', 'done', 'skipped' or 'failed'), rows loaded,
+    and seconds taken. Raises the first error, if any, once the tables being loaded when it happened are done."""
+    pool_connections = DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW - (1 if con is not None else 0)
+    workers = max(1, min(workers, len(jobs), pool_connections))
+    progress: Dict[str, Dict[str, Any]] = {
+        job['table']: {'status': 'pending', 'rows': None, 'seconds': None} for job in jobs}
+
+    def load(job: Dict[str, Any]):
+        """Load one table, recording its progress"""
+        table_progress = progress[job['table']]
+        table_progress['status'] = 'loading'
+        t0 = time.time()
+        try:
+            if workers == 1 and con:
+                rows = load_csv(con, schema=schema, local=local, **job)
+            else:
+                with get_db_connection(schema=schema, local=local) as worker_con:
+                    rows = load_csv(worker_con, schema=schema, local=local, **job)
+        except Exception as err:
+            table_progress['status'] = 'failed'
+            raise err
+        finally:
+            table_progress['seconds'] = round(time.time() - t0, 1)
+        table_progress.update({'status': 'skipped' if rows is None else 'done', 'rows': rows})
+        n_finished = len([x for x in progress.values() if x['status'] in ('done', 'skipped')])
+        print(f'INFO: {schema}.{job["table"]} {table_progress["status"]} in {table_progress["seconds"]} seconds '
+              f'({n_finished} of {len(jobs)} tables)')
+
+    if workers == 1:
+        for job in jobs:
+            load(job)
+        return progress
+    print(f'INFO: loading {len(jobs)} tables into {schema}, {workers} at a time')
+    with ThreadPoolExecutor(workers, thread_name_prefix='load_csv') as executor:
+        futures = [executor.submit(load, job) for job in jobs]
+        for future in as_completed(futures):
+            if future.exception():
+                for f in futures:
+                    f.cancel()  # those not started yet; ones being loaded are left to finish
+    errors = [f.exception() for f in futures if not f.cancelled() and f.exception()]
+    if errors:
+        raise errors[0]
+    return progress
+
+
+def get_field_data_types(table: str, schema=SCHEMA, con: Connection = None) -> Dict[str, str]:
     """Get data types for each field in the table"""
-    with get_db_connection(schema='') as con:
-        field_data_types: List[Dict[str, str]] = [dict(x) for x in sql_query(con, f"""
-            SELECT column_name,  data_type FROM information_schema.columns 
-            WHERE table_schema = '{schema}' AND table_name = '{table}';""")]
-        field_data_types: Dict[str, str] = {x['column_name']: x['data_type'] for x in field_data_types}
+    conn = con if con else get_db_connection(schema='')
+    field_data_types: List[Dict[str, str]] = [dict(x) for x in sql_query(conn, f"""
+        SELECT column_name,  data_type FROM information_schema.columns 
+        WHERE table_schema = '{schema}' AND table_name = '{table}';""")]
+    field_data_types: Dict[str, str] = {x['column_name']: x['data_type'] for x in field_data_types}
+    if not con:
+        conn.close()
     return field_data_types
 
 
@@ -908,6 +1496,16 @@ def order_modules_by_ddl_order(module_names: Union[List[str], str]) -> List[str]
     return sorted(module_names, key=lambda x: module_to_number[x])
 
 
+def sql_template_statements(path: str, **params) -> List[str]:
+    """Render a SQL Jinja2 template, and split it into statements. Statements should be separated by an empty line (two
+    line breaks)."""
+    with open(path, 'r') as file:
+        template_str = file.read()
+    sql_text = Template(template_str).render(**params)
+    without_comments = re.sub(r'^\s*--.*\n*', '', sql_text, flags=re.MULTILINE)
+    return [x + ';' for x in without_comments.split(';\n\n')]
+
+
 def get_ddl_statements(
     schema: str = SCHEMA, modules: Union[List[str], str] = None, table_suffix='', return_type=['flat', 'nested'][1],
     unique_index_names=True,
@@ -932,14 +1530,9 @@ def get_ddl_statements(
     statements: List[str] = []
     statements_by_module: Dict[str, List[str]] = {}
     for i, path in enumerate(paths):
-        with open(path, 'r') as file:
-            template_str = file.read()
         module = os.path.basename(path).split('-')[2].split('.')[0]
-        ddl_text = Template(template_str).render(
-            schema=schema + '.', optional_suffix=table_suffix, optional_index_suffix=index_suffix)
-        without_comments = re.sub(r'^\s*--.*\n*', '', ddl_text, flags=re.MULTILINE)
-        # Each DDL file should have 1 or more statements separated by an empty line (two line breaks).
-        module_statements = [x + ';' for x in without_comments.split(';\n\n')]
+        module_statements: List[str] = sql_template_statements(
+            path, schema=schema + '.', optional_suffix=table_suffix, optional_index_suffix=index_suffix)
         if return_type == 'flat':
             statements.extend(module_statements)
         elif return_type == 'nested':
@@ -0,0 +1 @@
+"""Concept graph engine: compact in-memory representation of the OMOP concept hierarchy"""
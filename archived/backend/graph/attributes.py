@@ -0,0 +1,74 @@
+"""Concept attributes as arrays aligned to the graph's node index, for vectorized filtering
+
+Hiding concepts by vocabulary or standard status used to need each concept's `vocabulary_id` and `standard_concept`
+from the DB, on every request. Instead, these are loaded along with the graph, as one small array per attribute:
+- vocab_code (uint8): 1-based position of the concept's vocabulary_id in g.meta['vocabularies']; 0 if unknown
+- standard (uint8): 1 if standard_concept = 'S', else 0
+
+Filters are then NumPy mask operations over these arrays.
+"""
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from backend.graph.compact_graph import CompactConceptGraph, IdsLike
+
+VOCAB_CODE = 'vocab_code'
+STANDARD = 'standard'
+MAX_VOCABULARIES = np.iinfo(np.uint8).max
+
+
+def has_concept_attributes(g: CompactConceptGraph) -> bool:
+    """Does g have concept attribute arrays?"""
+    return VOCAB_CODE in g.node_attrs and STANDARD in g.node_attrs and 'vocabularies' in g.meta
+
+
+def align_to_nodes(g: CompactConceptGraph, concept_ids: np.ndarray, values: np.ndarray, dtype=np.uint8) -> np.ndarray:
+    """Array of `values` by node index of g. Nodes not in concept_ids get 0; concept_ids not in g are ignored."""
+    aligned = np.zeros(len(g), dtype=dtype)
+    if not len(g.node_ids) or not len(concept_ids):
+        return aligned
+    idx = np.searchsorted(g.node_ids, concept_ids)
+    idx[idx == len(g.node_ids)] = 0
+    found = g.node_ids[idx] == concept_ids
+    aligned[idx[found]] = values[found]
+    return aligned
+
+
+def set_concept_attributes(g: CompactConceptGraph, vocabularies: List[str], rows: np.ndarray):
+    """Set g's concept attribute arrays
+
+    :param vocabularies: vocabulary_ids. Codes in rows are 1-based positions in this list.
+    :param rows: (n, 3) array of (concept_id, vocab_code, is_standard)"""
+    if len(vocabularies) > MAX_VOCABULARIES:
+        raise ValueError(f'{len(vocabularies)} vocabularies is too many for uint8 vocab codes')
+    g.node_attrs[VOCAB_CODE] = align_to_nodes(g, rows[:, 0], rows[:, 1])
+    g.node_attrs[STANDARD] = align_to_nodes(g, rows[:, 0], rows[:, 2])
+    g.meta['vocabularies'] = list(vocabularies)
+
+
+def vocab_codes(g: CompactConceptGraph, vocabs: List[str]) -> Dict[str, int]:
+    """Codes of the given vocabulary_ids. Vocabularies g doesn't know are left out."""
+    known: List[str] = g.meta.get('vocabularies', [])
+    return {v: known.index(v) + 1 for v in vocabs if v in known}
+
+
+def hidden_concepts(
+    g: CompactConceptGraph, concept_ids: IdsLike, hide_vocabs: List[str], hide_nonstandard_concepts=False
+) -> Tuple[Dict[str, np.ndarray], np.ndarray]:
+    """Which of concept_ids to hide, by vocab and by non-standard status. Concept ids not in g, or without attributes
+    (vocab code 0: not in the concept table), are never hidden.
+
+    :returns
+      hidden_by_voc: Map of vocab to concept ids to hide
+      nonstandard_concepts_hidden: Non-standard concept ids, if hide_nonstandard_concepts, else empty"""
+    idx = g.to_index(concept_ids)
+    codes: np.ndarray = g.node_attrs[VOCAB_CODE][idx]
+    hidden_by_voc: Dict[str, np.ndarray] = {}
+    for vocab, code in vocab_codes(g, hide_vocabs).items():
+        hidden = g.node_ids[idx[codes == code]]
+        if len(hidden):
+            hidden_by_voc[vocab] = hidden
+    nonstandard = g.node_ids[idx[(g.node_attrs[STANDARD][idx] == 0) & (codes != 0)]] if hide_nonstandard_concepts \
+        else np.empty(0, dtype=g.node_ids.dtype)
+    return hidden_by_voc, nonstandard
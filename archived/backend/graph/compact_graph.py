@@ -0,0 +1,256 @@
+"""Compact, CSR-backed concept relationship graph
+
+The OMOP hierarchy (`concept_graph` table) has millions of edges. As a networkx DiGraph, that costs several GB of
+Python dicts in every worker. CompactConceptGraph stores the same hierarchy as a handful of NumPy arrays:
+
+- node_ids: Sorted OMOP concept_ids. A concept's position in this array is its dense int32 node index.
+- indptr / indices: CSR adjacency of successors (children), by node index.
+- rev_indptr / rev_indices: CSR adjacency of predecessors (parents), by node index.
+- node_attrs: Optional per-node attribute arrays, also by node index. See attributes.py.
+- indexes: Optional arrays of indexes derived from this exact graph, e.g. reachability labels, so that they can be
+  saved in and mmapped from its snapshot rather than rebuilt by every process. Not carried over to subgraphs.
+
+Only the operations TermHub needs are implemented: node lookup, successors / predecessors, degrees, and subgraph
+extraction. None of them build networkx objects.
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+import numpy as np
+
+ATTR_PREFIX = 'attr_'
+INDEX_PREFIX = 'index_'
+INDEX_DTYPE = np.int32
+INDPTR_DTYPE = np.int64
+CONCEPT_ID_DTYPE = np.int64
+IdsLike = Union[Iterable[int], np.ndarray]
+
+
+def csr_gather(indptr: np.ndarray, indices: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Gather the CSR rows for `rows` in a single vectorized pass.
+
+    :return: (owners, values): values[i] is an entry of row owners[i]. Rows appear in the order given."""
+    rows = np.asarray(rows, dtype=INDEX_DTYPE)
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    total = int(counts.sum())
+    if not total:
+        return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=indices.dtype)
+    # position j of segment i maps to: indptr[rows[i]] + (j - segment_start[i])
+    segment_starts = np.cumsum(counts) - counts
+    positions = np.arange(total, dtype=INDPTR_DTYPE) + np.repeat(starts - segment_starts, counts)
+    return np.repeat(rows, counts), indices[positions]
+
+
+def _build_csr(src: np.ndarray, tgt: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Build CSR arrays. Assumes (src, tgt) is already sorted by src."""
+    indptr = np.zeros(n + 1, dtype=INDPTR_DTYPE)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, tgt.astype(INDEX_DTYPE, copy=False)
+
+
+class CompactConceptGraph:
+    """Directed concept graph (parent -> child) stored as forward and reverse CSR arrays."""
+
+    def __init__(
+        self, node_ids: np.ndarray, indptr: np.ndarray, indices: np.ndarray, rev_indptr: np.ndarray,
+        rev_indices: np.ndarray, meta: Dict = None, node_attrs: Dict[str, np.ndarray] = None,
+        indexes: Dict[str, np.ndarray] = None
+    ):
+        self.node_ids = node_ids
+        self.indptr = indptr
+        self.indices = indices
+        self.rev_indptr = rev_indptr
+        self.rev_indices = rev_indices
+        self.meta: Dict = meta if meta is not None else {}
+        self.node_attrs: Dict[str, np.ndarray] = node_attrs if node_attrs is not None else {}
+        self.indexes: Dict[str, np.ndarray] = indexes if indexes is not None else {}
+        self._out_degree: Optional[np.ndarray] = None
+
+    # Construction -----------------------------------------------------------------------------------------------------
+    @classmethod
+    def from_edges(
+        cls, sources: IdsLike, targets: IdsLike, node_ids: IdsLike = None, meta: Dict = None
+    ) -> 'CompactConceptGraph':
+        """Build from parallel arrays of source (parent) and target (child) concept_ids.
+
+        :param node_ids: Optional extra nodes to include, e.g. isolated nodes of a subgraph.
+        Duplicate edges are dropped."""
+        sources = np.asarray(sources, dtype=CONCEPT_ID_DTYPE)
+        targets = np.asarray(targets, dtype=CONCEPT_ID_DTYPE)
+        if len(sources) != len(targets):
+            raise ValueError(f'sources and targets differ in length: {len(sources)} vs {len(targets)}')
+        parts = [sources, targets]
+        if node_ids is not None:
+            parts.append(np.asarray(node_ids, dtype=CONCEPT_ID_DTYPE))
+        all_ids = np.unique(np.concatenate(parts))
+        n = len(all_ids)
+        if n >= np.iinfo(INDEX_DTYPE).max:
+            raise ValueError(f'Too many nodes for {INDEX_DTYPE.__name__} indexing: {n}')
+
+        # Dedupe and sort edges by (src, tgt) in one pass, by packing index pairs into one int64 key
+        src = np.searchsorted(all_ids, sources).astype(np.int64)
+        tgt = np.searchsorted(all_ids, targets).astype(np.int64)
+        keys = np.unique((src << 32) | tgt)
+        src = (keys >> 32).astype(INDEX_DTYPE)
+        tgt = (keys & 0xFFFFFFFF).astype(INDEX_DTYPE)
+
+        indptr, indices = _build_csr(src, tgt, n)
+        rev_order = np.lexsort((src, tgt))
+        rev_indptr, rev_indices = _build_csr(tgt[rev_order], src[rev_order], n)
+        return cls(all_ids, indptr, indices, rev_indptr, rev_indices, meta)
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], meta: Dict = None) -> 'CompactConceptGraph':
+        """Build from the arrays returned by arrays(), e.g. when loading a snapshot. Arrays are used as-is, not
+        copied."""
+        node_attrs = {k[len(ATTR_PREFIX):]: v for k, v in arrays.items() if k.startswith(ATTR_PREFIX)}
+        indexes = {k[len(INDEX_PREFIX):]: v for k, v in arrays.items() if k.startswith(INDEX_PREFIX)}
+        return cls(arrays['node_ids'], arrays['indptr'], arrays['indices'], arrays['rev_indptr'],
+                   arrays['rev_indices'], meta, node_attrs, indexes)
+
+    @classmethod
+    def from_networkx(cls, g) -> 'CompactConceptGraph':
+        """Convert a networkx DiGraph, e.g. from a legacy relationship_graph.pickle"""
+        edges = np.array(list(g.edges), dtype=CONCEPT_ID_DTYPE).reshape(-1, 2)
+        nodes = np.fromiter(g.nodes, dtype=CONCEPT_ID_DTYPE, count=len(g))
+        return cls.from_edges(edges[:, 0], edges[:, 1], nodes)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """All arrays needed to reconstruct the graph, by name"""
+        return {
+            'node_ids': self.node_ids,
+            'indptr': self.indptr,
+            'indices': self.indices,
+            'rev_indptr': self.rev_indptr,
+            'rev_indices': self.rev_indices,
+            **{ATTR_PREFIX + k: v for k, v in self.node_attrs.items()},
+            **{INDEX_PREFIX + k: v for k, v in self.indexes.items()},
+        }
+
+    # Basic properties -------------------------------------------------------------------------------------------------
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __contains__(self, concept_id) -> bool:
+        return self.has_node(concept_id)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(nodes={len(self)}, edges={self.number_of_edges()})'
+
+    def number_of_nodes(self) -> int:
+        """Number of nodes"""
+        return len(self.node_ids)
+
+    def number_of_edges(self) -> int:
+        """Number of edges"""
+        return len(self.indices)
+
+    @property
+    def nodes(self) -> np.ndarray:
+        """Concept ids of all nodes, sorted"""
+        return self.node_ids
+
+    @property
+    def edges(self) -> List[Tuple[int, int]]:
+        """All edges as (source, target) concept_id tuples. For big graphs, prefer edge_array()."""
+        return list(map(tuple, self.edge_array().tolist()))
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the graph's arrays"""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    def out_degree(self) -> np.ndarray:
+        """Number of children of each node, by node index. Computed once, so checks against it are free."""
+        if self._out_degree is None:
+            self._out_degree = np.diff(self.indptr)
+        return self._out_degree
+
+    def in_degree(self) -> np.ndarray:
+        """Number of parents of each node, by node index"""
+        return np.diff(self.rev_indptr)
+
+    # Lookup -----------------------------------------------------------------------------------------------------------
+    def has_node(self, concept_id: int) -> bool:
+        """Is concept_id a node in the graph?"""
+        i = np.searchsorted(self.node_ids, concept_id)
+        return bool(i < len(self.node_ids) and self.node_ids[i] == concept_id)
+
+    def to_index(self, concept_ids: IdsLike) -> np.ndarray:
+        """Dense node indexes of concept_ids. Concept ids that aren't in the graph are dropped."""
+        ids = np.asarray(concept_ids if isinstance(concept_ids, np.ndarray) else list(concept_ids),
+                         dtype=CONCEPT_ID_DTYPE)
+        if not len(ids) or not len(self.node_ids):
+            return np.empty(0, dtype=INDEX_DTYPE)
+        idx = np.searchsorted(self.node_ids, ids)
+        idx[idx == len(self.node_ids)] = 0
+        return idx[self.node_ids[idx] == ids].astype(INDEX_DTYPE)
+
+    def node_mask(self, concept_ids: IdsLike) -> np.ndarray:
+        """Boolean mask over node indexes, True for nodes in concept_ids"""
+        mask = np.zeros(len(self.node_ids), dtype=bool)
+        mask[self.to_index(concept_ids)] = True
+        return mask
+
+    def successors(self, concept_id: int) -> np.ndarray:
+        """Children of a concept, as concept_ids"""
+        idx = self.to_index([concept_id])
+        if not len(idx):
+            return np.empty(0, dtype=CONCEPT_ID_DTYPE)
+        i = idx[0]
+        return self.node_ids[self.indices[self.indptr[i]:self.indptr[i + 1]]]
+
+    def predecessors(self, concept_id: int) -> np.ndarray:
+        """Parents of a concept, as concept_ids"""
+        idx = self.to_index([concept_id])
+        if not len(idx):
+            return np.empty(0, dtype=CONCEPT_ID_DTYPE)
+        i = idx[0]
+        return self.node_ids[self.rev_indices[self.rev_indptr[i]:self.rev_indptr[i + 1]]]
+
+    def successors_of(self, concept_ids: IdsLike) -> Set[int]:
+        """Union of the children of all concept_ids"""
+        _owners, children = csr_gather(self.indptr, self.indices, self.to_index(concept_ids))
+        return set(self.node_ids[np.unique(children)].tolist())
+
+    # Edges & subgraphs ------------------------------------------------------------------------------------------------
+    def edge_index_array(self) -> Tuple[np.ndarray, np.ndarray]:
+        """All edges as parallel (source, target) node index arrays, sorted by source"""
+        src = np.repeat(np.arange(len(self.node_ids), dtype=INDEX_DTYPE), self.out_degree())
+        return src, self.indices
+
+    def edge_array(self) -> np.ndarray:
+        """All edges as an (n_edges, 2) array of concept_ids"""
+        src, tgt = self.edge_index_array()
+        return np.column_stack((self.node_ids[src], self.node_ids[tgt]))
+
+    def iter_edge_chunks(self, chunk_size: int = 65536) -> Iterator[np.ndarray]:
+        """All edges, as (<= chunk_size, 2) arrays of concept_ids. Only one chunk is materialized at a time."""
+        n_edges = self.number_of_edges()
+        for start in range(0, n_edges, chunk_size):
+            stop = min(start + chunk_size, n_edges)
+            # Sources of edge positions [start, stop): the rows whose indptr ranges contain them
+            src = np.searchsorted(self.indptr, np.arange(start, stop), side='right') - 1
+            yield np.column_stack((self.node_ids[src], self.node_ids[self.indices[start:stop]]))
+
+    def subgraph_edges(self, concept_ids: IdsLike) -> np.ndarray:
+        """Edges whose source and target are both in concept_ids, as an (n, 2) array of concept_ids.
+
+        Equivalent to `nx.DiGraph.subgraph(concept_ids).edges`, but vectorized: only the rows of the requested nodes
+        are visited."""
+        rows = np.unique(self.to_index(concept_ids))
+        mask = np.zeros(len(self.node_ids), dtype=bool)
+        mask[rows] = True
+        owners, children = csr_gather(self.indptr, self.indices, rows)
+        keep = mask[children]
+        return np.column_stack((self.node_ids[owners[keep]], self.node_ids[children[keep]]))
+
+    def subgraph(self, concept_ids: IdsLike) -> 'CompactConceptGraph':
+        """Induced subgraph on the concept_ids that are in the graph. Node attributes are carried over."""
+        edges = self.subgraph_edges(concept_ids)
+        nodes = self.node_ids[self.to_index(concept_ids)]
+        sg = type(self).from_edges(edges[:, 0], edges[:, 1], nodes)
+        if self.node_attrs:
+            idx = self.to_index(sg.node_ids)
+            sg.node_attrs = {k: v[idx] for k, v in self.node_attrs.items()}
+        return sg
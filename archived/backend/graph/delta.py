@@ -0,0 +1,148 @@
+"""Incremental updates of the concept graph from vocab refreshes
+
+Rather than rebuilding from scratch whenever the vocab changes, the edges of the new `concept_graph` table are diffed
+against the current graph, and only the added / removed edges are applied. Each applied delta is also written to a
+delta log next to the snapshot, so that processes holding an older version of the graph can still catch up by
+replaying deltas if the snapshot is missing or unreadable. Otherwise, they just map the new snapshot.
+
+Versions: every snapshot's meta has a `graph_version` integer, incremented on each update. The delta log entry for
+version N holds the changes from version N - 1 to N.
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from backend.graph.compact_graph import CONCEPT_ID_DTYPE, CompactConceptGraph
+
+DELTA_LOG_MAX_ENTRIES = 20
+
+
+class EdgeDelta:
+    """Edges added and removed between two versions of the graph, as (n, 2) arrays of (source_id, target_id)"""
+
+    def __init__(self, added: np.ndarray, removed: np.ndarray, meta: Dict[str, Any] = None):
+        self.added = np.asarray(added, dtype=CONCEPT_ID_DTYPE).reshape(-1, 2)
+        self.removed = np.asarray(removed, dtype=CONCEPT_ID_DTYPE).reshape(-1, 2)
+        self.meta: Dict[str, Any] = meta if meta is not None else {}
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.removed)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(added={len(self.added)}, removed={len(self.removed)})'
+
+
+def edge_keys(edges: np.ndarray) -> np.ndarray:
+    """Pack (source_id, target_id) rows into one uint64 each, so that edge sets can be diffed with np.setdiff1d().
+
+    OMOP concept_ids are non-negative int32s, so they fit in 32 bits each."""
+    edges = np.asarray(edges, dtype=CONCEPT_ID_DTYPE).reshape(-1, 2)
+    if len(edges) and (edges.min() < 0 or edges.max() > 0xFFFFFFFF):
+        raise ValueError('Concept ids must be in the range [0, 2^32) to be packed into edge keys')
+    edges = edges.astype(np.uint64)
+    return (edges[:, 0] << np.uint64(32)) | edges[:, 1]
+
+
+def edges_from_keys(keys: np.ndarray) -> np.ndarray:
+    """Inverse of edge_keys()"""
+    keys = np.asarray(keys, dtype=np.uint64)
+    return np.column_stack((keys >> np.uint64(32), keys & np.uint64(0xFFFFFFFF))).astype(CONCEPT_ID_DTYPE)
+
+
+def compute_edge_delta(g: CompactConceptGraph, new_edges: np.ndarray) -> EdgeDelta:
+    """Diff the edges of g against new_edges, an (n, 2) array of (source_id, target_id)"""
+    old_keys = np.unique(edge_keys(g.edge_array()))
+    new_keys = np.unique(edge_keys(new_edges))
+    added = np.setdiff1d(new_keys, old_keys, assume_unique=True)
+    removed = np.setdiff1d(old_keys, new_keys, assume_unique=True)
+    return EdgeDelta(edges_from_keys(added), edges_from_keys(removed))
+
+
+def apply_edge_delta(g: CompactConceptGraph, delta: EdgeDelta, meta: Dict[str, Any] = None) -> CompactConceptGraph:
+    """Return g with delta applied. g itself is not modified; its arrays may be read-only mmaps.
+
+    The result is identical to building the graph from the new edges from scratch: nodes left without edges are
+    dropped, as a full build only has nodes that appear in some edge.
+    :param meta: Meta for the new graph. Defaults to g.meta."""
+    keys = edge_keys(g.edge_array())
+    if len(delta.removed):
+        keys = keys[~np.isin(keys, edge_keys(delta.removed))]
+    if len(delta.added):
+        keys = np.concatenate([keys, edge_keys(delta.added)])
+    edges = edges_from_keys(keys)
+    return CompactConceptGraph.from_edges(edges[:, 0], edges[:, 1], meta=dict(g.meta if meta is None else meta))
+
+
+# Delta log ------------------------------------------------------------------------------------------------------------
+def delta_log_dir(graph_path: str) -> str:
+    """Directory holding the delta log of the snapshot at graph_path"""
+    return f'{graph_path}.deltas'
+
+
+def _delta_path(graph_path: str, version: int) -> str:
+    """Path of the delta log entry for the change to `version`"""
+    return os.path.join(delta_log_dir(graph_path), f'{version:08d}.npz')
+
+
+def write_delta(graph_path: str, version: int, delta: EdgeDelta):
+    """Add the delta that produced `version` to the log, and prune old entries.
+
+    Write this before the new snapshot, so that any process seeing the new snapshot version can find its delta."""
+    log_dir = delta_log_dir(graph_path)
+    os.makedirs(log_dir, exist_ok=True)
+    path = _delta_path(graph_path, version)
+    tmp_path = f'{path}.tmp{os.getpid()}.npz'
+    np.savez(tmp_path, added=delta.added, removed=delta.removed, meta=np.array(json.dumps(delta.meta)))
+    os.replace(tmp_path, path)
+    entries: List[str] = sorted(f for f in os.listdir(log_dir) if f.endswith('.npz') and '.tmp' not in f)
+    for old in entries[:-DELTA_LOG_MAX_ENTRIES]:
+        os.remove(os.path.join(log_dir, old))
+
+
+def read_delta(graph_path: str, version: int) -> Optional[EdgeDelta]:
+    """Read the delta that produced `version`. None if it isn't in the log."""
+    path = _delta_path(graph_path, version)
+    if not os.path.isfile(path):
+        return None
+    with np.load(path) as npz:
+        return EdgeDelta(npz['added'], npz['removed'], json.loads(str(npz['meta'])))
+
+
+def latest_delta_version(graph_path: str) -> Optional[int]:
+    """Version the newest entry of the delta log produced. None if the log is empty."""
+    log_dir = delta_log_dir(graph_path)
+    if not os.path.isdir(log_dir):
+        return None
+    versions: List[int] = [int(f[:-len('.npz')]) for f in os.listdir(log_dir) if f.endswith('.npz') and '.tmp' not in f]
+    return max(versions) if versions else None
+
+
+def clear_delta_log(graph_path: str):
+    """Remove all delta log entries, e.g. after a full rebuild, which they can no longer be replayed onto"""
+    log_dir = delta_log_dir(graph_path)
+    if os.path.isdir(log_dir):
+        for f in os.listdir(log_dir):
+            os.remove(os.path.join(log_dir, f))
+
+
+def catch_up(g: CompactConceptGraph, graph_path: str, target_meta: Dict[str, Any]) -> Optional[CompactConceptGraph]:
+    """Bring g up to the version described by target_meta (a snapshot's meta) by replaying the delta log.
+
+    :return: The updated graph, or None if the log doesn't cover every version in between, in which case the caller
+    should reload the snapshot."""
+    version: int = g.meta.get('graph_version', 0)
+    target: int = target_meta.get('graph_version', 0)
+    if target < version:
+        return None
+    deltas: List[EdgeDelta] = []
+    for v in range(version + 1, target + 1):
+        delta = read_delta(graph_path, v)
+        if delta is None:
+            return None
+        deltas.append(delta)
+    for delta in deltas:
+        g = apply_edge_delta(g, delta)
+    g.meta = dict(target_meta)
+    return g
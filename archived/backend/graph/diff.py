@@ -0,0 +1,87 @@
+"""Diff of the concept graph between two vocab versions, within the hierarchy of some concepts
+
+For reviewing a vocab update: which edges changed below the members of some concept sets, and which members gained or
+lost descendants. Computed from the two graphs' arrays, without SQL against `concept_ancestor`:
+- Edges are packed into sorted uint64 keys (see delta.edge_keys()), only for sources in scope: the concepts and their
+  descendants in either graph. The sets of added / removed edges are then np.setdiff1d() of sorted arrays.
+- Only concepts that are ancestors of some changed edge's source can have gained or lost descendants, so only their
+  descendant sets are diffed.
+
+Usage, to diff two snapshot files:
+    python -m backend.graph.diff OLD_SNAPSHOT NEW_SNAPSHOT --concept-ids ID [ID ...]
+"""
+import json
+from argparse import ArgumentParser
+from typing import Any, Dict, List
+
+import numpy as np
+
+from backend.graph.compact_graph import CONCEPT_ID_DTYPE, CompactConceptGraph, IdsLike, csr_gather
+from backend.graph.delta import edge_keys, edges_from_keys
+from backend.graph.reachability import ReachabilityIndex
+from backend.graph.snapshot import read_graph_snapshot
+
+
+def scoped_edge_keys(g: CompactConceptGraph, scope: np.ndarray) -> np.ndarray:
+    """Sorted edge keys of g's edges whose source is in scope, a sorted array of concept_ids"""
+    rows = g.to_index(scope)
+    owners, children = csr_gather(g.indptr, g.indices, rows)
+    # Rows are in concept_id order, and each row's children too, so the keys come out sorted
+    return edge_keys(np.column_stack((g.node_ids[owners], g.node_ids[children])))
+
+
+def diff_graphs(old: ReachabilityIndex, new: ReachabilityIndex, concept_ids: IdsLike) -> Dict[str, Any]:
+    """Changes from graph old.g to new.g, within the hierarchy of concept_ids
+
+    :param concept_ids: e.g. the members of some concept sets
+    :return: Dict with
+      edges_added / edges_removed: (parent, child) edges whose parent is one of concept_ids or a descendant of one, in
+        either graph
+      descendants_gained / descendants_lost: Map of each of concept_ids whose descendants changed, to the descendants
+        it gained / lost
+      missing_from_old / missing_from_new: concept_ids not in each graph"""
+    concept_ids = np.unique(np.asarray(list(concept_ids), dtype=CONCEPT_ID_DTYPE))
+    scope = np.union1d(old.descendants(concept_ids, include_self=True), new.descendants(concept_ids, include_self=True))
+    old_keys, new_keys = scoped_edge_keys(old.g, scope), scoped_edge_keys(new.g, scope)
+    added = edges_from_keys(np.setdiff1d(new_keys, old_keys, assume_unique=True))
+    removed = edges_from_keys(np.setdiff1d(old_keys, new_keys, assume_unique=True))
+
+    changed_sources = np.union1d(added[:, 0], removed[:, 0])
+    candidates = np.intersect1d(concept_ids, np.union1d(
+        old.ancestors(changed_sources, include_self=True), new.ancestors(changed_sources, include_self=True)))
+    gained: Dict[int, List[int]] = {}
+    lost: Dict[int, List[int]] = {}
+    for concept_id in candidates.tolist():
+        old_descendants, new_descendants = old.descendants([concept_id]), new.descendants([concept_id])
+        diff = np.setdiff1d(new_descendants, old_descendants, assume_unique=True)
+        if len(diff):
+            gained[concept_id] = diff.tolist()
+        diff = np.setdiff1d(old_descendants, new_descendants, assume_unique=True)
+        if len(diff):
+            lost[concept_id] = diff.tolist()
+
+    return {
+        'edges_added': added.tolist(),
+        'edges_removed': removed.tolist(),
+        'descendants_gained': gained,
+        'descendants_lost': lost,
+        'missing_from_old': np.setdiff1d(concept_ids, old.g.node_ids, assume_unique=True).tolist(),
+        'missing_from_new': np.setdiff1d(concept_ids, new.g.node_ids, assume_unique=True).tolist(),
+    }
+
+
+def cli():
+    """Command line interface"""
+    parser = ArgumentParser(prog='Graph diff', description='Diff two concept graph snapshots, below some concepts.')
+    parser.add_argument('old', help='Path of the older snapshot')
+    parser.add_argument('new', help='Path of the newer snapshot')
+    parser.add_argument('-c', '--concept-ids', type=int, nargs='+', required=True, help='Concepts to diff below')
+    args = parser.parse_args()
+    old, new = read_graph_snapshot(args.old), read_graph_snapshot(args.new)
+    diff = diff_graphs(ReachabilityIndex.for_graph(old), ReachabilityIndex.for_graph(new), args.concept_ids)
+    print(json.dumps({'from_vocab_version': old.meta.get('vocab_version'),
+                      'to_vocab_version': new.meta.get('vocab_version'), **diff}, indent=2))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,97 @@
+"""Local concept set expansion: concept_set_version_item rows to concept_set_members, without the enclave
+
+Follows the OMOP / ATLAS semantics of an expression's items:
+- includeDescendants: the item's concept plus all of its descendants in the relationship graph
+- includeMapped: also every concept that "Maps to" any of those, e.g. the non-standard source codes of a standard
+  concept
+- isExcluded: the item's concepts (expanded the same way) are removed from the result, whatever the item order
+
+Items are grouped by their flags, so an expression is expanded with a handful of vectorized lookups rather than one
+per item: descendants via ReachabilityIndex, mapped concepts via a sorted "Maps to" index.
+"""
+from typing import Any, Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from backend.graph.compact_graph import CONCEPT_ID_DTYPE, IdsLike
+from backend.graph.reachability import ReachabilityIndex, expand_ranges
+
+ITEM_FLAGS = ('includeDescendants', 'includeMapped', 'isExcluded')
+
+
+class MapsToIndex:
+    """Concepts that map to each concept, from concept_relationship "Maps to" rows, as arrays sorted by target"""
+
+    def __init__(self, targets: np.ndarray, sources: np.ndarray, meta: Dict = None):
+        self.targets = targets
+        self.sources = sources
+        self.meta: Dict = meta if meta is not None else {}
+
+    @classmethod
+    def from_edges(cls, maps_to: np.ndarray, meta: Dict = None) -> 'MapsToIndex':
+        """Build from an (n, 2) array of (concept_id_1, concept_id_2): concept_id_1 "Maps to" concept_id_2"""
+        maps_to = np.asarray(maps_to, dtype=CONCEPT_ID_DTYPE).reshape(-1, 2)
+        order = np.lexsort((maps_to[:, 0], maps_to[:, 1]))
+        return cls(maps_to[order, 1], maps_to[order, 0], meta)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def mapped_from(self, concept_ids: IdsLike) -> np.ndarray:
+        """Concepts that map to any of concept_ids, as sorted concept_ids"""
+        if not isinstance(concept_ids, np.ndarray):
+            concept_ids = list(concept_ids)
+        concept_ids = np.unique(np.asarray(concept_ids, dtype=CONCEPT_ID_DTYPE))
+        lo = np.searchsorted(self.targets, concept_ids, side='left')
+        hi = np.searchsorted(self.targets, concept_ids, side='right')
+        _segment, positions = expand_ranges(lo, hi - lo)
+        return np.unique(self.sources[positions])
+
+
+def expand_concepts(
+    index: ReachabilityIndex, maps_to: MapsToIndex, concept_ids: np.ndarray, include_descendants=False,
+    include_mapped=False
+) -> np.ndarray:
+    """concept_ids, plus their descendants, and / or the concepts that map to any of those. Sorted.
+
+    Concepts not in the graph are kept: they just have no descendants."""
+    concept_ids = np.unique(np.asarray(concept_ids, dtype=CONCEPT_ID_DTYPE))
+    if include_descendants and len(concept_ids):
+        concept_ids = np.union1d(concept_ids, index.descendants(concept_ids))
+    if include_mapped and len(concept_ids):
+        concept_ids = np.union1d(concept_ids, maps_to.mapped_from(concept_ids))
+    return concept_ids
+
+
+def expand_expression(
+    index: ReachabilityIndex, maps_to: MapsToIndex, items: Iterable[Dict[str, Any]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Members of a concept set version from its expression items
+
+    :param items: Dicts with concept_id and, optionally, the ITEM_FLAGS, as in concept_set_version_item
+    :return: (members, excluded): sorted concept_ids. excluded are the concepts that exclusion items removed or kept
+    out."""
+    groups: Dict[Tuple[bool, bool, bool], List[int]] = {}
+    for item in items:
+        flags = tuple(bool(item.get(flag)) for flag in ITEM_FLAGS)
+        groups.setdefault(flags, []).append(int(item['concept_id']))
+    included: List[np.ndarray] = [np.empty(0, dtype=CONCEPT_ID_DTYPE)]
+    excluded: List[np.ndarray] = [np.empty(0, dtype=CONCEPT_ID_DTYPE)]
+    for (include_descendants, include_mapped, is_excluded), concept_ids in groups.items():
+        expanded = expand_concepts(index, maps_to, np.array(concept_ids), include_descendants, include_mapped)
+        (excluded if is_excluded else included).append(expanded)
+    excluded_ids = np.unique(np.concatenate(excluded))
+    return np.setdiff1d(np.concatenate(included), excluded_ids), excluded_ids
+
+
+def expand_csets(
+    index: ReachabilityIndex, maps_to: MapsToIndex, items: Iterable[Dict[str, Any]]
+) -> Dict[int, np.ndarray]:
+    """Members of several concept set versions
+
+    :param items: concept_set_version_item rows: as for expand_expression(), plus codeset_id
+    :return: Map of codeset_id to sorted member concept_ids"""
+    by_cset: Dict[int, List[Dict[str, Any]]] = {}
+    for item in items:
+        by_cset.setdefault(int(item['codeset_id']), []).append(item)
+    return {codeset_id: expand_expression(index, maps_to, cset_items)[0] for codeset_id, cset_items in by_cset.items()}
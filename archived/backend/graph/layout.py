@@ -0,0 +1,152 @@
+"""Layered (Sugiyama-style) layout of concept subgraphs, computed server-side
+
+Laying out thousands of nodes in the browser freezes it. This computes a hierarchical layout in the classic steps
+(Sugiyama, Tagawa & Toda, 1981, "Methods for visual understanding of hierarchical system structures"):
+1. Layering: a node's layer is the length of the longest path reaching it from a root, so every edge points down.
+2. Long edges are split by a dummy node on each layer they cross, so that all edges join adjacent layers.
+3. Crossing reduction: alternating down / up sweeps, ordering each layer by the barycenter (mean position) of its
+   neighbors in the layer just ordered.
+4. Coordinates: x from the position in the layer, centered on 0; y from the layer.
+
+Each step is vectorized over a layer at a time. Long edges come back with their bend points: the coordinates of their
+dummy nodes.
+"""
+import hashlib
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+from backend.graph.compact_graph import INDEX_DTYPE, CompactConceptGraph
+from backend.graph.reachability import expand_ranges, topological_levels
+
+DEFAULT_LAYOUT_PARAMS: Dict[str, Any] = {'node_sep': 1.0, 'layer_sep': 1.0, 'iterations': 4}
+
+
+def graph_hash(g: CompactConceptGraph) -> str:
+    """Hash of g's nodes and edges, e.g. as a cache key for its layout"""
+    h = hashlib.blake2b(digest_size=16)
+    for arr in (g.node_ids, g.indptr, g.indices):
+        h.update(np.ascontiguousarray(arr).tobytes())
+    return h.hexdigest()
+
+
+def assign_layers(g: CompactConceptGraph) -> np.ndarray:
+    """Layer of each node index: the longest path length from a root. Nodes on or below a cycle go below the rest."""
+    levels, leftover = topological_levels(g.indptr, g.indices, g.rev_indptr, g.rev_indices)
+    layer = np.zeros(len(g), dtype=INDEX_DTYPE)
+    for i, nodes in enumerate(levels):
+        layer[nodes] = i
+    layer[leftover] = len(levels)
+    return layer
+
+
+def split_long_edges(
+    src: np.ndarray, tgt: np.ndarray, layer: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Put a dummy node on each layer that an edge crosses. Edges that don't point down (within cycles) are dropped.
+
+    :return: (kept, u, v, layers, dummy_start)
+      kept: Mask of the edges kept
+      u, v: Edges between adjacent layers, by node index. Dummy nodes are numbered from len(layer) up.
+      layers: Layer of each node, dummy nodes included
+      dummy_start: Index of the first dummy node of each kept edge. An edge's dummy nodes are numbered consecutively,
+        from top to bottom."""
+    kept = layer[tgt] > layer[src]
+    src, tgt = src[kept], tgt[kept]
+    spans = (layer[tgt] - layer[src]).astype(np.int64)
+    n_dummies = spans - 1
+    dummy_start = len(layer) + np.cumsum(n_dummies) - n_dummies
+    seg, step = expand_ranges(np.zeros(len(spans), dtype=np.int64), spans)
+    last = step == spans[seg] - 1
+    u = np.where(step == 0, src[seg], dummy_start[seg] + step - 1)
+    v = np.where(last, tgt[seg], dummy_start[seg] + step)
+    layers = np.concatenate([layer, np.empty(int(n_dummies.sum()), dtype=layer.dtype)])
+    layers[v[~last]] = layer[src[seg[~last]]] + step[~last] + 1
+    return kept, u, v, layers, dummy_start
+
+
+def _group_by(keys: np.ndarray, n_groups: int) -> List[np.ndarray]:
+    """Positions of keys, grouped by key value"""
+    order = np.argsort(keys, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(keys, minlength=n_groups))[:-1])
+
+
+def _reorder_layer(nodes: np.ndarray, owners: np.ndarray, neighbor_pos: np.ndarray, pos: np.ndarray) -> np.ndarray:
+    """Sort a layer by the barycenters of its nodes' neighbors. Nodes without neighbors keep their position.
+
+    :param nodes: The layer's nodes, in order of position
+    :param owners: For each edge to the neighboring layer, its node in this layer
+    :param neighbor_pos: For each edge, the position of its node in the neighboring layer
+    :param pos: Position of every node in its layer. Updated for this layer.
+    :return: The layer's nodes in their new order"""
+    k = len(nodes)
+    rank = pos[owners].astype(np.int64)
+    total = np.bincount(rank, weights=neighbor_pos, minlength=k)
+    count = np.bincount(rank, minlength=k)
+    current = np.arange(k, dtype=np.float64)
+    barycenter = np.where(count > 0, total / np.maximum(count, 1), current)
+    new_order = np.lexsort((current, barycenter))
+    nodes = nodes[new_order]
+    pos[nodes] = np.arange(k)
+    return nodes
+
+
+def order_layers(u: np.ndarray, v: np.ndarray, layers: np.ndarray, iterations: int = 4) -> np.ndarray:
+    """Order nodes within layers to reduce edge crossings, by barycenter sweeps
+
+    :return: Position of each node in its layer"""
+    n_layers = int(layers.max()) + 1 if len(layers) else 0
+    by_layer: List[np.ndarray] = _group_by(layers, n_layers)
+    pos = np.empty(len(layers), dtype=np.float64)
+    for nodes in by_layer:
+        pos[nodes] = np.arange(len(nodes))
+    edges_into: List[np.ndarray] = _group_by(layers[v], n_layers)
+    edges_out_of: List[np.ndarray] = _group_by(layers[u], n_layers)
+    for _ in range(iterations):
+        for i in range(1, n_layers):
+            e = edges_into[i]
+            by_layer[i] = _reorder_layer(by_layer[i], v[e], pos[u[e]], pos)
+        for i in range(n_layers - 2, -1, -1):
+            e = edges_out_of[i]
+            by_layer[i] = _reorder_layer(by_layer[i], u[e], pos[v[e]], pos)
+    return pos
+
+
+def layered_layout(g: CompactConceptGraph, node_sep=1.0, layer_sep=1.0, iterations=4) -> Dict[str, Any]:
+    """Layered layout of g, top down
+
+    :param node_sep: Horizontal distance between neighboring nodes in a layer
+    :param layer_sep: Vertical distance between layers
+    :param iterations: Number of down + up crossing reduction sweeps
+    :return: Dict with
+      nodes: Map of concept_id to [x, y]
+      bends: [source, target, [[x, y], ...]] for each edge that spans several layers: the points it should pass
+        through, top to bottom
+      n_layers, width, height"""
+    src, tgt = g.edge_index_array()
+    layer = assign_layers(g)
+    kept, u, v, layers, dummy_start = split_long_edges(src, tgt, layer)
+    pos = order_layers(u, v, layers, iterations)
+
+    layer_sizes = np.bincount(layers) if len(layers) else np.zeros(0, dtype=np.int64)
+    x = (pos - (layer_sizes[layers] - 1) / 2) * node_sep
+    y = layers * float(layer_sep)
+
+    n = len(g)
+    coords: List[List[float]] = np.column_stack((x[:n], y[:n])).tolist()
+    src, tgt = src[kept], tgt[kept]
+    n_dummies = layer[tgt] - layer[src] - 1
+    long = np.flatnonzero(n_dummies > 0)
+    _seg, dummies = expand_ranges(dummy_start[long], n_dummies[long])
+    points: List[List[float]] = np.column_stack((x[dummies], y[dummies])).tolist()
+    ends = np.cumsum(n_dummies[long]).tolist()
+    bends = [[int(g.node_ids[src[e]]), int(g.node_ids[tgt[e]]), points[end - int(n_dummies[e]):end]]
+             for e, end in zip(long.tolist(), ends)]
+
+    return {
+        'nodes': dict(zip(g.node_ids.tolist(), coords)),
+        'bends': bends,
+        'n_layers': len(layer_sizes),
+        'width': float((layer_sizes.max() - 1) * node_sep) if len(layer_sizes) else 0.0,
+        'height': float((len(layer_sizes) - 1) * layer_sep) if len(layer_sizes) else 0.0,
+    }
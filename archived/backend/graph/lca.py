@@ -0,0 +1,112 @@
+"""Lowest common ancestors and minimal connecting subgraphs of concepts
+
+Replaces the old networkx approach, which called `nx.ancestors()` for every node and then compared every pair. Here,
+each concept's ancestors (with their distances) come from one vectorized upward BFS; OMOP ancestor sets are small,
+bounded by the hierarchy's height. Common ancestors are sorted-array intersections, and the precomputed depths of
+ReachabilityIndex (longest path from a root, like `concept_ancestor_plus.a_depth`) rank the lowest ones.
+"""
+from typing import Any, Dict, List, Set, Tuple
+
+import numpy as np
+
+from backend.graph.compact_graph import IdsLike, csr_gather
+from backend.graph.reachability import ReachabilityIndex, bfs_levels
+
+
+def ancestor_distances(index: ReachabilityIndex, node: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Ancestors of node index `node`, including itself, as sorted node indexes, with each one's distance to it"""
+    found, depths = bfs_levels(index.g.rev_indptr, index.g.rev_indices, np.array([node]))
+    order = np.argsort(found)
+    return found[order], depths[order]
+
+
+def lowest_of(index: ReachabilityIndex, common: np.ndarray) -> np.ndarray:
+    """Lowest nodes of an ancestor-closed set of node indexes: those with no child in the set. Deepest first.
+
+    Checking children suffices: if a node has any descendant in the set, every node on the path between them is an
+    ancestor of that descendant, so is in the set too."""
+    if not len(common):
+        return common
+    owners, children = csr_gather(index.g.indptr, index.g.indices, common)
+    lowest = np.setdiff1d(common, owners[np.isin(children, common)])
+    return lowest[np.argsort(-index.depth[lowest], kind='stable')]
+
+
+def lowest_common_ancestors(index: ReachabilityIndex, concept_ids: IdsLike) -> List[int]:
+    """Lowest common ancestors of all concept_ids, deepest first. A DAG can have several. A concept counts as its own
+    ancestor, so if one of concept_ids is an ancestor of all the others, that is the answer.
+
+    :return: concept_ids of the LCAs. Empty if the concepts have no common ancestor, or none are in the graph."""
+    nodes = np.unique(index.g.to_index(concept_ids))
+    if not len(nodes):
+        return []
+    common = ancestor_distances(index, nodes[0])[0]
+    for node in nodes[1:]:
+        common = np.intersect1d(common, ancestor_distances(index, node)[0], assume_unique=True)
+        if not len(common):
+            return []
+    return index.g.node_ids[lowest_of(index, common)].tolist()
+
+
+def connecting_subgraph(index: ReachabilityIndex, concept_ids: IdsLike) -> Dict[str, Any]:
+    """Small tree joining concept_ids through their lowest common ancestor, without any other descendants
+
+    The edges are the union of shortest paths from the LCA down to each concept, preferring paths through nodes
+    already in the tree so that branches share edges. (A truly minimal Steiner tree is NP-hard; this is close in
+    practice, as hierarchy paths rarely diverge.)
+
+    Concepts without an ancestor in common with the rest are split into groups, greedily: each concept joins the first
+    group it still shares a common ancestor with. Each group gets its own tree.
+
+    :return: Dict with
+      edges: (parent, child) concept_id pairs of all trees
+      groups: For each group, its concept_ids, its lowest_common_ancestors (deepest first), and the root its tree uses
+      missing_from_graph: concept_ids not in the graph"""
+    g = index.g
+    requested = list(dict.fromkeys(int(x) for x in concept_ids))
+    nodes: List[int] = index.g.to_index(requested).tolist()
+    in_graph: Set[int] = set(g.node_ids[nodes].tolist())
+    ancestors: Dict[int, Tuple[np.ndarray, np.ndarray]] = {n: ancestor_distances(index, n) for n in nodes}
+
+    groups: List[Dict[str, Any]] = []
+    for node in nodes:
+        for group in groups:
+            common = np.intersect1d(group['common'], ancestors[node][0], assume_unique=True)
+            if len(common):
+                group['common'] = common
+                group['members'].append(node)
+                break
+        else:
+            groups.append({'members': [node], 'common': ancestors[node][0]})
+
+    edges: Set[Tuple[int, int]] = set()
+    groups_out: List[Dict[str, Any]] = []
+    for group in groups:
+        lcas = lowest_of(index, group['common'])
+        root = int(lcas[0])
+        in_tree: Set[int] = {root}
+        for member in group['members']:
+            anc, dist = ancestors[member]
+            cur = root
+            d = dist[np.searchsorted(anc, root)]
+            while cur != member:
+                # Children of cur that are on a shortest path to member
+                children = g.indices[g.indptr[cur]:g.indptr[cur + 1]]
+                pos = np.minimum(np.searchsorted(anc, children), len(anc) - 1)
+                candidates: List[int] = children[(anc[pos] == children) & (dist[pos] == d - 1)].tolist()
+                shared = [c for c in candidates if c in in_tree]
+                nxt = shared[0] if shared else candidates[0]
+                edges.add((cur, nxt))
+                in_tree.add(nxt)
+                cur, d = nxt, d - 1
+        groups_out.append({
+            'concept_ids': g.node_ids[group['members']].tolist(),
+            'lowest_common_ancestors': g.node_ids[lcas].tolist(),
+            'root': int(g.node_ids[root]),
+        })
+
+    return {
+        'edges': sorted((int(g.node_ids[s]), int(g.node_ids[t])) for s, t in edges),
+        'groups': groups_out,
+        'missing_from_graph': [x for x in requested if x not in in_graph],
+    }
@@ -0,0 +1,316 @@
+"""Reachability index over the concept graph, for transitive closure queries without `concept_ancestor`
+
+Uses interval labeling (Agrawal, Borgida & Jagadish, 1989, "Efficient management of transitive relationships in large
+data and knowledge bases"):
+- Pick a spanning forest of the DAG (each node's first parent) and number its nodes in preorder, so the descendants of
+  a node in the forest have consecutive numbers: an interval.
+- Each node is labeled with its own forest interval, merged with the labels of all of its children. The label then
+  covers exactly the node's descendants (plus itself), and is usually just a handful of intervals, since most of the
+  DAG's edges are forest edges.
+
+Labels are built level by level, all nodes of a level at once, with vectorized interval merges; there is no per-node
+Python loop.
+
+Only descendants are labeled. A concept's ancestors are few (bounded by the hierarchy's height, and mostly a single
+chain), so a vectorized upward breadth-first search answers those just as fast, without doubling the index's memory.
+
+Labels are stored with the graph's snapshot (see ReachabilityIndex.store()), so processes that mmap it share them rather
+than each building its own.
+"""
+import warnings
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from backend.graph.compact_graph import INDEX_DTYPE, INDPTR_DTYPE, CompactConceptGraph, IdsLike, csr_gather
+
+INDEX_NAME_PREFIX = 'reachability_'
+
+
+def expand_ranges(starts: np.ndarray, counts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Expand ranges [starts[i], starts[i] + counts[i]) into one flat array of positions.
+
+    :return: (segment, positions): positions[j] is in range segment[j]"""
+    counts = np.asarray(counts, dtype=INDPTR_DTYPE)
+    total = int(counts.sum())
+    if not total:
+        return np.empty(0, dtype=INDPTR_DTYPE), np.empty(0, dtype=INDPTR_DTYPE)
+    segment_starts = np.cumsum(counts) - counts
+    segment = np.repeat(np.arange(len(counts), dtype=INDPTR_DTYPE), counts)
+    shifts = np.asarray(starts, dtype=INDPTR_DTYPE) - segment_starts
+    positions = np.arange(total, dtype=INDPTR_DTYPE) + shifts[segment]
+    return segment, positions
+
+
+def merge_intervals(owners: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merge overlapping or adjacent closed intervals [lo, hi] that have the same owner.
+
+    :return: (owners, lo, hi), sorted by owner then lo. Each owner's intervals are disjoint and non-adjacent."""
+    owners = np.asarray(owners, dtype=INDPTR_DTYPE)
+    lo = np.asarray(lo, dtype=INDPTR_DTYPE)
+    hi = np.asarray(hi, dtype=INDPTR_DTYPE)
+    if not len(owners):
+        return owners, lo, hi
+    order = np.lexsort((lo, owners))
+    owners, lo, hi = owners[order], lo[order], hi[order]
+    # Running max of hi within each owner. Offsetting by owner keeps one owner's maxima from leaking into the next.
+    offset = (owners - owners[0]) * (int(hi.max()) + 2)
+    running_hi = np.maximum.accumulate(hi + offset) - offset
+    new_group = np.ones(len(owners), dtype=bool)
+    new_group[1:] = (owners[1:] != owners[:-1]) | (lo[1:] > running_hi[:-1] + 1)
+    starts = np.flatnonzero(new_group)
+    return owners[starts], lo[starts], np.maximum.reduceat(hi, starts)
+
+
+def topological_levels(
+    indptr: np.ndarray, indices: np.ndarray, rev_indptr: np.ndarray, rev_indices: np.ndarray
+) -> Tuple[List[np.ndarray], np.ndarray]:
+    """Group nodes by the length of the longest path reaching them from a root (a node without predecessors)
+
+    :return: (levels, leftover): levels[k] has the node indexes at longest-path depth k. leftover has the nodes on or
+    below a cycle, which never become ready; empty for a DAG."""
+    n = len(indptr) - 1
+    remaining = np.diff(rev_indptr)
+    frontier = np.flatnonzero(remaining == 0).astype(INDEX_DTYPE)
+    remaining = remaining.copy()
+    levels: List[np.ndarray] = []
+    n_seen = 0
+    while len(frontier):
+        levels.append(frontier)
+        n_seen += len(frontier)
+        _owners, children = csr_gather(indptr, indices, frontier)
+        children, counts = np.unique(children, return_counts=True)
+        remaining[children] -= counts
+        frontier = children[remaining[children] == 0].astype(INDEX_DTYPE)
+    leftover = np.empty(0, dtype=INDEX_DTYPE)
+    if n_seen < n:
+        seen = np.zeros(n, dtype=bool)
+        for level in levels:
+            seen[level] = True
+        leftover = np.flatnonzero(~seen).astype(INDEX_DTYPE)
+    return levels, leftover
+
+
+class IntervalLabels:
+    """Interval labels for one direction of the graph. Node indexes are those of the CompactConceptGraph.
+
+    - order: node index at each preorder number
+    - pre: preorder number of each node index
+    - label_indptr / label_lo / label_hi: CSR of each node's sorted, disjoint, closed preorder intervals
+    - level: longest path length from a root to each node (-1 for nodes on or below a cycle)"""
+
+    ARRAYS = ('order', 'pre', 'label_indptr', 'label_lo', 'label_hi', 'level')
+
+    def __init__(
+        self, order: np.ndarray, pre: np.ndarray, label_indptr: np.ndarray, label_lo: np.ndarray,
+        label_hi: np.ndarray, level: np.ndarray
+    ):
+        self.order = order
+        self.pre = pre
+        self.label_indptr = label_indptr
+        self.label_lo = label_lo
+        self.label_hi = label_hi
+        self.level = level
+
+    @classmethod
+    def build(
+        cls, indptr: np.ndarray, indices: np.ndarray, rev_indptr: np.ndarray, rev_indices: np.ndarray
+    ) -> 'IntervalLabels':
+        """Build labels for reachability along (indptr, indices). (rev_indptr, rev_indices) is the reverse adjacency."""
+        n = len(indptr) - 1
+        levels, leftover = topological_levels(indptr, indices, rev_indptr, rev_indices)
+        if len(leftover):
+            warnings.warn(f'Graph has cycles: reachability of {len(leftover)} nodes on or below them may be incomplete')
+        level = np.full(n, -1, dtype=INDEX_DTYPE)
+        for i, nodes in enumerate(levels):
+            level[nodes] = i
+
+        # Spanning forest: each node's first parent, if that parent is in the acyclic part of the graph
+        tree_parent = np.full(n, -1, dtype=INDPTR_DTYPE)
+        has_parent = np.diff(rev_indptr) > 0
+        tree_parent[has_parent] = rev_indices[rev_indptr[:-1][has_parent]]
+        tree_parent[leftover] = -1
+        # Depth in the forest. All tree siblings share it, so they can be numbered together.
+        tree_depth = np.zeros(n, dtype=INDPTR_DTYPE)
+        for nodes in levels[1:]:
+            tree_depth[nodes] = tree_depth[tree_parent[nodes]] + 1
+        tree_levels: List[np.ndarray] = np.split(np.argsort(tree_depth, kind='stable'),
+                                                 np.cumsum(np.bincount(tree_depth))[:-1]) if n else []
+
+        # Subtree sizes, bottom up; then preorder numbers, top down
+        size = np.ones(n, dtype=INDPTR_DTYPE)
+        for nodes in reversed(tree_levels[1:]):
+            np.add.at(size, tree_parent[nodes], size[nodes])
+        pre = np.empty(n, dtype=INDPTR_DTYPE)
+        for i, nodes in enumerate(tree_levels):
+            parents = tree_parent[nodes]
+            sort = np.argsort(parents, kind='stable')
+            nodes, parents = nodes[sort], parents[sort]
+            sizes = size[nodes]
+            preceding = np.cumsum(sizes) - sizes  # total size of the nodes before each one in this level
+            if i == 0:  # forest roots
+                pre[nodes] = preceding
+                continue
+            sibling_starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+            first_sibling = np.repeat(sibling_starts, np.diff(np.r_[sibling_starts, len(nodes)]))
+            pre[nodes] = pre[parents] + 1 + preceding - preceding[first_sibling]
+        order = np.empty(n, dtype=INDEX_DTYPE)
+        order[pre] = np.arange(n, dtype=INDEX_DTYPE)
+
+        # Labels, children before parents. Stored in a growing buffer, located by label_start / label_count.
+        label_start = np.zeros(n, dtype=INDPTR_DTYPE)
+        label_count = np.zeros(n, dtype=INDPTR_DTYPE)
+        buf_lo = np.empty(max(2 * n, 1), dtype=INDPTR_DTYPE)
+        buf_hi = np.empty(max(2 * n, 1), dtype=INDPTR_DTYPE)
+        buf_len = 0
+        for nodes in [leftover] + list(reversed(levels)):
+            owners, children = csr_gather(indptr, indices, nodes)
+            segment, positions = expand_ranges(label_start[children], label_count[children])
+            owners, lo, hi = merge_intervals(
+                np.concatenate([nodes, owners[segment]]),
+                np.concatenate([pre[nodes], buf_lo[positions]]),
+                np.concatenate([pre[nodes] + size[nodes] - 1, buf_hi[positions]]))
+            if not len(lo):
+                continue
+            if buf_len + len(lo) > len(buf_lo):
+                new_size = max(2 * len(buf_lo), buf_len + len(lo))
+                buf_lo, buf_hi = np.resize(buf_lo, new_size), np.resize(buf_hi, new_size)
+            buf_lo[buf_len:buf_len + len(lo)] = lo
+            buf_hi[buf_len:buf_len + len(hi)] = hi
+            first = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+            label_start[owners[first]] = buf_len + first
+            label_count[owners[first]] = np.diff(np.r_[first, len(owners)])
+            buf_len += len(lo)
+
+        # Compact into CSR, in node index order
+        label_indptr = np.zeros(n + 1, dtype=INDPTR_DTYPE)
+        np.cumsum(label_count, out=label_indptr[1:])
+        _segment, positions = expand_ranges(label_start, label_count)
+        return cls(order, pre.astype(INDEX_DTYPE), label_indptr, buf_lo[positions].astype(INDEX_DTYPE),
+                   buf_hi[positions].astype(INDEX_DTYPE), level)
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> 'IntervalLabels':
+        """Labels from the arrays returned by arrays(). Arrays are used as-is, not copied."""
+        return cls(*(arrays[name] for name in cls.ARRAYS))
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """All arrays of the labels, by name"""
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the labels"""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    def reachable(self, nodes: np.ndarray) -> np.ndarray:
+        """Node indexes reachable from any of `nodes`, including `nodes` themselves. Sorted by preorder number."""
+        starts = self.label_indptr[nodes]
+        _segment, positions = expand_ranges(starts, self.label_indptr[nodes + 1] - starts)
+        _owners, lo, hi = merge_intervals(
+            np.zeros(len(positions)), self.label_lo[positions], self.label_hi[positions])
+        _segment, preorder_numbers = expand_ranges(lo, hi - lo + 1)
+        return self.order[preorder_numbers]
+
+    def is_reachable(self, source: int, target: int) -> bool:
+        """Is node index target reachable from node index source (or the same node)?"""
+        start, end = self.label_indptr[source], self.label_indptr[source + 1]
+        target_pre = self.pre[target]
+        i = start + np.searchsorted(self.label_lo[start:end], target_pre, side='right') - 1
+        return bool(i >= start and self.label_hi[i] >= target_pre)
+
+
+class ReachabilityIndex:
+    """Descendant / ancestor queries over a CompactConceptGraph. Inputs and outputs are concept_ids."""
+
+    def __init__(self, g: CompactConceptGraph, labels: IntervalLabels):
+        self.g = g
+        self.labels = labels
+
+    @classmethod
+    def build(cls, g: CompactConceptGraph) -> 'ReachabilityIndex':
+        """Build the index for g"""
+        return cls(g, IntervalLabels.build(g.indptr, g.indices, g.rev_indptr, g.rev_indices))
+
+    @classmethod
+    def for_graph(cls, g: CompactConceptGraph) -> 'ReachabilityIndex':
+        """Index for g: from the labels stored in g.indexes, e.g. mmapped from its snapshot, if there; else built"""
+        stored = {name: g.indexes.get(INDEX_NAME_PREFIX + name) for name in IntervalLabels.ARRAYS}
+        if all(arr is not None for arr in stored.values()) and len(stored['order']) == len(g):
+            return cls(g, IntervalLabels.from_arrays(stored))
+        return cls.build(g)
+
+    def store(self):
+        """Store the labels in g.indexes, so they are saved with g's snapshot"""
+        self.g.indexes.update({INDEX_NAME_PREFIX + k: v for k, v in self.labels.arrays().items()})
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}(nodes={len(self.g)}, intervals={len(self.labels.label_lo)})'
+
+    @property
+    def depth(self) -> np.ndarray:
+        """Length of the longest path from a root to each node, by node index"""
+        return self.labels.level
+
+    def descendants(self, concept_ids: IdsLike, include_self=False, max_depth: int = None) -> np.ndarray:
+        """All descendants of any of concept_ids, as sorted concept_ids.
+
+        :param include_self: Include concept_ids themselves. Otherwise, a concept_id is included only if it descends
+        from another one.
+        :param max_depth: Only descendants at most this many edges away"""
+        nodes = np.unique(self.g.to_index(concept_ids))
+        if max_depth is not None:
+            found, _depths = bfs_closure(self.g.indptr, self.g.indices, nodes, include_self, max_depth)
+            return np.sort(self.g.node_ids[found])
+        if not include_self:  # everything reachable from a node's children is reachable from it by a path of 1+
+            _owners, nodes = csr_gather(self.g.indptr, self.g.indices, nodes)
+        return np.sort(self.g.node_ids[self.labels.reachable(np.unique(nodes))])
+
+    def ancestors(self, concept_ids: IdsLike, include_self=False, max_depth: int = None) -> np.ndarray:
+        """All ancestors of any of concept_ids, as sorted concept_ids. Parameters as for descendants()."""
+        nodes = np.unique(self.g.to_index(concept_ids))
+        found, _depths = bfs_closure(self.g.rev_indptr, self.g.rev_indices, nodes, include_self, max_depth)
+        return np.sort(self.g.node_ids[found])
+
+    def is_ancestor(self, ancestor_id: int, descendant_id: int) -> bool:
+        """Is ancestor_id a (strict) ancestor of descendant_id?"""
+        idx = self.g.to_index([ancestor_id, descendant_id])
+        if len(idx) < 2 or idx[0] == idx[1]:
+            return False
+        return self.labels.is_reachable(idx[0], idx[1])
+
+
+def bfs_levels(
+    indptr: np.ndarray, indices: np.ndarray, start: np.ndarray, max_depth: int = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Breadth-first search from start, at most max_depth edges deep (unlimited if None). One vectorized step per level.
+
+    :return: (nodes, depths): every node reached, and its shortest distance from start"""
+    found = [np.unique(np.asarray(start, dtype=INDEX_DTYPE))]
+    depths = [np.zeros(len(found[0]), dtype=INDEX_DTYPE)]
+    visited = found[0]
+    frontier = found[0]
+    depth = 0
+    while len(frontier) and (max_depth is None or depth < max_depth):
+        depth += 1
+        _owners, children = csr_gather(indptr, indices, frontier)
+        frontier = np.setdiff1d(np.unique(children), visited, assume_unique=True).astype(INDEX_DTYPE)
+        found.append(frontier)
+        depths.append(np.full(len(frontier), depth, dtype=INDEX_DTYPE))
+        visited = np.union1d(visited, frontier)
+    return np.concatenate(found), np.concatenate(depths)
+
+
+def bfs_closure(
+    indptr: np.ndarray, indices: np.ndarray, nodes: np.ndarray, include_self: bool, max_depth: int = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Like bfs_levels(), but if not include_self, only nodes reachable by a path of at least one edge are returned.
+
+    Searching from the neighbors of `nodes` keeps a query node that is reachable from another query node."""
+    if include_self:
+        return bfs_levels(indptr, indices, nodes, max_depth)
+    if max_depth is not None and max_depth < 1:
+        return np.empty(0, dtype=INDEX_DTYPE), np.empty(0, dtype=INDEX_DTYPE)
+    _owners, neighbors = csr_gather(indptr, indices, nodes)
+    found, depths = bfs_levels(indptr, indices, neighbors, None if max_depth is None else max_depth - 1)
+    return found, depths + 1
@@ -0,0 +1,132 @@
+"""Versioned, memory-mapped on-disk snapshots of the concept graph
+
+Replaces pickling. Unpickling the graph took many seconds at import time and gave every worker process its own copy.
+A snapshot is opened with `mmap` instead: loading is near-instant and zero-copy, and because the arrays are read-only
+views of the file, the OS page cache shares them across all gunicorn/uvicorn workers.
+
+File layout (little-endian):
+- 8 bytes: MAGIC
+- uint32: FORMAT_VERSION
+- uint32: length of the JSON header, in bytes
+- JSON header: `meta` (e.g. vocab_version, last_refreshed_vocab_tables) and the dtype / shape / offset of each array
+- Raw array data, starting on the first ALIGNMENT byte boundary after the header. Each array is aligned too.
+"""
+import json
+import mmap
+import os
+import shutil
+import struct
+from datetime import datetime
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from backend.graph.compact_graph import CompactConceptGraph
+
+MAGIC = b'THGRAPH\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct('<8sII')
+
+
+class SnapshotFormatError(ValueError):
+    """File is not a concept graph snapshot, or has an unsupported format version"""
+
+
+def _align(n: int) -> int:
+    """Round up to the next multiple of ALIGNMENT"""
+    return -(-n // ALIGNMENT) * ALIGNMENT
+
+
+def write_graph_snapshot(g: CompactConceptGraph, path: str, meta: Dict[str, Any] = None) -> Dict[str, Any]:
+    """Write graph to a snapshot file.
+
+    Writes to a temporary file first and then renames it, so readers never see a partially written snapshot.
+    :param meta: JSON-serializable metadata to store in the header. Defaults to g.meta.
+    :return: The header that was written"""
+    meta = dict(g.meta if meta is None else meta)
+    meta.setdefault('created_at', datetime.now().isoformat())
+    arrays: Dict[str, np.ndarray] = {k: np.ascontiguousarray(v) for k, v in g.arrays().items()}
+
+    # Array offsets are relative to the start of the data section, which begins at the first aligned byte after the
+    #  header
+    layout: Dict[str, Dict] = {}
+    offset = 0
+    for name, arr in arrays.items():
+        layout[name] = {'dtype': arr.dtype.newbyteorder('<').str, 'shape': list(arr.shape), 'offset': offset}
+        offset = _align(offset + arr.nbytes)
+    header = {'meta': meta, 'arrays': layout}
+    header_bytes = json.dumps(header).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, arr in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(arr.astype(layout[name]['dtype'], copy=False).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return header
+
+
+def previous_snapshot_path(path: str) -> str:
+    """Where the snapshot at path is kept when it is replaced by one of a new vocab version"""
+    return f'{path}.previous'
+
+
+def keep_previous_snapshot(path: str):
+    """Keep the snapshot at path as the previous one, before it's replaced. A hard link where possible, so that no data
+    is copied: replacing the snapshot then only unlinks the old file's original name."""
+    if not os.path.isfile(path):
+        return
+    tmp_path = f'{previous_snapshot_path(path)}.tmp{os.getpid()}'
+    try:
+        os.link(path, tmp_path)
+    except OSError:  # e.g. a file system without hard links
+        shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, previous_snapshot_path(path))
+
+
+def _read_header(f) -> Tuple[Dict[str, Any], int]:
+    """Read and validate the preamble and header. Returns (header, offset of the data section)."""
+    preamble = f.read(_PREAMBLE.size)
+    if len(preamble) < _PREAMBLE.size:
+        raise SnapshotFormatError('File too short to be a graph snapshot')
+    magic, version, header_len = _PREAMBLE.unpack(preamble)
+    if magic != MAGIC:
+        raise SnapshotFormatError('Not a graph snapshot: bad magic bytes')
+    if version != FORMAT_VERSION:
+        raise SnapshotFormatError(f'Unsupported graph snapshot format version {version}; expected {FORMAT_VERSION}')
+    return json.loads(f.read(header_len).decode('utf-8')), _align(_PREAMBLE.size + header_len)
+
+
+def read_snapshot_header(path: str) -> Dict[str, Any]:
+    """Read only the header of a snapshot. Cheap: does not touch the array data."""
+    with open(path, 'rb') as f:
+        return _read_header(f)[0]
+
+
+def read_snapshot_meta(path: str) -> Dict[str, Any]:
+    """Read the `meta` section of a snapshot's header"""
+    return read_snapshot_header(path)['meta']
+
+
+def read_graph_snapshot(path: str) -> CompactConceptGraph:
+    """Open a snapshot via mmap. The graph's arrays are read-only, zero-copy views of the file."""
+    with open(path, 'rb') as f:
+        header, data_start = _read_header(f)
+        # The mapping stays open after the file is closed, for as long as any array references it
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays: Dict[str, np.ndarray] = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        if not count:  # an empty array at the end of the file can have an offset past EOF
+            arrays[name] = np.empty(spec['shape'], dtype=dtype)
+            continue
+        arr = np.frombuffer(mm, dtype=dtype, count=count, offset=data_start + spec['offset'])
+        arrays[name] = arr.reshape(spec['shape'])
+    return CompactConceptGraph.from_arrays(arrays, header['meta'])
@@ -0,0 +1,72 @@
+"""Per-concept hierarchy statistics, as arrays by node index, computed when the graph is built
+
+- depth: Length of the longest path from a root (as `concept_ancestor_plus.a_depth`)
+- n_children: Number of direct children
+- n_descendants: Number of descendants, at any distance
+- root: Node index of the root of the concept's hierarchy, reached via first parents (lowest concept_id). Concepts
+  with several roots are listed under that one.
+
+All come from the reachability index at no extra traversal: n_descendants is the total length of a node's label
+intervals, less itself, and the roots' preorder intervals tile all node numbers, so a node's root is found by binary
+search on its preorder number. They are stored in g.indexes, and so in the snapshot, so requests never need a DB
+aggregation for them.
+"""
+from typing import Any, Dict
+
+import numpy as np
+
+from backend.graph.compact_graph import INDEX_DTYPE, CompactConceptGraph, IdsLike
+from backend.graph.reachability import ReachabilityIndex
+
+STATS = ('depth', 'n_children', 'n_descendants', 'root')
+INDEX_NAME_PREFIX = 'stats_'
+
+
+def compute_concept_stats(index: ReachabilityIndex) -> Dict[str, np.ndarray]:
+    """Stats of every node of index.g, by node index"""
+    g, labels = index.g, index.labels
+    lengths = (labels.label_hi - labels.label_lo + 1).astype(np.int64)
+    cumulative = np.concatenate([[0], np.cumsum(lengths)])
+    n_reachable = cumulative[labels.label_indptr[1:]] - cumulative[labels.label_indptr[:-1]]
+
+    # Roots of the labels' spanning forest: nodes without parents, and nodes on or below cycles (see IntervalLabels)
+    root_pre = np.sort(labels.pre[(g.in_degree() == 0) | (labels.level == -1)])
+    roots = labels.order[root_pre]
+    root = roots[np.searchsorted(root_pre, labels.pre, side='right') - 1]
+
+    return {
+        'depth': index.depth.astype(INDEX_DTYPE, copy=False),
+        'n_children': g.out_degree().astype(INDEX_DTYPE),
+        'n_descendants': (n_reachable - 1).astype(INDEX_DTYPE),
+        'root': root.astype(INDEX_DTYPE),
+    }
+
+
+def store_concept_stats(g: CompactConceptGraph, stats: Dict[str, np.ndarray]):
+    """Store stats in g.indexes, so they are saved with g's snapshot"""
+    g.indexes.update({INDEX_NAME_PREFIX + k: v for k, v in stats.items()})
+
+
+def has_concept_stats(g: CompactConceptGraph) -> bool:
+    """Are g's stats stored in g.indexes? Not for snapshots from before they were."""
+    stored = [g.indexes.get(INDEX_NAME_PREFIX + name) for name in STATS]
+    return all(arr is not None and len(arr) == len(g) for arr in stored)
+
+
+def get_concept_stats(index: ReachabilityIndex) -> Dict[str, np.ndarray]:
+    """Stats of index.g: those stored in g.indexes, e.g. mapped from its snapshot, if there; else computed"""
+    g = index.g
+    if has_concept_stats(g):
+        return {name: g.indexes[INDEX_NAME_PREFIX + name] for name in STATS}
+    return compute_concept_stats(index)
+
+
+def concept_stats(g: CompactConceptGraph, stats: Dict[str, np.ndarray], concept_ids: IdsLike) -> Dict[int, Dict]:
+    """Stats of concept_ids. Concepts not in g are left out.
+
+    :returns Map of concept_id to its stats. root is a concept_id."""
+    idx = g.to_index(concept_ids)
+    columns: Dict[str, Any] = {name: stats[name][idx].tolist() for name in STATS}
+    columns['root'] = g.node_ids[stats['root'][idx]].tolist()
+    return {concept_id: {name: columns[name][i] for name in STATS}
+            for i, concept_id in enumerate(g.node_ids[idx].tolist())}
@@ -0,0 +1,39 @@
+"""In-process metrics: counters and gauges, reported by the /metrics route
+
+Metrics are per process. Under gunicorn, each worker keeps and reports its own; the `pid` in the report says which.
+"""
+import os
+import threading
+from collections import defaultdict
+from typing import Any, Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+_gauges: Dict[str, float] = {}
+_collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def incr(name: str, value: float = 1):
+    """Increment a counter"""
+    with _lock:
+        _counters[name] += value
+
+
+def set_gauge(name: str, value: float):
+    """Set a gauge to its current value"""
+    with _lock:
+        _gauges[name] = value
+
+
+def register_collector(name: str, collector: Callable[[], Dict[str, Any]]):
+    """Register a function whose output is included in the report under `name`, e.g. a cache's stats()"""
+    _collectors[name] = collector
+
+
+def get_metrics() -> Dict[str, Any]:
+    """Report of all metrics"""
+    with _lock:
+        report: Dict[str, Any] = {'pid': os.getpid(), 'counters': dict(_counters), 'gauges': dict(_gauges)}
+    for name, collector in _collectors.items():
+        report[name] = collector()
+    return report
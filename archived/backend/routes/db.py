@@ -14,14 +14,15 @@ from typing import Dict, List, Union, Set, Optional
 import pandas as pd
 from fastapi import APIRouter, Query, Request
 from fastapi.responses import StreamingResponse
-from psycopg2 import sql
 from sqlalchemy import Connection, Row, text
+from sqlalchemy.sql.elements import TextClause
 from sqlalchemy.engine import RowMapping
 from starlette.responses import Response
 
 from backend.api_logger import Api_logger, get_ip_from_request, API_CALL_LOGGING_ON
-from backend.db.queries import get_concepts
-from backend.db.utils import get_db_connection, sql_query, SCHEMA, sql_query_single_col, sql_in, sql_in_safe, run_sql
+from backend.db.queries import async_get_concepts, get_concepts
+from backend.db.utils import async_sql_query, async_sql_query_single_col, get_async_db_connection, \
+    get_db_connection, quote_identifier, sql_query, SCHEMA, sql_query_single_col, sql_in, sql_in_safe, run_sql
 from backend.utils import return_err_with_trace, commify, recs2dicts, call_github_action
 from enclave_wrangler.config import RESEARCHER_COLS
 from enclave_wrangler.models import convert_rows
@@ -51,15 +52,28 @@ router = APIRouter(
 #       probably don't need precision etc.
 #       switched _container suffix on duplicate col names to container_ prefix
 #       joined OMOPConceptSet in the all_csets ddl to get `rid`
+CSETS_QUERY = """
+  SELECT *
+  FROM all_csets
+  WHERE codeset_id = ANY(:codeset_ids);"""
+
+
 def get_csets(codeset_ids: List[int]) -> List[Dict]:
     """Get information about concept sets the user has selected"""
     with get_db_connection() as con:
-        rows: List = sql_query(
-            con, """
-              SELECT *
-              FROM all_csets
-              WHERE codeset_id = ANY(:codeset_ids);""",
-            {'codeset_ids': codeset_ids})
+        rows: List = sql_query(con, CSETS_QUERY, {'codeset_ids': codeset_ids})
+    return csets_with_researchers(rows)
+
+
+async def async_get_csets(codeset_ids: List[int]) -> List[Dict]:
+    """Async counterpart of get_csets(), for async routes"""
+    async with get_async_db_connection() as con:
+        rows: List = await async_sql_query(con, CSETS_QUERY, {'codeset_ids': codeset_ids})
+    return csets_with_researchers(rows)
+
+
+def csets_with_researchers(rows: List[RowMapping]) -> List[Dict]:
+    """all_csets rows as dicts, each with its researchers' roles"""
     row_dicts: List[Dict] = [dict(x) for x in rows]
     for row in row_dicts:
         row['researchers'] = get_row_researcher_ids_dict(row)
@@ -124,27 +138,9 @@ def get_cset_members_items(
         item: True if its an expression item, else false
         csm: false if not in concept set members
     """
-    if column and columns:
-        raise ValueError('Cannot specify both columns and column')
-
+    query: TextClause = cset_members_items_query(columns, column)
+    params = {'codeset_ids': codeset_ids or []}
     with (get_db_connection() as con):
-        where = f" WHERE codeset_id = ANY(:codeset_ids)"
-        params = {'codeset_ids': codeset_ids or []}
-
-        if column:
-            columns = [column]
-
-        if columns:
-            select = sql.SQL("SELECT DISTINCT {}" + " FROM cset_members_items").format(
-                sql.SQL(', ').join(map(sql.Identifier, columns)),
-                sql.SQL(', ').join(sql.Placeholder() * len(columns)))
-            # noinspection PyUnresolvedReferences false_positive
-            select = select.as_string(con.connection.connection)
-        else:
-            select = "SELECT * FROM cset_members_items"
-
-        query = text(select + where)
-
         if column:  # with single column, don't return List[Dict] but just List(<column>)
             res: List = sql_query_single_col(con, query, params)
         else:
@@ -153,6 +149,34 @@ def get_cset_members_items(
     return res
 
 
+async def async_get_cset_members_items(
+    codeset_ids: Union[List[int], None] = None,
+    columns: Union[List[str], None] = None,
+    column: Union[str, None] = None,
+    return_with_keys: bool = True,
+) -> Union[List[int], List]:
+    """Async counterpart of get_cset_members_items(), for async routes"""
+    query: TextClause = cset_members_items_query(columns, column)
+    params = {'codeset_ids': codeset_ids or []}
+    async with get_async_db_connection() as con:
+        if column:
+            return await async_sql_query_single_col(con, query, params)
+        return await async_sql_query(con, query, params, return_with_keys=return_with_keys)
+
+
+def cset_members_items_query(columns: Union[List[str], None] = None, column: Union[str, None] = None) -> TextClause:
+    """Query for get_cset_members_items()"""
+    if column and columns:
+        raise ValueError('Cannot specify both columns and column')
+    if column:
+        columns = [column]
+    if columns:
+        select = f"SELECT DISTINCT {', '.join(quote_identifier(c) for c in columns)} FROM cset_members_items"
+    else:
+        select = "SELECT * FROM cset_members_items"
+    return text(select + " WHERE codeset_id = ANY(:codeset_ids)")
+
+
 @router.get("/get-cset-members-items")
 async def _get_cset_members_items(
     request: Request,
@@ -167,7 +191,7 @@ async def _get_cset_members_items(
     await rpt.start_rpt(request, params={'codeset_ids': requested_codeset_ids})
 
     try:
-        rows = get_cset_members_items(requested_codeset_ids, columns, column, return_with_keys)
+        rows = await async_get_cset_members_items(requested_codeset_ids, columns, column, return_with_keys)
         await rpt.finish(rows=len(rows))
     except Exception as e:
         await rpt.log_error(e)
@@ -252,7 +276,7 @@ async def get_concepts_route(request: Request, id: List[str] = Query(...), table
     await rpt.start_rpt(request, params={'concept_ids': id})
 
     try:
-        rows = get_concepts(concept_ids=id, table=table)
+        rows = await async_get_concepts(concept_ids=id, table=table)
         await rpt.finish(rows=len(rows))
     except Exception as e:
         await rpt.log_error(e)
@@ -357,7 +381,7 @@ async def _get_csets(
     await rpt.start_rpt(request, params={'codeset_ids': requested_codeset_ids})
 
     try:
-        csets = get_csets(requested_codeset_ids)
+        csets = await async_get_csets(requested_codeset_ids)
         await rpt.finish(rows=len(csets))
     except Exception as e:
         await rpt.log_error(e)
@@ -1,118 +1,394 @@
 """Graph related functions and routes"""
-import os, warnings
-import dateutil.parser as dp
-from datetime import datetime
+import asyncio, functools, hashlib, json, multiprocessing, os, threading, time, warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Any, Iterable, List, Set, Tuple, Union, Dict, Optional
-
-import pickle
-import networkx as nx
-from fastapi import APIRouter, Query, Request
-from networkx import DiGraph
-from sqlalchemy import Row, RowMapping
-from sqlalchemy.sql import text
-
-from backend.routes.db import get_cset_members_items
-from backend.db.queries import get_concepts
-from backend.db.utils import check_db_status_var, get_db_connection, SCHEMA
+from typing import Any, List, Set, Tuple, Union, Dict, Optional
+
+import numpy as np
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy import RowMapping
+
+from backend.cache import ResponseCache
+from backend.graph.attributes import STANDARD, VOCAB_CODE, has_concept_attributes, hidden_concepts, \
+    set_concept_attributes
+from backend.graph.compact_graph import ATTR_PREFIX, CompactConceptGraph
+from backend.graph.diff import diff_graphs
+from backend.graph.delta import EdgeDelta, apply_edge_delta, catch_up, clear_delta_log, compute_edge_delta, \
+    latest_delta_version, write_delta
+from backend.graph.expansion import MapsToIndex, expand_csets, expand_expression
+from backend.graph.layout import DEFAULT_LAYOUT_PARAMS, graph_hash, layered_layout
+from backend.graph.lca import connecting_subgraph
+from backend.graph.reachability import ReachabilityIndex
+from backend.graph.ingest import ProgressCallback, copy_int8_columns, estimate_row_count
+from backend.graph.stats import compute_concept_stats, concept_stats, get_concept_stats, has_concept_stats, \
+    store_concept_stats
+from backend.graph.snapshot import SnapshotFormatError, keep_previous_snapshot, previous_snapshot_path, \
+    read_graph_snapshot, read_snapshot_header, read_snapshot_meta, write_graph_snapshot
+from backend.routes.db import async_get_cset_members_items
+from backend.db.queries import async_get_concepts, async_get_expression_items
+from backend.db.utils import check_db_status_var, check_db_status_vars, get_db_connection, sql_query_single_col, \
+    SCHEMA
 from backend.api_logger import Api_logger
+from backend.metrics import incr, register_collector, set_gauge
 from backend.utils import get_timer, commify
 
 VERBOSE = False
 PROJECT_DIR = Path(os.path.dirname(__file__)).parent.parent
 VOCABS_PATH = os.path.join(PROJECT_DIR, 'termhub-vocab')
-GRAPH_PATH = os.path.join(VOCABS_PATH, 'relationship_graph.pickle')
+GRAPH_PATH = os.path.join(VOCABS_PATH, 'relationship_graph.bin')
 GRAPH_UNDIRECTED_PATH = os.path.join(VOCABS_PATH, 'relationship_graph_undirected.pickle')
 
+# Graph readiness
+# REL_GRAPH is loaded in a background thread at app startup (see start_graph_loading()), so that the server, and routes
+# that don't need the graph, come up right away. Until it's loaded, graph routes return 503 with Retry-After.
+REL_GRAPH: Optional[CompactConceptGraph] = None
+GRAPH_READY = threading.Event()
+GRAPH_RETRY_AFTER_SECONDS = 15
+_graph_loader: List[Optional[threading.Thread]] = [None]
+_graph_loader_lock = threading.Lock()
+_graph_load_error: List[Optional[str]] = [None]
+_graph_load_started_at: List[Optional[float]] = [None]
+_graph_load_phase: List[Optional[str]] = [None]
+
+
+def graph_status() -> Dict[str, Any]:
+    """Readiness of REL_GRAPH, for /ready"""
+    loader = _graph_loader[0]
+    started = _graph_load_started_at[0]
+    loading = loader is not None and loader.is_alive()
+    return {
+        'ready': GRAPH_READY.is_set(),
+        'loading': loading,
+        'phase': _graph_load_phase[0] if loading else None,
+        'error': _graph_load_error[0],
+        'seconds_since_load_started': round(time.monotonic() - started, 1) if started is not None else None,
+    }
+
+
+def require_graph():
+    """Dependency of all graph routes: 503 until REL_GRAPH is loaded. If loading failed, it is retried."""
+    if GRAPH_READY.is_set():
+        return
+    if _graph_load_error[0] is not None:
+        start_graph_loading()
+    raise HTTPException(
+        status_code=503, detail={'message': 'Concept graph is still loading', **graph_status()},
+        headers={'Retry-After': str(GRAPH_RETRY_AFTER_SECONDS)})
+
+
 router = APIRouter(
     responses={404: {"description": "Not found"}},
+    dependencies=[Depends(require_graph)],
 )
 
 
+# Version of the data /concept-graph responses are derived from. Looking it up queries the DB, so it's held in memory,
+# and looked up again in a background thread at most every CONCEPT_GRAPH_VERSION_CHECK_SECONDS, never in a request.
+CONCEPT_GRAPH_VERSION_CHECK_SECONDS = 30
+_concept_graph_data_version: List[Optional[Tuple[Optional[str], Optional[str], int]]] = [None]
+_concept_graph_version_checker: List[Optional[threading.Thread]] = [None]
+_concept_graph_version_checked_at: List[float] = [-CONCEPT_GRAPH_VERSION_CHECK_SECONDS]
+_concept_graph_version_lock = threading.Lock()
+
+
+def check_concept_graph_data_version():
+    """Look up the DB refresh timestamps and the graph version, and hold them in memory. Runs in a background thread."""
+    try:
+        status: Dict[str, Optional[str]] = check_db_status_vars(['last_refreshed_vocab_tables', 'last_refresh_success'])
+        graph_version: int = sync_rel_graph().meta.get('graph_version', 0)
+    except Exception as err:
+        warnings.warn(f'Failed to check /concept-graph data version: {type(err).__name__}: {err}')
+        return
+    _concept_graph_data_version[0] = (
+        status['last_refreshed_vocab_tables'], status['last_refresh_success'], graph_version)
+
+
+def get_concept_graph_data_version() -> Optional[Tuple[Optional[str], Optional[str], int]]:
+    """Identifies the data /concept-graph responses are derived from: the DB refresh timestamps and the graph version
+
+    Doesn't block: returns the version last looked up, and if that's stale, starts a lookup in the background, whose
+    result a later call returns."""
+    with _concept_graph_version_lock:
+        checker = _concept_graph_version_checker[0]
+        now = time.monotonic()
+        if (checker is None or not checker.is_alive()) \
+                and now - _concept_graph_version_checked_at[0] >= CONCEPT_GRAPH_VERSION_CHECK_SECONDS:
+            _concept_graph_version_checked_at[0] = now
+            checker = threading.Thread(
+                target=check_concept_graph_data_version, name='concept-graph-version-checker', daemon=True)
+            _concept_graph_version_checker[0] = checker
+            checker.start()
+    return _concept_graph_data_version[0]
+
+
+# get_concept_graph_data_version() only reads memory, so the cache can check it on every lookup
+CONCEPT_GRAPH_CACHE = ResponseCache(
+    maxsize=256, ttl=6 * 60 * 60, get_version=get_concept_graph_data_version, version_check_interval=0)
+register_collector('concept_graph_cache', CONCEPT_GRAPH_CACHE.stats)
+
+
 @router.get("/concept-graph")
 async def concept_graph_get(
     request: Request, codeset_ids: Optional[List[int]] = Query(None), cids: Optional[List[int]] = Query(None),
     hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False, verbose = VERBOSE,
+    super_node_threshold: Optional[int] = None, layout: bool = False, include_stats: bool = False,
+    transitive_descendants: bool = False,
 ) -> Dict[str, Any]:
     """Return concept graph"""
     cids = cids if cids else []
-    return await concept_graph_post(request, codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose)
+    return await concept_graph_post(request, codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose,
+                                    super_node_threshold, layout, include_stats, transitive_descendants)
 
 
 @router.post("/concept-graph")
 async def concept_graph_post(
     request: Request, codeset_ids: List[int], cids: Union[List[int], None] = [],
     hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False, verbose = VERBOSE,
+    super_node_threshold: Optional[int] = None, layout: bool = False, include_stats: bool = False,
+    transitive_descendants: bool = False,
 ) -> Dict:
-    """Return concept graph via HTTP POST"""
+    """Return concept graph via HTTP POST
+
+    The graph has the codesets' concepts and their children.
+
+    :param super_node_threshold: If set, nodes with more children than this in the graph are condensed: their edges
+    to their children are left out, and they are listed in `super_nodes` with their child counts. Fetch their
+    children on demand via /expand-super-node.
+    :param layout: If true, also return a layered layout of the graph as returned (see graph_layout()), under
+    `layout`.
+    :param include_stats: If true, also return the hierarchy stats of each concept in the graph, as for
+    /concept-stats, under `concept_stats`.
+    :param transitive_descendants: If true, include all of the concepts' descendants, not just their children."""
     rpt = Api_logger()
     try:
         await rpt.start_rpt(request, params={'codeset_ids': codeset_ids, 'cids': cids})
+        response: Dict[str, Any] = await concept_graph_response(
+            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose, super_node_threshold, layout,
+            include_stats, transitive_descendants)
+        await rpt.finish(rows=len(response['concept_ids']))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+def concept_graph_cache_key(
+    codeset_ids: Union[List[int], None], cids: Union[List[int], None] = [], hide_vocabs = [],
+    hide_nonstandard_concepts=False, super_node_threshold: Optional[int] = None, layout=False, include_stats=False,
+    transitive_descendants=False
+) -> Tuple:
+    """Key of a /concept-graph response in CONCEPT_GRAPH_CACHE"""
+    hide_vocabs = hide_vocabs if isinstance(hide_vocabs, list) else []
+    return (tuple(sorted(set(codeset_ids or []))), tuple(sorted(set(cids or []))), tuple(sorted(set(hide_vocabs))),
+            bool(hide_nonstandard_concepts), super_node_threshold, bool(layout), bool(include_stats),
+            bool(transitive_descendants))
+
+
+async def concept_graph_response(
+    codeset_ids: Union[List[int], None], cids: Union[List[int], None] = [], hide_vocabs = [],
+    hide_nonstandard_concepts=False, verbose = VERBOSE, super_node_threshold: Optional[int] = None, layout=False,
+    include_stats=False, transitive_descendants=False
+) -> Dict[str, Any]:
+    """Get the /concept-graph response. Cached."""
+    hide_vocabs = hide_vocabs if isinstance(hide_vocabs, list) else []
+    cache_key = concept_graph_cache_key(
+        codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, super_node_threshold, layout, include_stats,
+        transitive_descendants)
+    found, response = CONCEPT_GRAPH_CACHE.get(cache_key)
+    if found:
+        return response
+
+    sg: CompactConceptGraph
+    hidden_by_voc: Dict[str, Set[int]]
+    nonstandard_concepts_hidden: Set[int]
+
+    sg, concept_ids, hidden_dict, nonstandard_concepts_hidden = await concept_graph(
+        codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose,
+        transitive_descendants=transitive_descendants)
+    missing_from_graph = set(concept_ids) - set(sg.nodes)
+
+    response = {
+        'edges': list(sg.edges),
+        'concept_ids': concept_ids,
+        'missing_from_graph': missing_from_graph,
+        'hidden_by_vocab': hidden_dict,
+        'nonstandard_concepts_hidden': nonstandard_concepts_hidden}
+    shown: CompactConceptGraph = sg
+    if super_node_threshold is not None:
+        edges, super_nodes = condense_super_nodes(sg, super_node_threshold)
+        response['edges'] = list(map(tuple, edges.tolist()))
+        response['super_nodes'] = super_nodes
+        shown = CompactConceptGraph.from_edges(edges[:, 0], edges[:, 1], sg.node_ids)
+    if layout:
+        response['layout'] = await graph_layout(shown)
+    if include_stats:
+        response['concept_stats'] = get_graph_concept_stats(sync_rel_graph(), sg.node_ids)
+    CONCEPT_GRAPH_CACHE.set(cache_key, response)
+    return response
+
 
-        hide_vocabs = hide_vocabs if isinstance(hide_vocabs, list) else []
-        sg: DiGraph
-        hidden_by_voc: Dict[str, Set[int]]
-        nonstandard_concepts_hidden: Set[int]
-
-        sg, concept_ids, hidden_dict, nonstandard_concepts_hidden = await concept_graph(
-            codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, verbose)
-        missing_from_graph = set(concept_ids) - set(sg.nodes)
-
-        await rpt.finish(rows=len(sg))
-        return {
-            'edges': list(sg.edges),
-            'concept_ids': concept_ids,
-            'missing_from_graph': missing_from_graph,
-            'hidden_by_vocab': hidden_dict,
-            'nonstandard_concepts_hidden': nonstandard_concepts_hidden}
+@router.post("/concept-graph-batch")
+async def concept_graph_batch(
+    request: Request, groups: Dict[str, List[int]], cids: List[int] = [],
+    hide_vocabs: List[str] = ['RxNorm Extension'], hide_nonstandard_concepts: bool = False,
+    super_node_threshold: Optional[int] = None, layout: bool = False, include_stats: bool = False,
+    transitive_descendants: bool = False,
+) -> Dict[str, Any]:
+    """Concept graph for several groups of codesets at once, e.g. for comparison views
+
+    The union of all groups' concepts is fetched, expanded and filtered once, into one subgraph with shared edges.
+    Otherwise, the response is like that of /concept-graph for all groups' codesets together.
+
+    :param groups: Map of group name to codeset_ids
+    :param cids: Extra concept_ids, added to every group
+    :returns also
+      groups: Map of group name to its concept_ids: the same as /concept-graph would return for its codesets alone"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'groups': groups, 'cids': cids})
+        response: Dict[str, Any] = await concept_graph_batch_response(
+            groups, cids, hide_vocabs, hide_nonstandard_concepts, super_node_threshold, layout, include_stats,
+            transitive_descendants)
+        await rpt.finish(rows=len(response['concept_ids']))
+        return response
     except Exception as e:
         await rpt.log_error(e)
         raise e
 
 
+async def concept_graph_batch_response(
+    groups: Dict[str, List[int]], cids: List[int] = [], hide_vocabs: List[str] = [],
+    hide_nonstandard_concepts=False, super_node_threshold: Optional[int] = None, layout=False, include_stats=False,
+    transitive_descendants=False
+) -> Dict[str, Any]:
+    """Get the /concept-graph-batch response. Cached."""
+    cache_key = ('batch', tuple(sorted((name, tuple(sorted(set(ids)))) for name, ids in groups.items())),
+                 tuple(sorted(set(cids))), tuple(sorted(set(hide_vocabs))), bool(hide_nonstandard_concepts),
+                 super_node_threshold, bool(layout), bool(include_stats), bool(transitive_descendants))
+    found, response = CONCEPT_GRAPH_CACHE.get(cache_key)
+    if found:
+        return response
+
+    codeset_ids: List[int] = sorted(set().union(*groups.values()))
+    members: List[RowMapping] = await async_get_cset_members_items(
+        codeset_ids=codeset_ids, columns=['codeset_id', 'concept_id', 'vocabulary_id', 'standard_concept'])
+    sg, concept_ids, hidden_by_voc, nonstandard_concepts_hidden = await concept_graph(
+        codeset_ids, cids, hide_vocabs, hide_nonstandard_concepts, members=members,
+        transitive_descendants=transitive_descendants)
+
+    members_by_codeset: Dict[int, Set[int]] = {}
+    for row in members:
+        members_by_codeset.setdefault(row['codeset_id'], set()).add(row['concept_id'])
+    group_members: Dict[str, Set[int]] = {
+        name: set(cids).union(*[members_by_codeset.get(codeset_id, set()) for codeset_id in ids])
+        for name, ids in groups.items()}
+    hidden: Set[int] = set().union(*hidden_by_voc.values()).union(nonstandard_concepts_hidden)
+
+    response = {
+        'edges': list(sg.edges),
+        'concept_ids': concept_ids,
+        'groups': group_concept_ids(sync_rel_graph(), group_members, hidden, transitive_descendants),
+        'missing_from_graph': set(concept_ids) - set(sg.nodes),
+        'hidden_by_vocab': hidden_by_voc,
+        'nonstandard_concepts_hidden': nonstandard_concepts_hidden}
+    shown: CompactConceptGraph = sg
+    if super_node_threshold is not None:
+        edges, super_nodes = condense_super_nodes(sg, super_node_threshold)
+        response['edges'] = list(map(tuple, edges.tolist()))
+        response['super_nodes'] = super_nodes
+        shown = CompactConceptGraph.from_edges(edges[:, 0], edges[:, 1], sg.node_ids)
+    if layout:
+        response['layout'] = await graph_layout(shown)
+    if include_stats:
+        response['concept_stats'] = get_graph_concept_stats(sync_rel_graph(), sg.node_ids)
+    CONCEPT_GRAPH_CACHE.set(cache_key, response)
+    return response
+
+
+def group_concept_ids(
+    g: CompactConceptGraph, group_members: Dict[str, Set[int]], hidden: Set[int], transitive=False
+) -> Dict[str, List[int]]:
+    """Concept ids of each group of a batch: its members that aren't hidden, and their children
+
+    :param group_members: Map of group name to the concept ids of its codesets' members, plus any extra cids
+    :param hidden: Concept ids hidden by vocab or non-standard status
+    :param transitive: If true, all of their descendants, not just their children
+    :returns Map of group name to sorted concept ids"""
+    groups: Dict[str, List[int]] = {}
+    for name, members in group_members.items():
+        seeds: Set[int] = members - hidden
+        groups[name] = sorted(seeds.union(get_all_descendants(g, seeds, transitive)))
+    return groups
+
+
 async def concept_graph(
     codeset_ids: Union[List[int], None], cids: Union[List[int], None] = [], hide_vocabs = [],
-    hide_nonstandard_concepts=False, verbose = VERBOSE, all_descendants = True
- ) -> Tuple[DiGraph, Set[int], Set[int], Dict[str, Set[int]], Set[int]]:
+    hide_nonstandard_concepts=False, verbose = VERBOSE, all_descendants = True,
+    members: Optional[List[RowMapping]] = None, transitive_descendants=False
+ ) -> Tuple[CompactConceptGraph, Set[int], Dict[str, Set[int]], Set[int]]:
     """Return concept graph
 
         concepts/concept_ids will include all definition and expansion concepts for codeset_ids
             plus any cids that are passed in
+    :param members: Members of codeset_ids, with concept_id, vocabulary_id and standard_concept, if already fetched
+    :param transitive_descendants: If true, add all descendants of the concepts, not just their children
     :returns
       hidden_by_voc: Map of vocab to set of concept ids"""
     timer = get_timer('')
     verbose and timer('concept_graph()')
 
     # Get concepts & metadata
-    concepts_unfiltered: List[RowMapping] = get_cset_members_items(
-        codeset_ids=codeset_ids, columns=['concept_id', 'vocabulary_id', 'standard_concept'])
+    concepts_unfiltered: List[RowMapping] = list(members) if members is not None else \
+        await async_get_cset_members_items(
+            codeset_ids=codeset_ids, columns=['concept_id', 'vocabulary_id', 'standard_concept'])
     concepts: List[Dict[str, Any]]
     hidden_by_voc: Dict[str, Set[int]]
     nonstandard_concepts_hidden: Set
 
+    rel_graph: CompactConceptGraph = sync_rel_graph()
+    use_attributes: bool = has_concept_attributes(rel_graph)
+    cid_ids_in_graph: List[int] = []
     if cids:
-        more_concepts = get_concepts(cids)
-        concepts_unfiltered.extend(more_concepts)
+        # Concepts in the graph are filtered via its attribute arrays; only the others need fetching
+        cid_ids_in_graph = rel_graph.node_ids[rel_graph.to_index(cids)].tolist() if use_attributes else []
+        cids_to_fetch = set(cids) - set(cid_ids_in_graph)
+        if cids_to_fetch:
+            more_concepts = await async_get_concepts(cids_to_fetch)
+            concepts_unfiltered.extend(more_concepts)
 
     # - filter: by vocab & non-standard
     concepts, hidden_by_voc, nonstandard_concepts_hidden = filter_concepts(
         concepts_unfiltered, hide_vocabs, hide_nonstandard_concepts)
     concept_ids: Set[int] = set([c['concept_id'] for c in concepts])
+    if cid_ids_in_graph:
+        hidden_by_voc_c, nonstandard_concepts_hidden_c = filter_concept_ids(
+            rel_graph, cid_ids_in_graph, hide_vocabs, hide_nonstandard_concepts)
+        hidden_c = set().union(*hidden_by_voc_c.values()).union(nonstandard_concepts_hidden_c)
+        concept_ids.update(set(cid_ids_in_graph) - hidden_c)
+        for voc, hidden in hidden_by_voc_c.items():
+            hidden_by_voc[voc] = hidden_by_voc.get(voc, set()).union(hidden)
+        nonstandard_concepts_hidden = nonstandard_concepts_hidden.union(nonstandard_concepts_hidden_c)
     # concept_ids.update(cids)  # future
 
     # 2024-10-22. What if we get all descendants, not just missing in between?
     # 2024-11-18. It's been working ok. Now getting rid of all missing-in-between stuff.
     #               Return to commit fdb472ee1bf14156e87c324f2d7297ea2df3601d to get it back.
-    more_concept_ids: Set[int] = get_all_descendants(REL_GRAPH, concept_ids)
+    more_concept_ids: Set[int] = get_all_descendants(rel_graph, concept_ids, transitive_descendants)
 
     # merge and filter
-    more_concepts: List[RowMapping] = get_concepts(more_concept_ids)
-    concepts_m: List[Dict]
     hidden_by_voc_m: Dict[str, Set[int]]
     nonstandard_concepts_hidden_m: Set
-    # - filter more_concepts: by vocab & non-standard
-    concepts_m, hidden_by_voc_m, nonstandard_concepts_hidden_m = filter_concepts(
-        more_concepts, hide_vocabs, hide_nonstandard_concepts)
+    # - filter more_concepts: by vocab & non-standard. Descendants are all in the graph, so no DB query is needed.
+    if use_attributes:
+        hidden_by_voc_m, nonstandard_concepts_hidden_m = filter_concept_ids(
+            rel_graph, more_concept_ids, hide_vocabs, hide_nonstandard_concepts)
+    else:  # graph loaded from a snapshot that predates attribute arrays
+        more_concepts: List[RowMapping] = await async_get_concepts(more_concept_ids)
+        _concepts_m, hidden_by_voc_m, nonstandard_concepts_hidden_m = filter_concepts(
+            more_concepts, hide_vocabs, hide_nonstandard_concepts)
 
     # Merge: more_concepts into concept_ids
     concept_ids.update(more_concept_ids)
@@ -121,24 +397,105 @@ async def concept_graph(
     nonstandard_concepts_hidden = nonstandard_concepts_hidden.union(nonstandard_concepts_hidden_m)
 
     # Get subgraph
-    sg: DiGraph = REL_GRAPH.subgraph(concept_ids)
+    sg: CompactConceptGraph = rel_graph.subgraph(concept_ids)
 
     # Return
     verbose and timer('done')
     return sg, concept_ids, hidden_by_voc, nonstandard_concepts_hidden
 
 
-def get_all_descendants(g: nx.DiGraph, subgraph_nodes: Union[List[int], Set[int]]) -> Set[int]:
+def get_all_descendants(
+    g: CompactConceptGraph, subgraph_nodes: Union[List[int], Set[int]], transitive=False
+) -> Set[int]:
     """Get all descendants of a set of nodes
 
     Using this instead of get_missing_in_between_nodes. this way the front end has the entire descendant tree for all
     concepts being looked at.
+    :param transitive: If false, only their children. If true, all descendants, via the reachability index.
     """
-    descendants: Set[int] = set()
-    for node in subgraph_nodes:
-        if g.has_node(node):
-            descendants.update(g.successors(node))
-    return descendants
+    if transitive:
+        return set(get_reachability_index(g).descendants(subgraph_nodes).tolist())
+    return g.successors_of(subgraph_nodes)
+
+
+_reachability_index: List[Optional[ReachabilityIndex]] = [None]
+
+
+def get_reachability_index(g: CompactConceptGraph) -> ReachabilityIndex:
+    """Reachability index for g. Taken from g's snapshot, or built, on first use, and again whenever g is replaced, e.g.
+    by sync_rel_graph()."""
+    if _reachability_index[0] is None or _reachability_index[0].g is not g:
+        _reachability_index[0] = ReachabilityIndex.for_graph(g)
+    return _reachability_index[0]
+
+
+@router.get("/concept-descendants")
+async def concept_descendants(
+    request: Request, concept_ids: List[int] = Query(...), max_depth: Optional[int] = None, include_self: bool = False
+) -> Dict[str, Any]:
+    """Get all descendants of concept_ids, or only those at most max_depth levels down"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'concept_ids': concept_ids, 'max_depth': max_depth})
+        descendants: List[int] = get_reachability_index(sync_rel_graph()).descendants(
+            concept_ids, include_self, max_depth).tolist()
+        await rpt.finish(rows=len(descendants))
+        return {'concept_ids': concept_ids, 'max_depth': max_depth, 'descendants': descendants}
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+@router.get("/concept-ancestors")
+async def concept_ancestors(
+    request: Request, concept_ids: List[int] = Query(...), max_depth: Optional[int] = None, include_self: bool = False
+) -> Dict[str, Any]:
+    """Get all ancestors of concept_ids, or only those at most max_depth levels up"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'concept_ids': concept_ids, 'max_depth': max_depth})
+        ancestors: List[int] = get_reachability_index(sync_rel_graph()).ancestors(
+            concept_ids, include_self, max_depth).tolist()
+        await rpt.finish(rows=len(ancestors))
+        return {'concept_ids': concept_ids, 'max_depth': max_depth, 'ancestors': ancestors}
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+_concept_stats: List[Optional[Tuple[CompactConceptGraph, Dict[str, np.ndarray]]]] = [None]
+
+
+def get_graph_concept_stats(g: CompactConceptGraph, concept_ids: Union[List[int], np.ndarray]) -> Dict[int, Dict]:
+    """Hierarchy stats of concept_ids in g (see backend.graph.stats). Taken from g's snapshot, or computed, on first
+    use, and again whenever g is replaced."""
+    if _concept_stats[0] is None or _concept_stats[0][0] is not g:
+        _concept_stats[0] = (g, get_concept_stats(get_reachability_index(g)))
+    return concept_stats(g, _concept_stats[0][1], concept_ids)
+
+
+@router.get("/concept-stats")
+async def concept_stats_get(request: Request, concept_ids: List[int] = Query(...)) -> Dict[str, Any]:
+    """Get hierarchy stats of concept_ids"""
+    return await concept_stats_post(request, concept_ids)
+
+
+@router.post("/concept-stats")
+async def concept_stats_post(request: Request, concept_ids: List[int]) -> Dict[str, Any]:
+    """Get hierarchy stats of concept_ids via HTTP POST, for long lists
+
+    :returns
+      concept_stats: Map of concept_id to its depth, number of children and descendants, and root concept_id
+      missing_from_graph: concept_ids not in the graph"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'concept_ids': concept_ids})
+        stats: Dict[int, Dict] = get_graph_concept_stats(sync_rel_graph(), concept_ids)
+        await rpt.finish(rows=len(stats))
+        return {'concept_stats': stats, 'missing_from_graph': sorted(set(concept_ids) - set(stats))}
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
 
 
 # TODO: @Siggie: move below to frontend
@@ -169,17 +526,15 @@ def filter_concepts(
     :param: concepts: List of concept ids as keys, and metadata as values.
     :returns
       hidden_by_voc: Map of vocab to set of concept ids"""
-    # Hide by vocabulary
+    # Hide by vocabulary & non-standard, in a single pass
+    hide_vocabs_set: Set[str] = set(hide_vocabs)
     hidden_by_voc: Dict[str, Set[int]] = {}
-    for vocab in hide_vocabs:  # for each vocab being hidden, separate out the concepts
-        hidden_i: Set[int] = set([c['concept_id'] for c in concepts if c['vocabulary_id'] == vocab])
-        if hidden_i:
-            hidden_by_voc[vocab] = hidden_i
-
-    # Hide non-standard concepts
-    nonstandard_concepts_hidden = set()
-    if hide_nonstandard_concepts:
-        nonstandard_concepts_hidden: Set[int] = set([c['concept_id'] for c in concepts if c['standard_concept'] != 'S'])
+    nonstandard_concepts_hidden: Set[int] = set()
+    for c in concepts:
+        if c['vocabulary_id'] in hide_vocabs_set:
+            hidden_by_voc.setdefault(c['vocabulary_id'], set()).add(c['concept_id'])
+        if hide_nonstandard_concepts and c['standard_concept'] != 'S':
+            nonstandard_concepts_hidden.add(c['concept_id'])
 
     # Get filtered concepts
     hidden_nodes = set().union(*list(hidden_by_voc.values())).union(nonstandard_concepts_hidden)
@@ -187,156 +542,776 @@ def filter_concepts(
     return filtered_concepts, hidden_by_voc, nonstandard_concepts_hidden
 
 
+def filter_concept_ids(
+    g: CompactConceptGraph, concept_ids: Union[List[int], Set[int]], hide_vocabs: List[str],
+    hide_nonstandard_concepts=False
+) -> Tuple[Dict[str, Set[int]], Set[int]]:
+    """Like filter_concepts(), but for concepts in g, using its attribute arrays instead of rows from the DB
+
+    :returns
+      hidden_by_voc: Map of vocab to set of concept ids
+      nonstandard_concepts_hidden: Set of concept ids"""
+    hidden_by_voc, nonstandard = hidden_concepts(g, concept_ids, hide_vocabs, hide_nonstandard_concepts)
+    return {k: set(v.tolist()) for k, v in hidden_by_voc.items()}, set(nonstandard.tolist())
+
+
 # print_stack = lambda s: ' | '.join([f"{n} => {','.join([str(x) for x in p])}" for n,p in s])
 # print_stack = lambda s: ' | '.join([f"{n} => {str(p)}" for n,p in s])
 # print_stack = lambda s: ' | '.join([f"""{n}{'=>' if p else ''}{','.join(p)}""" for n,p in reversed(s)])
 print_stack = lambda s: ' | '.join([f"{n} => {','.join([str(x) for x in p])}" for n,p in s])
 
 
+WHOLEGRAPH_CHUNK_EDGES = 65536
+WHOLEGRAPH_MEDIA_TYPES = {
+    'binary': 'application/octet-stream',
+    'ndjson': 'application/x-ndjson',
+    'json': 'application/json',
+}
+
+
+def graph_etag(g: CompactConceptGraph, fmt: str) -> str:
+    """Strong ETag for a representation of the whole graph. Changes whenever the graph's version does."""
+    version = g.meta.get('graph_version', 0)
+    vocab = g.meta.get('last_refreshed_vocab_tables') or g.meta.get('created_at') or ''
+    digest = hashlib.sha1(f'{version}|{vocab}|{g.number_of_edges()}'.encode('utf-8')).hexdigest()[:16]
+    return f'"graph-{version}-{digest}-{fmt}"'
+
+
+def wholegraph_response(
+    g: CompactConceptGraph, accept: str = '', if_none_match: str = '', chunk_size: int = WHOLEGRAPH_CHUNK_EDGES
+) -> Response:
+    """Stream all edges of g, a chunk at a time, in the format the Accept header asks for
+
+    Formats:
+    - application/octet-stream: Packed little-endian int32 (source_id, target_id) pairs, 8 bytes per edge
+    - application/x-ndjson: One [source_id, target_id] JSON array per line
+    - Otherwise JSON: A single array of [source_id, target_id] pairs, as this route has always returned
+    Returns 304 Not Modified if if_none_match has the current ETag."""
+    fmt = 'binary' if WHOLEGRAPH_MEDIA_TYPES['binary'] in accept \
+        else 'ndjson' if WHOLEGRAPH_MEDIA_TYPES['ndjson'] in accept else 'json'
+    etag = graph_etag(g, fmt)
+    headers = {'ETag': etag, 'Vary': 'Accept', 'Cache-Control': 'no-cache', 'X-Edge-Count': str(g.number_of_edges())}
+    if etag in [x.strip() for x in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+
+    def chunks():
+        """Encode edge chunks"""
+        first = True
+        for edges in g.iter_edge_chunks(chunk_size):
+            if fmt == 'binary':
+                yield edges.astype('<i4').tobytes()
+            elif fmt == 'ndjson':
+                yield ''.join(f'[{s},{t}]\n' for s, t in edges.tolist()).encode('utf-8')
+            else:
+                body = ','.join(f'[{s},{t}]' for s, t in edges.tolist())
+                yield (('[' if first else ',') + body).encode('utf-8')
+            first = False
+        if fmt == 'json':
+            yield b'[]' if first else b']'
+
+    if fmt == 'binary':
+        if len(g.node_ids) and g.node_ids[-1] > np.iinfo(np.int32).max:
+            raise ValueError('Concept ids exceed int32; the binary format cannot represent them')
+        headers['Content-Length'] = str(8 * g.number_of_edges())
+    return StreamingResponse(chunks(), media_type=WHOLEGRAPH_MEDIA_TYPES[fmt], headers=headers)
+
+
 @router.get("/wholegraph")
-def wholegraph():
-    """Get subgraph edges for the whole graph"""
-    return list(REL_GRAPH.edges)
+def wholegraph(request: Request) -> Response:
+    """Get subgraph edges for the whole graph
+
+    Streamed in chunks, so neither the server nor the client needs the whole payload in memory at once. Send
+    `Accept: application/octet-stream` for packed int32 pairs or `Accept: application/x-ndjson` for NDJSON; JSON
+    otherwise. Responses have a strong ETag, so clients can revalidate with If-None-Match instead of re-downloading."""
+    return wholegraph_response(
+        sync_rel_graph(), request.headers.get('accept', ''), request.headers.get('if-none-match', ''))
 
 
-def condense_super_nodes(sg, threshhold=10):  # todo
-    """Condense super nodes"""
-    super_nodes = [node for node, degree in sg.out_degree() if degree > threshhold]
-    # for node in super_nodes:
-    # sg.discard(node) -- n
-    return NotImplementedError(super_nodes)
+def condense_super_nodes(sg: CompactConceptGraph, threshold=10) -> Tuple[np.ndarray, Dict[int, int]]:
+    """Condense super nodes: nodes with more than `threshold` children in sg
+
+    :returns
+      edges: Edges of sg, as an (n, 2) array, minus those from super nodes to their children
+      super_nodes: Map of super node concept_id to its number of children in sg"""
+    out_degree: np.ndarray = sg.out_degree()
+    is_super: np.ndarray = out_degree > threshold
+    src, tgt = sg.edge_index_array()
+    keep = ~is_super[src]
+    edges = np.column_stack((sg.node_ids[src[keep]], sg.node_ids[tgt[keep]]))
+    super_idx = np.flatnonzero(is_super)
+    return edges, dict(zip(sg.node_ids[super_idx].tolist(), out_degree[super_idx].tolist()))
 
 
 # noinspection PyPep8Naming
-def expand_super_node(G, subgraph_nodes, super_node):  # todo
-    """Expand super node"""
-    # sg = G.subgraph(subgraph_nodes)
-    return NotImplementedError(G, subgraph_nodes, super_node)
-
-
-def from_pydot_layout(g):  # Todo
-    """From PyDot layout"""
-    return NotImplementedError(g)
-# def find_nearest_common_ancestor(G, nodes):
-#     all_ancestors = [set(nx.ancestors(G, node)) for node in nodes]
-#     common_ancestors = set.intersection(*all_ancestors)
-#
-#     # Find the lowest common ancestor
-#     lowest_common_ancestor = None
-#     for ancestor in common_ancestors:
-#         if all(ancestor in ancestors or ancestor == node for node, ancestors in zip(nodes, all_ancestors)):
-#             if lowest_common_ancestor is None or not ancestor in nx.ancestors(G, lowest_common_ancestor):
-#                 lowest_common_ancestor = ancestor
-#
-#     return lowest_common_ancestor
-#
-#
-# def connect_roots(G, target_nodes):
-#     # Find the nearest common ancestor
-#     nca = find_nearest_common_ancestor(G, target_nodes)
-#
-#     # Create a subgraph including the paths from the nearest common ancestor to the target nodes
-#     edges_to_include = set()
-#     for node in target_nodes:
-#         path = nx.shortest_path(G, nca, node)
-#         edges_to_include.update([tuple(l) for l in zip(path, path[1:])])
-#
-#     SG = G.edge_subgraph(edges_to_include).copy()
-#     return SG
-
-
-def generate_graph_edges() -> Iterable[Row]:
-    """Generate graph edges"""
+def expand_super_node(
+    G: CompactConceptGraph, super_node: int, subgraph_nodes: Optional[Union[List[int], Set[int]]] = None,
+    offset=0, limit=100
+) -> Dict[str, Any]:
+    """Expand super node: get a page of its children, sorted by concept_id
+
+    :param subgraph_nodes: If given, only children in these nodes are returned, e.g. those of a condensed subgraph.
+    :returns Dict with the page of children, and the total number of children. child_counts has the number of children
+    of each child in G, so the caller can tell which of them are super nodes themselves."""
+    children: np.ndarray = G.successors(super_node)
+    if subgraph_nodes is not None:
+        children = children[np.isin(children, np.fromiter(subgraph_nodes, dtype=children.dtype))]
+    page: np.ndarray = children[offset:offset + limit]
+    child_counts: np.ndarray = G.out_degree()[G.to_index(page)]
+    return {
+        'concept_id': super_node,
+        'total': len(children),
+        'offset': offset,
+        'limit': limit,
+        'children': page.tolist(),
+        'child_counts': dict(zip(page.tolist(), child_counts.tolist())),
+    }
+
+
+@router.get("/expand-super-node")
+async def expand_super_node_route(
+    request: Request, concept_id: int, codeset_ids: Optional[List[int]] = Query(None),
+    cids: Optional[List[int]] = Query(None), hide_vocabs = ['RxNorm Extension'], hide_nonstandard_concepts=False,
+    super_node_threshold: Optional[int] = None, layout: bool = False, include_stats: bool = False,
+    transitive_descendants: bool = False, offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=10_000),
+) -> Dict[str, Any]:
+    """Get a page of the children of a super node, as condensed by /concept-graph.
+
+    If codeset_ids or cids are given, children are limited to those in the /concept-graph response for the same
+    parameters. Otherwise, all of concept_id's children are returned.
+
+    :param super_node_threshold, layout, include_stats: As passed to /concept-graph, so that its cached response is
+    used, rather than computed again. They don't change which children are returned.
+    :param transitive_descendants: As passed to /concept-graph."""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'concept_id': concept_id, 'codeset_ids': codeset_ids, 'offset': offset})
+        subgraph_nodes: Optional[Set[int]] = None
+        if codeset_ids or cids:
+            found, response = CONCEPT_GRAPH_CACHE.get(concept_graph_cache_key(
+                codeset_ids, cids or [], hide_vocabs, hide_nonstandard_concepts, super_node_threshold, layout,
+                include_stats, transitive_descendants))
+            if not found:  # only its concept_ids are needed, so no layout or stats
+                response = await concept_graph_response(
+                    codeset_ids, cids or [], hide_vocabs, hide_nonstandard_concepts,
+                    super_node_threshold=super_node_threshold, transitive_descendants=transitive_descendants)
+            subgraph_nodes = response['concept_ids']
+        page: Dict[str, Any] = expand_super_node(sync_rel_graph(), concept_id, subgraph_nodes, offset, limit)
+        await rpt.finish(rows=len(page['children']))
+        return page
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+LAYOUT_WORKERS = int(os.getenv('TERMHUB_LAYOUT_WORKERS', 2))
+LAYOUT_CACHE = ResponseCache(maxsize=128, ttl=24 * 60 * 60)
+register_collector('layout_cache', LAYOUT_CACHE.stats)
+_layout_pool: List[Optional[ProcessPoolExecutor]] = [None]
+
+
+def get_layout_pool() -> ProcessPoolExecutor:
+    """Process pool for layouts. Created on first use. Spawned rather than forked, as this process has threads."""
+    if _layout_pool[0] is None:
+        _layout_pool[0] = ProcessPoolExecutor(LAYOUT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _layout_pool[0]
+
+
+async def graph_layout(g: CompactConceptGraph, **params) -> Dict[str, Any]:
+    """Layered layout of g (see layout.py). Computed in the layout process pool, so it never blocks the event loop.
+    Cached by g's nodes and edges, and the layout params.
+
+    :param params: Overrides of DEFAULT_LAYOUT_PARAMS"""
+    params = {**DEFAULT_LAYOUT_PARAMS, **params}
+    cache_key = (graph_hash(g), tuple(sorted(params.items())))
+    found, layout = LAYOUT_CACHE.get(cache_key)
+    if found:
+        return layout
+    t0 = time.monotonic()
+    try:
+        layout = await asyncio.get_running_loop().run_in_executor(
+            get_layout_pool(), functools.partial(layered_layout, g, **params))
+    except BrokenProcessPool:
+        _layout_pool[0] = None  # a worker died; start a new pool next time
+        raise
+    incr('layout_seconds', time.monotonic() - t0)
+    incr('layouts_computed')
+    LAYOUT_CACHE.set(cache_key, layout)
+    return layout
+
+
+_previous_graph_index: List[Optional[Tuple[float, ReachabilityIndex]]] = [None]
+
+
+def get_previous_graph_index(graph_path: str = GRAPH_PATH) -> Optional[ReachabilityIndex]:
+    """Reachability index of the snapshot of the previous vocab version, mapped on first use. None if there is none."""
+    path = previous_snapshot_path(graph_path)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    if _previous_graph_index[0] is None or _previous_graph_index[0][0] != mtime:
+        _previous_graph_index[0] = (mtime, ReachabilityIndex.for_graph(read_graph_snapshot(path)))
+    return _previous_graph_index[0][1]
+
+
+@router.get("/vocab-diff")
+async def vocab_diff(request: Request, codeset_ids: List[int] = Query(...)) -> Dict[str, Any]:
+    """How the hierarchy below the members of codeset_ids changed since the previous vocab version
+
+    See diff_graphs() for the response, which also has from_vocab_version and to_vocab_version. 404 if no snapshot of
+    a previous vocab version has been kept."""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'codeset_ids': codeset_ids})
+        old: Optional[ReachabilityIndex] = get_previous_graph_index()
+        if old is None:
+            raise HTTPException(status_code=404, detail='No graph of a previous vocab version to diff against')
+        new: ReachabilityIndex = get_reachability_index(sync_rel_graph())
+        concept_ids: List[int] = await async_get_cset_members_items(
+            codeset_ids, column='concept_id', return_with_keys=False)
+        response = {
+            'from_vocab_version': old.g.meta.get('vocab_version'),
+            'to_vocab_version': new.g.meta.get('vocab_version'),
+            **diff_graphs(old, new, concept_ids)}
+        await rpt.finish(rows=len(response['edges_added']) + len(response['edges_removed']))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+class ExpressionItem(BaseModel):
+    """Schema of an expression item, as in concept_set_version_item"""
+    concept_id: int
+    includeDescendants: bool = False
+    includeMapped: bool = False
+    isExcluded: bool = False
+
+
+@router.post("/expand-expression")
+async def expand_expression_route(
+    request: Request, items: List[ExpressionItem] = [], codeset_ids: List[int] = []
+) -> Dict[str, Any]:
+    """Expand expression items into concept set members locally, without waiting for the enclave to do it
+
+    :param items: Expression items of one concept set version, e.g. a draft being edited
+    :param codeset_ids: Concept set versions whose stored expression items to expand, each separately
+    :returns
+      concept_ids: Members from `items`
+      excluded: Concepts that the exclusion items of `items` removed or kept out
+      members: Map of each of codeset_ids to its members"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'items': len(items), 'codeset_ids': codeset_ids})
+        g: CompactConceptGraph = sync_rel_graph()
+        index: ReachabilityIndex = get_reachability_index(g)
+        maps_to: MapsToIndex = await async_get_maps_to_index(g)
+        members, excluded = expand_expression(index, maps_to, [item.dict() for item in items])
+        cset_members: Dict[int, np.ndarray] = {codeset_id: np.empty(0) for codeset_id in codeset_ids}
+        if codeset_ids:
+            cset_members.update(expand_csets(index, maps_to, await async_get_expression_items(codeset_ids)))
+        response = {
+            'concept_ids': members.tolist(),
+            'excluded': excluded.tolist(),
+            'members': {codeset_id: ids.tolist() for codeset_id, ids in cset_members.items()}}
+        await rpt.finish(rows=len(members) + sum(len(ids) for ids in cset_members.values()))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+@router.get("/connecting-subgraph")
+async def connecting_subgraph_route(request: Request, concept_ids: List[int] = Query(...)) -> Dict[str, Any]:
+    """Get a small tree joining concept_ids via their lowest common ancestor(s), e.g. to show how the roots of
+    several concept sets relate, without pulling in all of their descendants"""
+    rpt = Api_logger()
+    try:
+        await rpt.start_rpt(request, params={'concept_ids': concept_ids})
+        response: Dict[str, Any] = connecting_subgraph(get_reachability_index(sync_rel_graph()), concept_ids)
+        await rpt.finish(rows=len(response['edges']))
+        return response
+    except Exception as e:
+        await rpt.log_error(e)
+        raise e
+
+
+def get_graph_edges(progress_callback: Optional[ProgressCallback] = None) -> np.ndarray:
+    """Get all graph edges as an (n_edges, 2) array of (source_id, target_id), streamed via binary COPY
+
+    :param progress_callback: Called as `progress_callback(rows_loaded, estimated_total_rows)` as rows arrive."""
     with get_db_connection() as con:
-        # moving the sql to ddl-20-concept_graph.jinja.sql
+        # the edges themselves are defined in ddl-19-concept_graph.jinja.sql
+        query = f"""
+            SELECT source_id::int8, target_id::int8
+            FROM {SCHEMA}.concept_graph
+            WHERE source_id IS NOT NULL AND target_id IS NOT NULL"""
+        expected_rows = estimate_row_count(con, f'{SCHEMA}.concept_graph')
+        return copy_int8_columns(con, query, 2, expected_rows, progress_callback)
+
 
+def get_maps_to_edges() -> np.ndarray:
+    """Get all "Maps to" relationships as an (n, 2) array of (concept_id_1, concept_id_2), streamed via binary COPY"""
+    with get_db_connection() as con:
         query = f"""
-        SELECT * FROM {SCHEMA}.concept_graph
-        """
+            SELECT concept_id_1::int8, concept_id_2::int8
+            FROM {SCHEMA}.concept_relationship
+            WHERE relationship_id = 'Maps to' AND concept_id_1 != concept_id_2"""
+        return copy_int8_columns(con, query, 2)
+
+
+_maps_to_index: List[Optional[MapsToIndex]] = [None]
+_maps_to_index_lock = threading.Lock()
+
 
-        result = con.execute(text(query))
+def _is_maps_to_index_current(g: CompactConceptGraph) -> bool:
+    """Is the "Maps to" index loaded, and of the vocab version of g?"""
+    return _maps_to_index[0] is not None and _maps_to_index[0].meta.get('vocab_version') == g.meta.get('vocab_version')
 
-        for row in result:
-            yield row
+
+def get_maps_to_index(g: CompactConceptGraph) -> MapsToIndex:
+    """"Maps to" index for the vocab version of g. Loaded by the graph loader, and again when g is of a new vocab
+    version. Loading it queries the DB, so call async_get_maps_to_index() from async routes."""
+    with _maps_to_index_lock:
+        if not _is_maps_to_index_current(g):
+            vocab_version: Optional[str] = g.meta.get('vocab_version')
+            _maps_to_index[0] = MapsToIndex.from_edges(get_maps_to_edges(), {'vocab_version': vocab_version})
+        return _maps_to_index[0]
+
+
+async def async_get_maps_to_index(g: CompactConceptGraph) -> MapsToIndex:
+    """get_maps_to_index(), loading it, if need be, in a thread, so it never blocks the event loop"""
+    if _is_maps_to_index_current(g):
+        return _maps_to_index[0]
+    return await asyncio.get_running_loop().run_in_executor(None, get_maps_to_index, g)
+
+
+def get_concept_attributes(
+    progress_callback: Optional[ProgressCallback] = None
+) -> Tuple[List[str], np.ndarray]:
+    """Get the vocabulary and standard status of every concept in the graph, via binary COPY
+
+    :return: (vocabularies, rows): vocabularies are the vocabulary_ids, sorted. rows is an (n, 3) array of
+    (concept_id, vocab_code, is_standard), where vocab_code is a 1-based position in vocabularies."""
+    with get_db_connection() as con:
+        vocabularies: List[str] = sql_query_single_col(
+            con, f"SELECT DISTINCT vocabulary_id FROM {SCHEMA}.vocabulary ORDER BY vocabulary_id")
+        vocab_array = 'ARRAY[' + ', '.join(["'" + v.replace("'", "''") + "'" for v in vocabularies]) + ']::text[]'
+        query = f"""
+            SELECT c.concept_id::int8,
+                COALESCE(array_position({vocab_array}, c.vocabulary_id::text), 0)::int8,
+                (c.standard_concept IS NOT DISTINCT FROM 'S')::int::int8
+            FROM {SCHEMA}.concept c
+            WHERE EXISTS (SELECT 1 FROM {SCHEMA}.concept_graph cg WHERE cg.source_id = c.concept_id)
+               OR EXISTS (SELECT 1 FROM {SCHEMA}.concept_graph cg WHERE cg.target_id = c.concept_id)"""
+        return vocabularies, copy_int8_columns(con, query, 3, progress_callback=progress_callback)
+
+
+def load_concept_attributes(g: CompactConceptGraph):
+    """Load concept attribute arrays (vocab, standard status) onto g. See attributes.py."""
+    vocabularies, rows = get_concept_attributes()
+    set_concept_attributes(g, vocabularies, rows)
+
+
+def get_vocab_version() -> Optional[str]:
+    """Get the OMOP vocabulary version, as recorded in the 'None' row of the vocabulary table"""
+    with get_db_connection() as con:
+        versions: List[str] = sql_query_single_col(
+            con, "SELECT vocabulary_version FROM vocabulary WHERE vocabulary_id = 'None'")
+    return versions[0] if versions else None
+
+
+def get_graph_version_meta() -> Dict[str, Optional[str]]:
+    """Get the values that identify which vocab a graph was built from. Stored in the snapshot header."""
+    return {
+        'vocab_version': get_vocab_version(),
+        'last_refreshed_vocab_tables': check_db_status_var('last_refreshed_vocab_tables'),
+    }
+
+
+def _stream_graph_edges() -> np.ndarray:
+    """Stream all edges from the DB, printing progress"""
+    report_every = 1_000_000
+    reported = [0]
+
+    def progress(n_rows: int, n_expected: int):
+        """Report progress every report_every rows"""
+        if n_rows - reported[0] >= report_every:
+            reported[0] = n_rows
+            print(f'   - {commify(n_rows)} of ~{commify(n_expected)} edges loaded')
+
+    return get_graph_edges(progress)
+
+
+def keep_previous_vocab_snapshot(graph_path: str, meta: Dict[str, Any]):
+    """If the snapshot at graph_path is of another vocab version than meta's, keep it as the previous snapshot, for
+    /vocab-diff, before it's replaced"""
+    try:
+        vocab_version = read_snapshot_meta(graph_path).get('vocab_version')
+    except (OSError, SnapshotFormatError):
+        return
+    if vocab_version != meta.get('vocab_version'):
+        keep_previous_snapshot(graph_path)
+
+
+def _snapshot_graph_version(graph_path: str) -> int:
+    """graph_version of the snapshot at graph_path, or 0 if there is no readable snapshot"""
+    try:
+        return read_snapshot_meta(graph_path).get('graph_version', 0)
+    except (OSError, SnapshotFormatError):
+        return 0
+
+
+def build_graph_indexes(g: CompactConceptGraph):
+    """Build g's reachability index and concept stats, and store them in g.indexes, to be saved with its snapshot"""
+    index = ReachabilityIndex.build(g)
+    index.store()
+    store_concept_stats(g, compute_concept_stats(index))
 
 
 # todo: control verbosity?
-def create_rel_graphs(save_to_pickle: bool) -> DiGraph:
+def create_rel_graphs(save_snapshot: bool, graph_path: str = GRAPH_PATH) -> CompactConceptGraph:
     """Create relationship graphs"""
     timer = get_timer('create_rel_graphs')
 
-    timer('get edge records')
-    edge_generator = generate_graph_edges()
+    # Get version first: if the vocab is refreshed mid-build, the snapshot will look outdated rather than current
+    meta = get_graph_version_meta()
+    meta['graph_version'] = _snapshot_graph_version(graph_path) + 1
+    timer('streaming edge records')
+    edges: np.ndarray = _stream_graph_edges()
+
+    timer(f'building graph from {commify(len(edges))} edges')
+    # noinspection PyPep8Naming
+    G = CompactConceptGraph.from_edges(edges[:, 0], edges[:, 1], meta=meta)
+    timer('loading concept attributes')
+    load_concept_attributes(G)
+
+    if save_snapshot:
+        timer('building reachability index and concept stats')
+        build_graph_indexes(G)
+        timer(f'saving snapshot to {graph_path}')
+        # Deltas from before a full rebuild can't be replayed onto it
+        clear_delta_log(graph_path)
+        keep_previous_vocab_snapshot(graph_path, meta)
+        write_graph_snapshot(G, graph_path)
+
+    timer('done')
+    return G
+
+
+def update_rel_graph(g: CompactConceptGraph, save_snapshot: bool, graph_path: str = GRAPH_PATH) -> CompactConceptGraph:
+    """Update a relationship graph to the current vocab by applying only the edges added / removed since it was built
 
+    The applied delta is written to the delta log before the new snapshot, so other processes can catch up via
+    sync_rel_graph() even if the snapshot can't be read."""
+    timer = get_timer('update_rel_graph')
+    meta = get_graph_version_meta()
+    meta['graph_version'] = max(g.meta.get('graph_version', 0), _snapshot_graph_version(graph_path)) + 1
+    timer('streaming edge records')
+    edges: np.ndarray = _stream_graph_edges()
+
+    timer('computing delta')
+    delta: EdgeDelta = compute_edge_delta(g, edges)
+    delta.meta = {
+        'from_version': g.meta.get('graph_version', 0), 'to_version': meta['graph_version'],
+        'from_vocab_version': g.meta.get('vocab_version'), 'to_vocab_version': meta['vocab_version']}
+    timer(f'applying delta: {commify(len(delta.added))} edges added, {commify(len(delta.removed))} removed')
     # noinspection PyPep8Naming
-    G = nx.DiGraph()
-    if save_to_pickle:
-        msg = 'loading and pickling'
-        pickle_file = open(GRAPH_PATH, 'ab')
-    else:
-        msg = 'loading'
-        pickle_file = None
-
-    timer(msg)
-    rownum = 0
-    chunk_size = 10000
-    msg = msg.replace('ing', 'ed')
-    edges = []
-    chunks_loaded = 0
-    for source, target in edge_generator:
-        edges.append((source, target))
-        rownum += 1
-        if rownum >= chunk_size:
-            chunks_loaded += 1
-            G.add_edges_from(edges)
-            edges = []
-            if chunks_loaded % 100 == 0:
-                timer(f'{commify(chunks_loaded * chunk_size)} rows {msg}')
-            rownum = 0
-
-    if save_to_pickle:
-        timer('saving to pickle')
-        pickle.dump(G, pickle_file)  # , pickle.HIGHEST_PROTOCOL
+    G = apply_edge_delta(g, delta, meta)
+    # Attributes may have changed even for concepts whose edges didn't, e.g. a concept became non-standard
+    timer('loading concept attributes')
+    load_concept_attributes(G)
+
+    if save_snapshot:
+        timer('building reachability index and concept stats')
+        build_graph_indexes(G)
+        timer(f'saving delta and snapshot to {graph_path}')
+        write_delta(graph_path, meta['graph_version'], delta)
+        keep_previous_vocab_snapshot(graph_path, meta)
+        write_graph_snapshot(G, graph_path)
 
     timer('done')
-    return G # , Gu
+    return G
 
 
 def is_graph_up_to_date(graph_path: str = GRAPH_PATH) -> bool:
-    """Determine if the networkx relationship_graph derived from OMOP vocab is current"""
-    voc_last_updated = dp.parse(check_db_status_var('last_refreshed_vocab_tables'))
-    graph_last_updated = datetime.fromtimestamp(os.path.getmtime(graph_path))
-    if voc_last_updated.tzinfo and not graph_last_updated.tzinfo:  # if one has timezone, both need
-        graph_last_updated = graph_last_updated.replace(tzinfo=voc_last_updated.tzinfo)
-    return graph_last_updated > voc_last_updated
+    """Determine if the relationship_graph snapshot derived from OMOP vocab is current
+
+    Compares the vocab refresh timestamp recorded in the snapshot header when it was built against the current one.
+    File mtimes aren't used: they change on copy / checkout and say nothing about which vocab the graph came from."""
+    if not os.path.isfile(graph_path):
+        return False
+    try:
+        header = read_snapshot_header(graph_path)
+    except SnapshotFormatError as err:
+        warnings.warn(f'{graph_path}: {err}; will rebuild')
+        return False
+    graph_meta = header['meta']
+    if not all(ATTR_PREFIX + attr in header['arrays'] for attr in (VOCAB_CODE, STANDARD)):
+        return False  # predates concept attribute arrays
+    graph_vocab_refreshed = graph_meta.get('last_refreshed_vocab_tables')
+    return graph_vocab_refreshed is not None and \
+        graph_vocab_refreshed == check_db_status_var('last_refreshed_vocab_tables')
 
 
 # noinspection PyPep8Naming for_G
-def load_relationship_graph(graph_path: str = GRAPH_PATH, update_if_outdated=True, save=True) -> DiGraph:
-    """Load relationship graph from disk"""
+def load_relationship_graph(
+    graph_path: str = GRAPH_PATH, update_if_outdated=True, save=True, incremental=True
+) -> CompactConceptGraph:
+    """Load relationship graph from disk
+
+    :param incremental: If the snapshot is outdated, update it by applying the vocab's edge delta rather than
+    rebuilding from scratch."""
     timer = get_timer('./load_relationship_graph')
     timer(f'loading {graph_path}')
     up_to_date = True if not update_if_outdated else is_graph_up_to_date(graph_path)
-    if os.path.isfile(graph_path) and up_to_date:
-        with open(graph_path, 'rb') as pickle_file:
-            G: DiGraph = pickle.load(pickle_file)
-    else:
-        G: DiGraph = create_rel_graphs(save)
+    G: Optional[CompactConceptGraph] = None
+    if os.path.isfile(graph_path):
+        try:
+            G = read_graph_snapshot(graph_path)
+        except SnapshotFormatError:
+            pass  # is_graph_up_to_date() has warned already
+    if G is None:
+        G = create_rel_graphs(save, graph_path)
+    elif not up_to_date:
+        G = update_rel_graph(G, save, graph_path) if incremental else create_rel_graphs(save, graph_path)
     timer('done')
     return G
 
 
-LOAD_FROM_PICKLE = False
-LOAD_RELGRAPH = True
+_rel_graph_snapshot_mtime: List[float] = [0.0]
+_rel_graph_sync_lock = threading.Lock()
+
+
+# Shared graph mode
+# Under gunicorn, the master process publishes the snapshot (gunicorn_config.py), and every worker maps that same file
+# read-only, reachability index included. Graph memory is then shared via the OS page cache, so doesn't grow with the
+# number of workers. Refreshes write a new snapshot and atomically rename it into place; workers swap to it on their
+# next request, while requests in flight keep using the old mapping.
+# Publishing runs in a process the master spawns, so boot doesn't wait on it, and the master has no threads, which could
+# hold locks when it forks workers. It records how it went in a status file, whose path workers get in
+# GRAPH_PUBLISH_STATUS_ENV_VAR. Workers' loaders wait for the outcome (/ready says so), then map the published snapshot,
+# or, if publishing failed, load the graph themselves, as without gunicorn. The publisher process then checks every
+# GRAPH_REFRESH_CHECK_SECONDS whether the vocab was refreshed, and if so, publishes a new snapshot.
+SHARED_GRAPH_ENV_VAR = 'TERMHUB_SHARED_GRAPH'
+GRAPH_PUBLISH_STATUS_ENV_VAR = 'TERMHUB_GRAPH_PUBLISH_STATUS'
+GRAPH_REFRESH_CHECK_SECONDS = 5 * 60
+GRAPH_PUBLISH_WAIT_SECONDS = 30 * 60
+GRAPH_PUBLISH_POLL_SECONDS = 1.0
 
-if __name__ == '__main__':
-    pass
-else:
-    # if you don't want graph loaded, then somewhere up in the import tree, do this
-    #   import builtins
-    #   builtins.DONT_LOAD_GRAPH = True
+
+def is_shared_graph_mode() -> bool:
+    """Are workers to attach to a snapshot published by another process, rather than load / update it themselves?"""
+    return os.getenv(SHARED_GRAPH_ENV_VAR, '').lower() in ('1', 'true', 'yes')
+
+
+def publish_rel_graph(graph_path: str = GRAPH_PATH) -> CompactConceptGraph:
+    """Bring the snapshot at graph_path up to date, with its reachability index and concept stats, for workers to
+    map"""
+    G: CompactConceptGraph = load_relationship_graph(graph_path, save=True)
+    if not has_concept_stats(G):  # snapshot from before indexes / stats were stored in it
+        build_graph_indexes(G)
+        write_graph_snapshot(G, graph_path)
+    return G
+
+
+def watch_rel_graph(
+    graph_path: str = GRAPH_PATH, interval: float = GRAPH_REFRESH_CHECK_SECONDS, status_path: Optional[str] = None
+):
+    """Republish the snapshot whenever the vocab is refreshed. Checks every `interval` seconds, forever."""
+    while True:
+        time.sleep(interval)
+        try:
+            up_to_date = is_graph_up_to_date(graph_path)
+        except Exception as err:
+            incr('graph_publish_errors')
+            warnings.warn(f'Failed to check relationship graph version: {type(err).__name__}: {err}')
+            continue
+        if not up_to_date:
+            _publish_rel_graph(graph_path, status_path)
+
+
+def write_publish_status(status_path: str, state: str, error: Optional[str] = None):
+    """Record the state of publishing: 'publishing', 'published' or 'failed'. Written atomically, as workers poll it."""
+    tmp_path = f'{status_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'state': state, 'error': error, 'pid': os.getpid(), 'time': time.time()}, f)
+    os.replace(tmp_path, status_path)
+
+
+def read_publish_status(status_path: str) -> Dict[str, Any]:
+    """State of publishing, as written by write_publish_status(); 'unknown' if unreadable"""
+    try:
+        with open(status_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'state': 'unknown', 'error': None}
+
+
+def _publish_rel_graph(graph_path: str, status_path: Optional[str] = None) -> bool:
+    """publish_rel_graph(), recording the outcome in status_path, if given. Errors are warned about, not raised.
+
+    :returns whether the snapshot was published"""
+    try:
+        publish_rel_graph(graph_path)
+    except Exception as err:
+        error = f'{type(err).__name__}: {err}'
+        incr('graph_publish_errors')
+        warnings.warn(f'Failed to publish relationship graph: {error}')
+        if status_path:
+            write_publish_status(status_path, 'failed', error)
+        return False
+    if status_path:
+        write_publish_status(status_path, 'published')
+    return True
+
+
+def run_graph_publisher(
+    graph_path: str = GRAPH_PATH, status_path: Optional[str] = None, interval: float = GRAPH_REFRESH_CHECK_SECONDS
+):
+    """Publish the snapshot, then republish it whenever the vocab is refreshed. Runs in the publisher process."""
+    _publish_rel_graph(graph_path, status_path)
+    watch_rel_graph(graph_path, interval, status_path)
+
+
+def start_graph_publishing(
+    graph_path: str = GRAPH_PATH, status_path: Optional[str] = None, interval: float = GRAPH_REFRESH_CHECK_SECONDS
+) -> multiprocessing.Process:
+    """Start the publisher process. Called in the gunicorn master, before workers are forked: they inherit
+    GRAPH_PUBLISH_STATUS_ENV_VAR, and wait for the outcome. See: wait_for_published_graph()
+
+    The process is spawned rather than forked, so it doesn't inherit the master's state, and starts no threads in the
+    master.
+
+    :returns the publisher process"""
+    status_path = status_path or f'{graph_path}.publish-status.json'
+    write_publish_status(status_path, 'publishing')
+    os.environ[GRAPH_PUBLISH_STATUS_ENV_VAR] = status_path  # only once workers can read the status
+    publisher = multiprocessing.get_context('spawn').Process(
+        target=run_graph_publisher, args=(graph_path, status_path, interval), name='rel-graph-publisher', daemon=True)
+    publisher.start()
+    return publisher
+
+
+def wait_for_published_graph(timeout: float = GRAPH_PUBLISH_WAIT_SECONDS) -> bool:
+    """If another process is publishing the snapshot, wait for it. If it was published, turns on shared graph mode for
+    this process. Runs in the loader thread.
+
+    :returns whether to map the published snapshot, rather than load the graph ourselves"""
+    if is_shared_graph_mode():
+        return True
+    status_path = os.getenv(GRAPH_PUBLISH_STATUS_ENV_VAR)
+    if not status_path:
+        return False
+    _graph_load_phase[0] = 'waiting for the graph to be published'
+    deadline = time.monotonic() + timeout
+    status = read_publish_status(status_path)
+    while status['state'] == 'publishing' and time.monotonic() < deadline:
+        time.sleep(GRAPH_PUBLISH_POLL_SECONDS)
+        status = read_publish_status(status_path)
+    if status['state'] != 'published':
+        warnings.warn(f'Relationship graph was not published ({status["state"]}: {status.get("error")}); '
+                      f'loading it in this process')
+        return False
+    os.environ[SHARED_GRAPH_ENV_VAR] = '1'
+    return True
+
+
+def sync_rel_graph(graph_path: str = GRAPH_PATH) -> CompactConceptGraph:
+    """Bring this process's REL_GRAPH up to date with the snapshot on disk, which another process may have updated
+
+    Cheap when nothing changed: a single stat(). When the snapshot changed, it's mapped, which is cheap too, and comes
+    with its reachability index and stats. Only if the snapshot is missing or unreadable is the delta log replayed, if
+    it has newer versions, and never in shared graph mode: that would give this worker a private copy of the graph.
+    One thread checks and swaps at a time; while it does, others keep using the graph already loaded."""
+    global REL_GRAPH
+    try:
+        mtime: Optional[float] = os.stat(graph_path).st_mtime
+    except OSError:
+        mtime = None
+    if mtime is not None and mtime == _rel_graph_snapshot_mtime[0]:
+        return REL_GRAPH
+    if not _rel_graph_sync_lock.acquire(blocking=False):
+        return REL_GRAPH
+    try:
+        if mtime is None:
+            REL_GRAPH = _replay_delta_log(REL_GRAPH, graph_path)
+        elif mtime != _rel_graph_snapshot_mtime[0]:
+            try:
+                if read_snapshot_meta(graph_path).get('graph_version', 0) != REL_GRAPH.meta.get('graph_version', 0):
+                    REL_GRAPH = read_graph_snapshot(graph_path)
+            except (OSError, SnapshotFormatError) as err:
+                warnings.warn(f'{graph_path}: {err}; keeping the graph already loaded')
+                REL_GRAPH = _replay_delta_log(REL_GRAPH, graph_path)
+                return REL_GRAPH
+            # Only once swapped, so that if mapping the snapshot failed, the next call tries again
+            _rel_graph_snapshot_mtime[0] = mtime
+        return REL_GRAPH
+    finally:
+        _rel_graph_sync_lock.release()
+
+
+def _replay_delta_log(g: CompactConceptGraph, graph_path: str) -> CompactConceptGraph:
+    """g, caught up with the delta log, if it has newer versions than g and covers every version in between. For when
+    the snapshot is missing or unreadable."""
+    latest: Optional[int] = latest_delta_version(graph_path)
+    if is_shared_graph_mode() or latest is None or latest <= g.meta.get('graph_version', 0):
+        return g
+    G: Optional[CompactConceptGraph] = catch_up(g, graph_path, {**g.meta, 'graph_version': latest})
+    if G is None:
+        return g
+    # Deltas only hold edges. Attributes are kept if the nodes are the same.
+    G.node_attrs = g.node_attrs if np.array_equal(G.node_ids, g.node_ids) else {}
+    return G
+
+
+def _load_graph(graph_path: str):
+    """Load REL_GRAPH and its reachability index, then mark the graph ready. Runs in the loader thread."""
+    global REL_GRAPH
+    t0 = time.monotonic()
+    try:
+        # In shared graph mode, the snapshot is kept current by the process that published it; just map it
+        shared = wait_for_published_graph()
+        _graph_load_phase[0] = 'loading'
+        G = read_graph_snapshot(graph_path) if shared else load_relationship_graph(graph_path)
+        _rel_graph_snapshot_mtime[0] = os.stat(graph_path).st_mtime if os.path.isfile(graph_path) else 0.0
+        get_reachability_index(G)
+        REL_GRAPH = G
+    except Exception as err:
+        _graph_load_error[0] = f'{type(err).__name__}: {err}'
+        incr('graph_load_errors')
+        warnings.warn(f'Failed to load relationship graph: {_graph_load_error[0]}')
+        return
+    _graph_load_error[0] = None
+    set_gauge('graph_cold_start_seconds', time.monotonic() - t0)
+    GRAPH_READY.set()
+    # Only /expand-expression needs it, so the graph doesn't wait for it. If this fails, that route loads it.
+    _graph_load_phase[0] = 'loading "Maps to" index'
+    try:
+        get_maps_to_index(G)
+    except Exception as err:
+        warnings.warn(f'Failed to load "Maps to" index: {type(err).__name__}: {err}')
+
+
+def start_graph_loading(graph_path: str = GRAPH_PATH) -> Optional[threading.Thread]:
+    """Load REL_GRAPH in a background thread, unless it's loaded or loading already
+
+    If you don't want the graph loaded, e.g. in tests, then somewhere up in the import tree, do this:
+      import builtins
+      builtins.DONT_LOAD_GRAPH = True
+
+    :returns the loader thread, or None if not started"""
     import builtins
     if hasattr(builtins, 'DONT_LOAD_GRAPH') and builtins.DONT_LOAD_GRAPH:
         warnings.warn('not loading relationship graph')
-    else:
-        REL_GRAPH = load_relationship_graph()
+        return None
+    with _graph_loader_lock:
+        loader = _graph_loader[0]
+        if GRAPH_READY.is_set() or (loader is not None and loader.is_alive()):
+            return None
+        _graph_load_started_at[0] = time.monotonic()
+        loader = threading.Thread(target=_load_graph, args=(graph_path,), name='rel-graph-loader', daemon=True)
+        _graph_loader[0] = loader
+        loader.start()
+    return loader
+
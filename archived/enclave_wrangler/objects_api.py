@@ -606,7 +606,14 @@ def csets_and_members_to_db(
     print(f'  - concept_set_members completed in {(datetime.now() - t2).seconds} seconds')
 
     # Derived tables
-    refresh_derived_tables(con, schema=schema)
+    # - only the rows of the csets fetched, and of any containers fetched, need updating
+    codeset_ids: List[int] = [
+        (x['properties'] if 'properties' in x else x)['codesetId'] for x in csets_and_members.get('OMOPConceptSet', [])]
+    concept_set_names: List[str] = [
+        (x['properties'] if 'properties' in x else x)['conceptSetId']
+        for x in csets_and_members.get('OMOPConceptSetContainer', [])] \
+        if 'OMOPConceptSetContainer' in obj_types else []
+    refresh_derived_tables(con, schema=schema, codeset_ids=codeset_ids, concept_set_names=concept_set_names)
 
 
 def fetch_object_by_id(
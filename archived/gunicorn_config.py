@@ -6,4 +6,26 @@
 # Dev: https://portal.azure.com/#@live.johnshopkins.edu/resource/subscriptions/fe24df19-d251-4821-9a6f-f037c93d7e47/resourceGroups/jh-termhub-webapp-rg/providers/Microsoft.Web/sites/termhub/slots/dev/configuration
 # Prod: https://portal.azure.com/#@live.johnshopkins.edu/resource/subscriptions/fe24df19-d251-4821-9a6f-f037c93d7e47/resourceGroups/JH-TERMHUB-WEBAPP-RG/providers/Microsoft.Web/sites/termhub/configuration
 workers = 4
+# Workers share one relationship graph, published by a process the master starts: see on_starting()
 worker_class = "uvicorn.workers.UvicornWorker"
+_graph_publisher = []
+
+
+def on_starting(server):
+    """Start the relationship graph publisher process. It publishes the snapshot, then republishes it whenever the vocab
+    is refreshed. Workers wait for it, which /ready reports, then map the snapshot read-only and share it, rather than
+    each loading its own copy. If it can't be published, they load their own. See: backend/routes/graph.py
+
+    It's a spawned process, not a thread: the master must have no threads when it forks workers, or a worker could
+    inherit a lock held by one."""
+    try:
+        from backend.routes.graph import start_graph_publishing
+        _graph_publisher.append(start_graph_publishing())
+    except Exception as err:
+        server.log.warning(f'Not publishing the relationship graph; workers will load their own: {err}')
+
+
+def on_exit(server):
+    """Stop the relationship graph publisher process"""
+    for publisher in _graph_publisher:
+        publisher.terminate()
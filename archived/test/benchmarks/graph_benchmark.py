@@ -0,0 +1,245 @@
+"""Benchmarks of the graph engine, on synthetic DAGs of OMOP scale and shape. No DB needed.
+
+Times, for each graph size, and each number of input concepts where there is one:
+- load_relationship_graph: mapping the snapshot, as at server startup; plus get_reachability_index() on it
+- get_all_descendants: all descendants of the input concepts, via the reachability index
+- concept_graph: the whole /concept-graph pipeline with transitive_descendants, for a codeset with the input concepts
+  as members: all descendants, hiding by vocab / standard status, and subgraph extraction
+- filter_concepts: hiding by vocab / standard status of concept rows: those of the input concepts and their
+  descendants
+
+Each timing is the best of `--repeat` runs; median and mean are recorded too. Results are written as JSON, by default
+to test/benchmarks/results/graph_<commit>.json, so runs of different commits can be compared:
+    python test/benchmarks/graph_benchmark.py --sizes 100000 1000000
+    python test/benchmarks/graph_benchmark.py --compare test/benchmarks/results/graph_<older commit>.json
+
+Synthetic graphs (see synthetic_omop_dag()) grow by preferential attachment: each concept gets a parent among the
+concepts before it, with probability proportional to a heavy-tailed weight. So, as in OMOP, most concepts are leaves,
+some have thousands of children, and the hierarchy is a few dozen levels deep. Some concepts get extra parents.
+"""
+import asyncio
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.attributes import set_concept_attributes
+from backend.graph.compact_graph import CONCEPT_ID_DTYPE, CompactConceptGraph
+from backend.graph.snapshot import write_graph_snapshot
+from backend.routes import graph as graph_routes
+from backend.routes.graph import GRAPH_PATH, build_graph_indexes, concept_graph, filter_concepts, \
+    get_all_descendants, get_reachability_index, load_relationship_graph
+
+RESULTS_DIR = THIS_DIR / 'results'
+DEFAULT_SIZES = [100_000, 1_000_000]
+DEFAULT_INPUT_SIZES = [10, 100, 1_000, 10_000]
+DEFAULT_REPEAT = 5
+REGRESSION_RATIO = 1.25
+REGRESSION_MIN_SECONDS = 0.001  # smaller slowdowns are noise
+# Roughly OMOP's mix: vocabularies, and the share of concepts in each
+VOCABULARIES = ['SNOMED', 'RxNorm', 'RxNorm Extension', 'LOINC', 'ICD10CM', 'ICD9CM', 'CPT4', 'NDC']
+VOCABULARY_SHARES = [0.25, 0.1, 0.3, 0.1, 0.1, 0.05, 0.05, 0.05]
+STANDARD_SHARE = 0.8
+HIDE_VOCABS = ['RxNorm Extension']
+
+
+def synthetic_omop_dag(
+    n_nodes: int, n_roots: int = 40, extra_parent_share=0.3, max_extra_parents=3, tail_exponent=1.2, seed=0
+) -> CompactConceptGraph:
+    """Random DAG with OMOP-like shape, sparse concept ids and concept attributes
+
+    :param n_roots: Concepts without parents, e.g. one per domain / vocabulary
+    :param extra_parent_share: Share of non-root concepts with more than one parent
+    :param max_extra_parents: Most extra parents per concept
+    :param tail_exponent: Pareto shape of the attachment weights. Lower gives more skewed fan-out."""
+    rng = np.random.default_rng(seed)
+    n_roots = max(1, min(n_roots, n_nodes))
+    weights = rng.pareto(tail_exponent, n_nodes) + 1
+    cumulative = np.cumsum(weights)
+
+    def earlier_nodes(nodes: np.ndarray) -> np.ndarray:
+        """A node before each of `nodes`, picked with probability proportional to its weight"""
+        return np.searchsorted(cumulative, rng.random(len(nodes)) * cumulative[nodes - 1], side='right')
+
+    children = np.arange(n_roots, n_nodes)
+    parents = earlier_nodes(children)
+    n_extra = np.where(rng.random(len(children)) < extra_parent_share,
+                       rng.integers(1, max_extra_parents + 1, len(children)), 0)
+    extra_children = np.repeat(children, n_extra)
+    sources = np.concatenate([parents, earlier_nodes(extra_children)])
+    targets = np.concatenate([children, extra_children])
+
+    # Sparse, shuffled concept ids, so that node order says nothing about the hierarchy
+    concept_ids = np.unique(rng.integers(1, 50_000_000, int(n_nodes * 1.1) + 100, dtype=CONCEPT_ID_DTYPE))
+    concept_ids = rng.permutation(concept_ids)[:n_nodes]
+    g = CompactConceptGraph.from_edges(concept_ids[sources], concept_ids[targets], concept_ids,
+                                       meta={'vocab_version': 'synthetic', 'graph_version': 1})
+    attributes = np.column_stack([
+        concept_ids,
+        rng.choice(len(VOCABULARIES), n_nodes, p=VOCABULARY_SHARES) + 1,
+        rng.random(n_nodes) < STANDARD_SHARE])
+    set_concept_attributes(g, VOCABULARIES, attributes)
+    return g
+
+
+def concept_rows(g: CompactConceptGraph, concept_ids: np.ndarray) -> List[Dict[str, Any]]:
+    """Concept rows as get_cset_members_items() returns them, from g's attribute arrays"""
+    idx = g.to_index(concept_ids)
+    codes = g.node_attrs['vocab_code'][idx].tolist()
+    standard = g.node_attrs['standard'][idx].tolist()
+    return [{'concept_id': cid, 'vocabulary_id': VOCABULARIES[code - 1], 'standard_concept': 'S' if s else None}
+            for cid, code, s in zip(g.node_ids[idx].tolist(), codes, standard)]
+
+
+def use_graph(g: Optional[CompactConceptGraph]):
+    """Make g the server's REL_GRAPH, as if loaded from the snapshot, so that sync_rel_graph() keeps it"""
+    graph_routes.REL_GRAPH = g
+    graph_routes._rel_graph_snapshot_mtime[0] = os.stat(GRAPH_PATH).st_mtime if os.path.isfile(GRAPH_PATH) else 0.0
+
+
+def time_it(func: Callable[[], Any], repeat: int) -> Tuple[Dict[str, float], Any]:
+    """Time func, `repeat` times
+
+    :return: (timings, func's last result)"""
+    seconds: List[float] = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        seconds.append(time.perf_counter() - t0)
+    return {'min_seconds': min(seconds), 'median_seconds': float(np.median(seconds)),
+            'mean_seconds': float(np.mean(seconds))}, result
+
+
+def run_benchmarks(
+    sizes: List[int] = DEFAULT_SIZES, input_sizes: List[int] = DEFAULT_INPUT_SIZES, repeat=DEFAULT_REPEAT, seed=0,
+    verbose=True
+) -> List[Dict[str, Any]]:
+    """Run all benchmarks for each graph size
+
+    :return: One record per benchmark, graph size and input size"""
+    results: List[Dict[str, Any]] = []
+
+    def record(name: str, g: CompactConceptGraph, input_size: int, timings: Dict[str, float], output_size: int):
+        """Add a result, and show it"""
+        results.append({'benchmark': name, 'n_nodes': len(g), 'n_edges': g.number_of_edges(),
+                        'input_size': input_size, 'output_size': output_size, 'repeat': repeat, **timings})
+        verbose and print(f'{name:<24} nodes={len(g):<10,} input={input_size:<8,} output={output_size:<10,} '
+                          f'{timings["min_seconds"] * 1000:10.2f} ms')
+
+    for n_nodes in sizes:
+        g = synthetic_omop_dag(n_nodes, seed=seed)
+        build_graph_indexes(g)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'relationship_graph.bin')
+            write_graph_snapshot(g, path)
+
+            def load():
+                """Load as at server startup: map the snapshot, and its reachability index"""
+                with redirect_stdout(io.StringIO()):
+                    loaded = load_relationship_graph(path, update_if_outdated=False)
+                get_reachability_index(loaded)
+                return loaded
+            timings, g = time_it(load, repeat)
+            record('load_relationship_graph', g, 0, timings, len(g))
+
+            use_graph(g)
+            rng = np.random.default_rng(seed)
+            for input_size in input_sizes:
+                concept_ids = rng.choice(g.node_ids, min(input_size, len(g)), replace=False)
+                members = concept_rows(g, concept_ids)
+                timings, descendants = time_it(
+                    lambda: get_all_descendants(g, concept_ids.tolist(), transitive=True), repeat)
+                record('get_all_descendants', g, input_size, timings, len(descendants))
+                timings, (sg, *_rest) = time_it(lambda: asyncio.run(concept_graph(
+                    [], [], HIDE_VOCABS, hide_nonstandard_concepts=True, members=members,
+                    transitive_descendants=True)), repeat)
+                record('concept_graph', g, input_size, timings, len(sg))
+                rows = concept_rows(g, np.union1d(concept_ids, list(descendants)))
+                timings, (filtered, *_rest) = time_it(
+                    lambda: filter_concepts(rows, HIDE_VOCABS, hide_nonstandard_concepts=True), repeat)
+                record('filter_concepts', g, input_size, timings, len(filtered))
+            # Let go of the mapped snapshot before its directory is removed
+            use_graph(None)
+            graph_routes._reachability_index[0] = None
+            del g
+    return results
+
+
+def git_commit() -> str:
+    """Short hash of the checked out commit, or 'unknown'"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold=REGRESSION_RATIO, min_seconds=REGRESSION_MIN_SECONDS
+) -> List[str]:
+    """Compare the best timings of two runs, for the benchmarks both have
+
+    :return: Lines of a report. Those of timings more than `threshold` times, and `min_seconds`, slower start with
+    'REGRESSION'."""
+    key = lambda r: (r['benchmark'], r['n_nodes'], r['input_size'])
+    before = {key(r): r for r in baseline['results']}
+    lines = [f"{baseline['meta']['commit']} -> {current['meta']['commit']}"]
+    for r in current['results']:
+        if key(r) not in before:
+            continue
+        old_seconds = before[key(r)]['min_seconds']
+        ratio = r['min_seconds'] / max(old_seconds, 1e-9)
+        flag = 'REGRESSION' if ratio > threshold and r['min_seconds'] - old_seconds > min_seconds else ''
+        lines.append(f"{flag:<10} {r['benchmark']:<24} nodes={r['n_nodes']:<10,} input={r['input_size']:<8,} "
+                     f"{old_seconds * 1000:10.2f} ms -> {r['min_seconds'] * 1000:10.2f} ms "
+                     f"({ratio:.2f}x)")
+    return lines
+
+
+def cli():
+    """Command line interface"""
+    parser = ArgumentParser(prog='Graph benchmarks', description='Benchmark the graph engine on synthetic DAGs.')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Graph sizes, in nodes')
+    parser.add_argument('-i', '--input-sizes', type=int, nargs='+', default=DEFAULT_INPUT_SIZES,
+                        help='Numbers of input concepts')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT, help='Runs per timing; the best is kept')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic graphs and inputs')
+    parser.add_argument('-o', '--output', help='Path of the results JSON. Default: results/graph_<commit>.json')
+    parser.add_argument('-c', '--compare', help='Path of earlier results JSON, to compare with')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = run_benchmarks(args.sizes, args.input_sizes, args.repeat, args.seed)
+    report = {
+        'meta': {
+            'commit': commit, 'timestamp': datetime.now().isoformat(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'sizes': args.sizes, 'input_sizes': args.input_sizes, 'repeat': args.repeat, 'seed': args.seed},
+        'results': results}
+    output = args.output or os.path.join(RESULTS_DIR, f'graph_{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            print('\n'.join(compare(json.load(f), report)))
+
+
+if __name__ == '__main__':
+    cli()
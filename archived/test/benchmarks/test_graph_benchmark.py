@@ -0,0 +1,49 @@
+"""Tests for graph_benchmark.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.reachability import ReachabilityIndex
+from test.benchmarks.graph_benchmark import compare, run_benchmarks, synthetic_omop_dag
+
+
+class TestGraphBenchmark(unittest.TestCase):
+    """Tests for the synthetic graphs, and a small run of the benchmarks"""
+
+    def test_synthetic_omop_dag(self):
+        """Graphs are acyclic, with the given roots, some concepts with several parents, and concept attributes"""
+        g = synthetic_omop_dag(5000, n_roots=10, seed=1)
+        self.assertEqual(len(g), 5000)
+        self.assertEqual(int(np.sum(g.in_degree() == 0)), 10)
+        self.assertGreater(int(np.sum(g.in_degree() > 1)), 500)
+        self.assertGreater(int(g.out_degree().max()), 100)  # heavy-tailed fan-out
+        self.assertTrue(np.all(ReachabilityIndex.build(g).depth >= 0))  # no cycles
+        self.assertEqual(len(g.node_attrs['vocab_code']), 5000)
+        np.testing.assert_array_equal(synthetic_omop_dag(5000, n_roots=10, seed=1).indices, g.indices)
+
+    def test_run_and_compare(self):
+        """Every benchmark runs for every input size, and slowdowns are flagged"""
+        results = run_benchmarks(sizes=[2000], input_sizes=[10, 100], repeat=1, verbose=False)
+        self.assertEqual([(r['benchmark'], r['input_size']) for r in results], [
+            ('load_relationship_graph', 0), ('get_all_descendants', 10), ('concept_graph', 10),
+            ('filter_concepts', 10), ('get_all_descendants', 100), ('concept_graph', 100), ('filter_concepts', 100)])
+        baseline = {'meta': {'commit': 'a'}, 'results': results}
+        slower = {'meta': {'commit': 'b'}, 'results': [{**r, 'min_seconds': r['min_seconds'] + 1} for r in results]}
+        report = compare(baseline, slower)
+        self.assertEqual(len(report), len(results) + 1)
+        self.assertTrue(all(line.startswith('REGRESSION') for line in report[1:]))
+        self.assertFalse(any(line.startswith('REGRESSION') for line in compare(baseline, baseline)[1:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,19 +3,34 @@
 How to run:
     python -m unittest discover
 """
+import asyncio
+import csv
+import io
 import os
+import re
 import sys
+import tempfile
+import threading
+import time
 import unittest
 from pathlib import Path
 from typing import Dict, List
+from unittest import mock
 
+import psycopg2
 from sqlalchemy.engine.base import Connection
+from sqlalchemy.pool import QueuePool
 
 TEST_DIR = os.path.dirname(__file__)
 PROJECT_ROOT = Path(TEST_DIR).parent.parent.parent
 sys.path.insert(0, str(PROJECT_ROOT))
-from backend.db.utils import get_db_connection, get_idle_connections, insert_fetch_statuses, run_sql, \
-    select_failed_fetches, sql_query
+from backend.db import utils as db_utils
+from backend.db.config import CORE_CSET_TABLES
+from backend.db.utils import DB_POOL_SIZE, INCREMENTAL_DERIVED_TABLES, chunk_list, chunk_transaction, \
+    copy_expert, count_csv_records, csv_column_types, csv_record_end, db_pool_stats, dbapi_cursor, get_async_engine, \
+    get_db_connection, get_dependent_tables_queue, get_derived_table_dependencies, get_engine, get_idle_connections, \
+    insert_fetch_statuses, iter_csv_chunks, order_derived_tables, quote_identifier, rows_to_copy_csv, run_sql, \
+    select_failed_fetches, skip_csv_records, sql_query
 
 
 # todo: add datetime to setUp and tearDown: It might be possible, despite failsafes being in place to prevent refreshes
@@ -83,6 +98,311 @@ class TestIdleConnections(unittest.TestCase):
         msg = f'{len(idle_cnx)} exceeds the theshold of {threshold} for interval {interval}.'
         self.assertLessEqual(len(idle_cnx), threshold, msg=msg)
 
+class TestEngineRegistry(unittest.TestCase):
+    """Tests for get_engine(). Engines don't connect until used, so no DB is needed."""
+
+    @mock.patch('backend.db.utils.get_pg_connect_url', return_value='postgresql+psycopg2://u:p@localhost:5432/db')
+    def test_engines_are_shared(self, _get_pg_connect_url):
+        """There's one pooled engine per (local, schema, isolation_level), and its pool is reported"""
+        with mock.patch.dict(db_utils._engines, clear=True):
+            engine = get_engine(schema='test_schema')
+            self.assertIs(get_engine(schema='test_schema'), engine)
+            self.assertIsNot(get_engine(schema='other_schema'), engine)
+            self.assertIsNot(get_engine(schema='test_schema', local=True), engine)
+            self.assertIsInstance(engine.pool, QueuePool)
+            self.assertEqual(engine.pool.size(), DB_POOL_SIZE)
+            stats = db_pool_stats()
+            self.assertEqual(len(stats), 3)
+            self.assertEqual(stats['remote:test_schema:AUTOCOMMIT']['checked_out'], 0)
+
+    @mock.patch('backend.db.utils.get_pg_connect_url', return_value='postgresql+asyncpg://u:p@localhost:5432/db')
+    def test_async_engines_per_loop(self, _get_pg_connect_url):
+        """Async engines are shared within an event loop, and replaced in a new one"""
+        async def get_engines():
+            """The engine for a schema, twice"""
+            return get_async_engine(schema='test_schema'), get_async_engine(schema='test_schema')
+
+        def run_in_new_loop():
+            """get_engines() in a loop of its own. Unlike asyncio.run(), leaves the current event loop in place, which
+            other tests in the session use."""
+            loop = asyncio.new_event_loop()
+            try:
+                return loop.run_until_complete(get_engines())
+            finally:
+                loop.close()
+
+        with mock.patch.dict(db_utils._async_engines, clear=True):
+            engine1, engine2 = run_in_new_loop()
+            self.assertIs(engine1, engine2)
+            self.assertIsNot(run_in_new_loop()[0], engine1)
+            self.assertIn('async:remote:test_schema', db_pool_stats())
+
+    def test_quote_identifier(self):
+        """Quotes in names are escaped"""
+        self.assertEqual(quote_identifier('concept_id'), '"concept_id"')
+        self.assertEqual(quote_identifier('a"; DROP TABLE x; --'), '"a""; DROP TABLE x; --"')
+
+
+class TestCsvChunks(unittest.TestCase):
+    """Tests for the record-aligned chunking load_csv() streams files with"""
+    records = [b'1,plain\n', b'2,"quoted, with comma"\n', b'3,"multi\nline ""quoted"" name"\n', b'4,"\n"\n',
+               b'5,last']
+
+    def test_record_end(self):
+        """Newlines in quoted fields don't end records"""
+        data = b''.join(self.records[1:3])
+        self.assertEqual(csv_record_end(data), len(data))
+        self.assertEqual(csv_record_end(data, last=False), len(self.records[1]))
+        self.assertEqual(csv_record_end(self.records[2][:12]), 0)
+
+    def test_chunks_are_whole_records(self):
+        """Chunks of any size split the file only between records, and lose nothing"""
+        data = b''.join(self.records)
+        for chunk_bytes in (1, 5, 16, 1000):
+            chunks = list(iter_csv_chunks(io.BytesIO(data), chunk_bytes))
+            self.assertEqual(b''.join(chunks), data)
+            self.assertEqual(sum(count_csv_records(c) for c in chunks), len(self.records))
+            for chunk in chunks[:-1]:
+                self.assertEqual(csv_record_end(chunk), len(chunk))
+        limit = len(b''.join(self.records[:3])) + 2
+        self.assertEqual(b''.join(iter_csv_chunks(io.BytesIO(data), 5, limit)), b''.join(self.records[:3]) + b'4,')
+
+    def test_skip_records(self):
+        """Skipping leaves the file at the start of the next record"""
+        f = io.BytesIO(b''.join(self.records))
+        self.assertEqual(skip_csv_records(f, 3), 3)
+        self.assertEqual(f.read(), b''.join(self.records[3:]))
+        self.assertEqual(skip_csv_records(io.BytesIO(b''.join(self.records)), 10), len(self.records))
+
+    def test_column_types_from_whole_file(self):
+        """Types inferred for a new table hold for every row, not just the first ones"""
+        rows = ['concept_id,concept_code,invalid_reason,score,standard',
+                '1,100,,1,true', '2,200,,2,true', '3,300,,3,true', '4,ABC,D,4.5,true', '5,500,,5,']
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'concept.csv')
+            with open(path, 'w') as f:
+                f.write('\n'.join(rows) + '\n')
+            columns = rows[0].split(',')
+            types = csv_column_types(mock.MagicMock(), path, columns, [], chunk_rows=2)
+            self.assertEqual(types, csv_column_types(mock.MagicMock(), path, columns, [], chunk_rows=100))
+        self.assertEqual(types, {'concept_id': 'bigint', 'concept_code': 'text', 'invalid_reason': 'text',
+                                 'score': 'double precision', 'standard': 'text'})
+
+    def test_chunk_transaction(self):
+        """On an AUTOCOMMIT connection, each chunk is a transaction on the cursor; otherwise, a SQLAlchemy one, nested
+        in the caller's if it has one, which is then left open"""
+        for autocommit, in_transaction, fail in [(True, False, False), (True, False, True), (False, True, False),
+                                                 (False, False, False)]:
+            con, cursor = mock.MagicMock(), mock.MagicMock()
+            con.connection.dbapi_connection.autocommit = autocommit
+            con.in_transaction.return_value = in_transaction
+            try:
+                with chunk_transaction(con, cursor):
+                    cursor.execute('COPY')
+                    if fail:
+                        raise ValueError('bad chunk')
+            except ValueError:
+                pass
+            statements = [c.args[0] for c in cursor.execute.call_args_list]
+            if autocommit:
+                self.assertEqual(statements, ['BEGIN', 'COPY', 'ROLLBACK' if fail else 'COMMIT'])
+                con.begin.assert_not_called()
+            else:
+                self.assertEqual(statements, ['COPY'])
+                (con.begin_nested if in_transaction else con.begin).assert_called_once()
+                (con.begin if in_transaction else con.begin_nested).assert_not_called()
+                con.commit.assert_not_called()
+
+
+class TestLoadCsvs(unittest.TestCase):
+    """Tests for load_csvs(), with load_csv() mocked"""
+
+    def run_load_csvs(self, jobs: List[Dict], workers: int, fail_table: str = None, con=None, expected: int = None):
+        """Run load_csvs(), recording the most tables loaded at once in self.max_loading
+
+        :param expected: Tables expected to load at once, `workers` by default. Each load waits, up to a timeout, for
+        that many to be loading, so that a slow submit, e.g. during garbage collection, doesn't make them miss each
+        other."""
+        expected = expected or workers
+        state = {'loading': 0, 'max_loading': 0}
+        lock = threading.Lock()
+
+        def load_csv(_con, table, **_kwargs):
+            with lock:
+                state['loading'] += 1
+                state['max_loading'] = max(state['max_loading'], state['loading'])
+            deadline = time.monotonic() + 0.5
+            while state['loading'] < expected and time.monotonic() < deadline:
+                time.sleep(0.005)
+            time.sleep(0.01)
+            with lock:
+                state['loading'] -= 1
+            if table == fail_table:
+                raise ValueError(table)
+            return None if table == 'skipped' else len(table)
+
+        with mock.patch.object(db_utils, 'load_csv', side_effect=load_csv), \
+                mock.patch.object(db_utils, 'get_db_connection', return_value=mock.MagicMock()):
+            try:
+                return db_utils.load_csvs(jobs, workers, con=con)
+            finally:
+                self.max_loading = state['max_loading']
+
+    def test_bounded_concurrency(self):
+        """Tables load at most `workers` at a time, and each one's progress is recorded"""
+        jobs = [{'table': t} for t in ('concept', 'concept_ancestor', 'relationship', 'skipped', 'code_sets')]
+        progress = self.run_load_csvs(jobs, workers=2)
+        self.assertEqual(self.max_loading, 2)
+        self.assertEqual(list(progress), [j['table'] for j in jobs])
+        self.assertEqual(progress['concept']['status'], 'done')
+        self.assertEqual(progress['concept']['rows'], len('concept'))
+        self.assertEqual(progress['skipped']['status'], 'skipped')
+        self.assertTrue(all(p['seconds'] is not None for p in progress.values()))
+        self.run_load_csvs(jobs, workers=1)
+        self.assertEqual(self.max_loading, 1)
+
+    def test_failure_raised(self):
+        """A table's error is raised once the tables being loaded finish"""
+        jobs = [{'table': t} for t in ('concept', 'bad', 'relationship')]
+        with self.assertRaises(ValueError):
+            self.run_load_csvs(jobs, workers=3, fail_table='bad')
+        self.assertEqual(self.max_loading, 3)
+
+    def test_workers_capped_by_pool(self):
+        """Workers are capped at the pool's connections, less the one the caller holds, if it passes it"""
+        jobs = [{'table': f'table_{i}'} for i in range(6)]
+        with mock.patch.object(db_utils, 'DB_POOL_SIZE', 2), mock.patch.object(db_utils, 'DB_POOL_MAX_OVERFLOW', 1):
+            self.run_load_csvs(jobs, workers=6, expected=3)
+            self.assertEqual(self.max_loading, 3)
+            self.run_load_csvs(jobs, workers=6, con=mock.MagicMock(), expected=2)
+            self.assertEqual(self.max_loading, 2)
+
+
+class TestBulkWrite(unittest.TestCase):
+    """Tests for the CSV that insert_from_dicts() and update_from_dicts() COPY into their staging tables"""
+
+    def test_rows_to_copy_csv(self):
+        """None becomes NULL, empty strings stay empty, and quotes, commas, newlines and JSON survive"""
+        rows = [{'id': 1, 'name': 'a "quoted", name\nacross lines', 'json': {'k': [1, 2]}},
+                {'id': 2, 'name': '', 'json': None}]
+        self.assertEqual(
+            rows_to_copy_csv(rows, ['id', 'name', 'json']),
+            '"1","a ""quoted"", name\nacross lines","{""k"": [1, 2]}"\n'
+            '"2","",\n')
+        parsed = list(csv.reader(io.StringIO(rows_to_copy_csv(rows, ['name', 'missing']))))
+        self.assertEqual(parsed, [[rows[0]['name'], ''], ['', '']])
+
+    def test_copy_expert(self):
+        """COPY runs on a raw cursor that is always closed, and its errors are raised with the statement"""
+        con = mock.MagicMock()
+        cursor = con.connection.dbapi_connection.cursor.return_value
+        cursor.rowcount = 2
+        with dbapi_cursor(con) as cur:
+            self.assertEqual(copy_expert(cur, 'COPY t FROM STDIN', io.StringIO('1\n2\n')), 2)
+        cursor.close.assert_called_once()
+        cursor.reset_mock()
+        cursor.copy_expert.side_effect = psycopg2.errors.UndefinedTable('relation "t" does not exist')
+        with self.assertRaisesRegex(RuntimeError, 'does not exist.*\n.*COPY t FROM STDIN'):
+            with dbapi_cursor(con) as cur:
+                copy_expert(cur, 'COPY t FROM STDIN', io.StringIO(''))
+        cursor.close.assert_called_once()
+
+
+class TestDerivedTableRefresh(unittest.TestCase):
+    """Tests for the ordering and scheduling of derived table refreshes, with the DB mocked"""
+
+    def test_queue_is_topological(self):
+        """Every derived table comes after those it's derived from, and the order is the same every time"""
+        for independent_tables in (CORE_CSET_TABLES, ['concept', 'concept_ancestor', 'concept_relationship'],
+                                   ['deidentified_term_usage_by_domain_clamped'], 'concept_ancestor'):
+            queue = get_dependent_tables_queue(independent_tables)
+            self.assertTrue(queue)
+            for table, deps in get_derived_table_dependencies(queue).items():
+                self.assertTrue(all(queue.index(d) < queue.index(table) for d in deps), (table, queue))
+            self.assertEqual(get_dependent_tables_queue(independent_tables), queue)
+        self.assertEqual(order_derived_tables(['concept_graph', 'all_csets_view', 'all_csets', 'codeset_counts']),
+                         ['codeset_counts', 'all_csets', 'all_csets_view', 'concept_graph'])
+
+    def test_parallel_refresh(self):
+        """Independent modules are made at the same time; each only after those it's derived from are swapped in"""
+        queue = get_dependent_tables_queue(['concept', 'concept_ancestor', 'concept_relationship'])
+        events: List = []
+        lock = threading.Lock()
+
+        def run_sql_mock(_con, statement: str, *_args):
+            swap = re.match(r'ALTER TABLE \S+\.(\w+)_new RENAME TO \1;', statement)
+            if statement in queue:  # the mocked DDL statement of a module
+                with lock:
+                    events.append(('start', statement))
+                time.sleep(0.05)
+            elif swap:
+                with lock:
+                    events.append(('swapped', swap.group(1)))
+
+        with mock.patch.object(db_utils, 'list_views', return_value=['all_csets_view']), \
+                mock.patch.object(db_utils, 'get_ddl_statements', side_effect=lambda _s, module, *_a: [module]), \
+                mock.patch.object(db_utils, 'run_sql', side_effect=run_sql_mock):
+            timings = db_utils.refresh_derived_tables_exec(mock.MagicMock(), queue, 'test_schema', workers=3)
+
+        self.assertEqual(set(timings), set(queue))
+        started = [m for e, m in events if e == 'start']
+        self.assertEqual(sorted(started), sorted(queue))
+        for table, deps in get_derived_table_dependencies(queue).items():
+            start = events.index(('start', table))
+            self.assertTrue(all(events.index(('swapped', d)) < start for d in deps), (table, events))
+        # concept_graph depends on nothing else refreshed, so starts alongside the first module
+        self.assertEqual(set(started[:2]), {'concepts_with_counts_ungrouped', 'concept_graph'})
+
+    def test_workers_capped_by_pool(self):
+        """Workers are capped at the pool's connections, less con, which is held throughout"""
+        queue = get_dependent_tables_queue(['concept', 'concept_ancestor', 'concept_relationship'])
+        con = mock.MagicMock()
+        with mock.patch.object(db_utils, 'DB_POOL_SIZE', 1), mock.patch.object(db_utils, 'DB_POOL_MAX_OVERFLOW', 1), \
+                mock.patch.object(db_utils, 'list_views', return_value=['all_csets_view']), \
+                mock.patch.object(db_utils, 'get_ddl_statements', side_effect=lambda _s, module, *_a: [module]), \
+                mock.patch.object(db_utils, 'run_sql'):
+            db_utils.refresh_derived_tables_exec(con, queue, 'test_schema', workers=3)
+        con.engine.connect.assert_not_called()  # only one worker, so everything is made on con
+
+
+class TestIncrementalRefresh(unittest.TestCase):
+    """Tests for refresh_cset_derived_tables_incremental(), with the DB mocked"""
+
+    def test_covers_cset_derived_tables(self):
+        """It updates every table derived from the core cset tables, in dependency order; only views are left"""
+        queue = get_dependent_tables_queue(CORE_CSET_TABLES)
+        self.assertEqual(set(queue) - set(INCREMENTAL_DERIVED_TABLES), {'all_csets_view'})
+        self.assertEqual([t for t in queue if t in INCREMENTAL_DERIVED_TABLES], INCREMENTAL_DERIVED_TABLES)
+
+    def test_one_transaction(self):
+        """Each table's rows of the changed codesets are deleted and reinserted, all in one transaction"""
+        statements: List[str] = []
+        with mock.patch.object(db_utils, 'run_sql', side_effect=lambda _con, q, *_a: statements.append(q.strip())):
+            timings = db_utils.refresh_cset_derived_tables_incremental(mock.MagicMock(), [1, 2], ['a'], 'test_n3c')
+        self.assertEqual(list(timings), INCREMENTAL_DERIVED_TABLES)
+        self.assertEqual((statements[0], statements[-1]), ('BEGIN;', 'COMMIT;'))
+        self.assertTrue(statements[1].startswith('CREATE TEMP TABLE changed_codesets ON COMMIT DROP'))
+        for table, (delete, insert) in zip(INCREMENTAL_DERIVED_TABLES, chunk_list(statements[2:-1], 2)):
+            self.assertTrue(delete.startswith(f'DELETE FROM test_n3c.{table} WHERE codeset_id IN'), delete)
+            self.assertTrue(insert.startswith(f'INSERT INTO test_n3c.{table}'), insert)
+            self.assertIn('changed_codesets', insert)
+
+    def test_rolled_back_on_error(self):
+        """If any statement fails, none of the changes are kept"""
+        statements: List[str] = []
+
+        def run_sql_mock(_con, query: str, *_args):
+            statements.append(query.strip())
+            if query.startswith('INSERT INTO test_n3c.codeset_counts'):
+                raise ValueError(query)
+
+        with mock.patch.object(db_utils, 'run_sql', side_effect=run_sql_mock):
+            with self.assertRaises(ValueError):
+                db_utils.refresh_cset_derived_tables_incremental(mock.MagicMock(), [1], schema='test_n3c')
+        self.assertEqual(statements[-1], 'ROLLBACK;')
+        self.assertNotIn('COMMIT;', statements)
+
+
 # Uncomment this and run this file and run directly to run all tests
 # if __name__ == '__main__':
 #     unittest.main()
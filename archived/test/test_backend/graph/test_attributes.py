@@ -0,0 +1,59 @@
+"""Tests for attributes.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.attributes import STANDARD, VOCAB_CODE, has_concept_attributes, hidden_concepts, \
+    set_concept_attributes
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.snapshot import read_graph_snapshot, write_graph_snapshot
+
+
+class TestConceptAttributes(unittest.TestCase):
+    """Tests for concept attribute arrays"""
+
+    def setUp(self):
+        self.g = CompactConceptGraph.from_edges([1, 1, 2, 3], [2, 3, 4, 5])
+        # (concept_id, vocab_code, is_standard). 99 isn't in the graph; 5 has no attributes
+        rows = np.array([(1, 1, 1), (2, 2, 1), (3, 2, 0), (4, 3, 0), (99, 2, 0)])
+        set_concept_attributes(self.g, ['ICD10CM', 'RxNorm Extension', 'SNOMED'], rows)
+
+    def test_aligned(self):
+        """Attribute arrays are aligned to node index, with 0 for concepts missing from the rows"""
+        self.assertTrue(has_concept_attributes(self.g))
+        self.assertEqual(self.g.node_attrs[VOCAB_CODE].tolist(), [1, 2, 2, 3, 0])
+        self.assertEqual(self.g.node_attrs[STANDARD].tolist(), [1, 1, 0, 0, 0])
+
+    def test_hidden_concepts(self):
+        """Hiding by vocab and non-standard status matches a row-by-row filter"""
+        hidden_by_voc, nonstandard = hidden_concepts(self.g, [1, 2, 3, 4, 99], ['RxNorm Extension', 'Unknown'], True)
+        self.assertEqual({k: v.tolist() for k, v in hidden_by_voc.items()}, {'RxNorm Extension': [2, 3]})
+        self.assertEqual(nonstandard.tolist(), [3, 4])
+        _hidden_by_voc, nonstandard = hidden_concepts(self.g, [1, 2, 3, 4], [], False)
+        self.assertEqual(len(nonstandard), 0)
+
+    def test_subgraph_and_snapshot(self):
+        """Attributes carry over to subgraphs and survive a snapshot round trip"""
+        sg = self.g.subgraph([2, 4, 5])
+        self.assertEqual(sg.node_attrs[VOCAB_CODE].tolist(), [2, 3, 0])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'relationship_graph.bin')
+            write_graph_snapshot(self.g, path)
+            g2 = read_graph_snapshot(path)
+            self.assertTrue(has_concept_attributes(g2))
+            self.assertEqual(g2.node_attrs[STANDARD].tolist(), self.g.node_attrs[STANDARD].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
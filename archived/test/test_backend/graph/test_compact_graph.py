@@ -0,0 +1,93 @@
+"""Tests for compact_graph.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import random
+import sys
+import unittest
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph, csr_gather
+
+
+def random_dag(n_nodes=300, n_edges=900, seed=0) -> nx.DiGraph:
+    """Random DAG with sparse, OMOP-like concept ids. Edges always point from a lower to a higher rank."""
+    rng = random.Random(seed)
+    ids = rng.sample(range(1, 50_000_000), n_nodes)
+    g = nx.DiGraph()
+    g.add_nodes_from(ids)
+    while g.number_of_edges() < n_edges:
+        a, b = sorted(rng.sample(range(n_nodes), 2))
+        g.add_edge(ids[a], ids[b])
+    return g
+
+
+class TestCompactConceptGraph(unittest.TestCase):
+    """Tests for CompactConceptGraph"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nxg = random_dag()
+        cls.g = CompactConceptGraph.from_networkx(cls.nxg)
+
+    def test_counts(self):
+        """Node and edge counts match networkx"""
+        self.assertEqual(len(self.g), len(self.nxg))
+        self.assertEqual(self.g.number_of_edges(), self.nxg.number_of_edges())
+        self.assertEqual(set(self.g.edges), set(self.nxg.edges))
+
+    def test_from_edges_dedupes(self):
+        """Duplicate edges are dropped and extra nodes are kept"""
+        g = CompactConceptGraph.from_edges([1, 1, 2], [2, 2, 3], node_ids=[99])
+        self.assertEqual(g.edges, [(1, 2), (2, 3)])
+        self.assertEqual(g.nodes.tolist(), [1, 2, 3, 99])
+        self.assertTrue(g.has_node(99))
+        self.assertFalse(g.has_node(4))
+
+    def test_successors_predecessors(self):
+        """Adjacency matches networkx in both directions"""
+        for node in list(self.nxg.nodes)[:50]:
+            self.assertEqual(set(self.g.successors(node).tolist()), set(self.nxg.successors(node)))
+            self.assertEqual(set(self.g.predecessors(node).tolist()), set(self.nxg.predecessors(node)))
+        self.assertEqual(len(self.g.successors(-1)), 0)
+
+    def test_successors_of(self):
+        """successors_of() is the union of each node's successors"""
+        nodes = list(self.nxg.nodes)[:40] + [-1]
+        expected = set().union(*[set(self.nxg.successors(n)) for n in nodes if n in self.nxg])
+        self.assertEqual(self.g.successors_of(nodes), expected)
+
+    def test_subgraph(self):
+        """Induced subgraph matches networkx, including isolated nodes"""
+        nodes = random.Random(1).sample(list(self.nxg.nodes), 120) + [-5]
+        expected = self.nxg.subgraph(nodes)
+        self.assertEqual({tuple(e) for e in self.g.subgraph_edges(nodes).tolist()}, set(expected.edges))
+        sg = self.g.subgraph(nodes)
+        self.assertEqual(set(sg.nodes.tolist()), set(expected.nodes))
+        self.assertEqual(set(sg.edges), set(expected.edges))
+
+    def test_iter_edge_chunks(self):
+        """Chunks together are all edges, in order"""
+        chunks = list(self.g.iter_edge_chunks(chunk_size=100))
+        self.assertEqual(len(chunks), -(-self.g.number_of_edges() // 100))
+        np.testing.assert_array_equal(np.concatenate(chunks), self.g.edge_array())
+
+    def test_csr_gather(self):
+        """csr_gather() returns rows in the order requested"""
+        indptr = np.array([0, 2, 2, 5])
+        indices = np.array([10, 11, 20, 21, 22])
+        owners, values = csr_gather(indptr, indices, np.array([2, 0, 1]))
+        self.assertEqual(owners.tolist(), [2, 2, 2, 0, 0])
+        self.assertEqual(values.tolist(), [20, 21, 22, 10, 11])
+
+
+if __name__ == '__main__':
+    unittest.main()
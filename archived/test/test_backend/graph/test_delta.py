@@ -0,0 +1,93 @@
+"""Tests for delta.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.delta import DELTA_LOG_MAX_ENTRIES, EdgeDelta, apply_edge_delta, catch_up, compute_edge_delta, \
+    delta_log_dir, read_delta, write_delta
+from backend.graph.snapshot import read_snapshot_meta, write_graph_snapshot
+
+
+def graph(edges, version: int) -> CompactConceptGraph:
+    """Graph from a list of edges"""
+    edges = np.array(edges).reshape(-1, 2)
+    return CompactConceptGraph.from_edges(edges[:, 0], edges[:, 1], meta={'graph_version': version})
+
+
+class TestEdgeDelta(unittest.TestCase):
+    """Tests for computing and applying edge deltas"""
+
+    def test_compute_and_apply(self):
+        """Applying the computed delta gives the same graph as building from the new edges"""
+        old = graph([(1, 2), (1, 3), (3, 4), (5, 6), (2_100_000_000, 7)], 1)
+        new_edges = np.array([(1, 2), (3, 4), (3, 8), (2_100_000_000, 7), (9, 1)])
+        delta = compute_edge_delta(old, new_edges)
+        self.assertEqual(sorted(map(tuple, delta.added.tolist())), [(3, 8), (9, 1)])
+        self.assertEqual(sorted(map(tuple, delta.removed.tolist())), [(1, 3), (5, 6)])
+
+        patched = apply_edge_delta(old, delta, {'graph_version': 2})
+        expected = graph(new_edges, 2)
+        for name, arr in expected.arrays().items():
+            np.testing.assert_array_equal(patched.arrays()[name], arr)
+        self.assertFalse(patched.has_node(5))  # nodes left without edges are dropped, as in a full build
+        self.assertEqual(patched.meta['graph_version'], 2)
+
+    def test_no_change(self):
+        """Identical edges give an empty delta"""
+        old = graph([(1, 2), (2, 3)], 1)
+        self.assertEqual(len(compute_edge_delta(old, np.array([(2, 3), (1, 2)]))), 0)
+
+
+class TestDeltaLog(unittest.TestCase):
+    """Tests for the delta log and catching up"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'relationship_graph.bin')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_catch_up(self):
+        """A process with an old version catches up by replaying the log"""
+        v1 = graph([(1, 2), (2, 3)], 1)
+        v2 = graph([(1, 2), (2, 3), (3, 4)], 2)
+        v3 = graph([(1, 2), (3, 4), (4, 5)], 3)
+        write_delta(self.path, 2, compute_edge_delta(v1, v2.edge_array()))
+        write_delta(self.path, 3, compute_edge_delta(v2, v3.edge_array()))
+        write_graph_snapshot(v3, self.path)
+
+        caught_up = catch_up(v1, self.path, read_snapshot_meta(self.path))
+        self.assertEqual(caught_up.edges, v3.edges)
+        self.assertEqual(caught_up.meta['graph_version'], 3)
+
+        os.remove(os.path.join(delta_log_dir(self.path), '00000002.npz'))
+        self.assertIsNone(catch_up(v1, self.path, v3.meta))
+
+    def test_round_trip_and_pruning(self):
+        """Deltas survive a write / read round trip, and only the latest entries are kept"""
+        delta = EdgeDelta(np.array([(1, 2)]), np.empty((0, 2)), {'to_version': 1})
+        for version in range(1, DELTA_LOG_MAX_ENTRIES + 3):
+            write_delta(self.path, version, delta)
+        self.assertEqual(len(os.listdir(delta_log_dir(self.path))), DELTA_LOG_MAX_ENTRIES)
+        self.assertIsNone(read_delta(self.path, 1))
+        latest = read_delta(self.path, DELTA_LOG_MAX_ENTRIES + 2)
+        self.assertEqual(latest.added.tolist(), [[1, 2]])
+        self.assertEqual(latest.removed.shape, (0, 2))
+        self.assertEqual(latest.meta, {'to_version': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
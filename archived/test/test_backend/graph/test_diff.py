@@ -0,0 +1,47 @@
+"""Tests for diff.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.diff import diff_graphs
+from backend.graph.reachability import ReachabilityIndex
+
+
+def index_of(edges):
+    """Reachability index of a graph with the given edges"""
+    return ReachabilityIndex.build(CompactConceptGraph.from_edges([e[0] for e in edges], [e[1] for e in edges]))
+
+
+class TestDiff(unittest.TestCase):
+    """Tests for diff_graphs()"""
+
+    def test_diff_graphs(self):
+        """Changed edges below the concepts are reported, with each concept's gained and lost descendants"""
+        # 3 moves from under 2 to under 4; 5 is new under 4. Edges elsewhere (10 -> 11 -> 12) are out of scope.
+        old = index_of([(1, 2), (2, 3), (1, 4), (10, 11)])
+        new = index_of([(1, 2), (1, 4), (4, 3), (4, 5), (10, 11), (11, 12)])
+        diff = diff_graphs(old, new, [1, 2, 4, 99])
+        self.assertEqual(diff['edges_added'], [[4, 3], [4, 5]])
+        self.assertEqual(diff['edges_removed'], [[2, 3]])
+        self.assertEqual(diff['descendants_gained'], {1: [5], 4: [3, 5]})
+        self.assertEqual(diff['descendants_lost'], {2: [3]})
+        self.assertEqual((diff['missing_from_old'], diff['missing_from_new']), ([99], [99]))
+
+    def test_no_changes(self):
+        """Identical graphs have an empty diff"""
+        edges = [(1, 2), (2, 3)]
+        diff = diff_graphs(index_of(edges), index_of(edges), [1])
+        self.assertEqual((diff['edges_added'], diff['edges_removed'], diff['descendants_gained']), ([], [], {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+"""Tests for expansion.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.expansion import MapsToIndex, expand_csets, expand_expression
+from backend.graph.reachability import ReachabilityIndex
+
+# 1 -> 2 -> 3, 1 -> 4; 10 and 11 map to 2, 12 maps to 4, 13 maps to 99 (not in the graph)
+EDGES = [(1, 2), (2, 3), (1, 4)]
+MAPS_TO = [(10, 2), (11, 2), (12, 4), (13, 99)]
+
+
+class TestExpansion(unittest.TestCase):
+    """Tests for expand_expression() and MapsToIndex"""
+
+    @classmethod
+    def setUpClass(cls):
+        g = CompactConceptGraph.from_edges([e[0] for e in EDGES], [e[1] for e in EDGES])
+        cls.index = ReachabilityIndex.build(g)
+        cls.maps_to = MapsToIndex.from_edges(np.array(MAPS_TO))
+
+    def expand(self, *items):
+        """Members of the given items, as a list"""
+        return expand_expression(self.index, self.maps_to, items)[0].tolist()
+
+    def test_mapped_from(self):
+        """Sources of "Maps to" relationships are found by target"""
+        self.assertEqual(self.maps_to.mapped_from([2, 4, 5]).tolist(), [10, 11, 12])
+        self.assertEqual(self.maps_to.mapped_from([]).tolist(), [])
+
+    def test_flags(self):
+        """includeDescendants and includeMapped add descendants, and concepts mapping to any of those"""
+        self.assertEqual(self.expand({'concept_id': 2}), [2])
+        self.assertEqual(self.expand({'concept_id': 1, 'includeDescendants': True}), [1, 2, 3, 4])
+        self.assertEqual(self.expand({'concept_id': 2, 'includeMapped': True}), [2, 10, 11])
+        self.assertEqual(self.expand({'concept_id': 1, 'includeDescendants': True, 'includeMapped': True}),
+                         [1, 2, 3, 4, 10, 11, 12])
+        self.assertEqual(self.expand({'concept_id': 99, 'includeDescendants': True, 'includeMapped': True}),
+                         [13, 99])  # not in the graph
+
+    def test_excluded(self):
+        """Exclusion items remove their expanded concepts, whatever the item order"""
+        members, excluded = expand_expression(self.index, self.maps_to, [
+            {'concept_id': 2, 'isExcluded': True, 'includeDescendants': True},
+            {'concept_id': 1, 'includeDescendants': True, 'includeMapped': True}])
+        self.assertEqual(members.tolist(), [1, 4, 10, 11, 12])
+        self.assertEqual(excluded.tolist(), [2, 3])
+        self.assertEqual(self.expand({'concept_id': 2, 'isExcluded': True}), [])
+
+    def test_expand_csets(self):
+        """Items of several csets are expanded separately"""
+        members = expand_csets(self.index, self.maps_to, [
+            {'codeset_id': 7, 'concept_id': 2, 'includeDescendants': True},
+            {'codeset_id': 8, 'concept_id': 4, 'includeMapped': True},
+            {'codeset_id': 7, 'concept_id': 3, 'isExcluded': True}])
+        self.assertEqual({k: v.tolist() for k, v in members.items()}, {7: [2], 8: [4, 12]})
+
+
+if __name__ == '__main__':
+    unittest.main()
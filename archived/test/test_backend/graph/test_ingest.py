@@ -0,0 +1,70 @@
+"""Tests for ingest.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import struct
+import sys
+import unittest
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.ingest import PG_COPY_SIGNATURE, BinaryCopyInt8Sink
+
+
+def binary_copy_stream(rows: List[Tuple], header_extension: bytes = b'') -> bytes:
+    """Encode rows of int8 values (None for NULL) the way Postgres does for COPY ... TO STDOUT (FORMAT binary)"""
+    out = PG_COPY_SIGNATURE + struct.pack('>ii', 0, len(header_extension)) + header_extension
+    for row in rows:
+        out += struct.pack('>h', len(row))
+        for val in row:
+            out += struct.pack('>i', -1) if val is None else struct.pack('>iq', 8, val)
+    return out + struct.pack('>h', -1)
+
+
+def feed(sink: BinaryCopyInt8Sink, stream: bytes, chunk_size: int) -> np.ndarray:
+    """Feed a stream to a sink in chunks, like copy_expert() does"""
+    for i in range(0, len(stream), chunk_size):
+        sink.write(stream[i:i + chunk_size])
+    return sink.result()
+
+
+class TestBinaryCopyInt8Sink(unittest.TestCase):
+    """Tests for BinaryCopyInt8Sink"""
+
+    def test_decode(self):
+        """Rows decode correctly regardless of how the stream is chunked, and the array grows as needed"""
+        rows = [(i * 7, 2_100_000_000 + i) for i in range(1000)]
+        stream = binary_copy_stream(rows, header_extension=b'ext!')
+        for chunk_size in (1, 13, 26, 4096, len(stream)):
+            progress = []
+            sink = BinaryCopyInt8Sink(2, expected_rows=10, batch_bytes=500,
+                                      progress_callback=lambda n, expected: progress.append(n))
+            result = feed(sink, stream, chunk_size)
+            self.assertEqual(result.tolist(), [list(r) for r in rows])
+            self.assertEqual(progress[-1], len(rows))
+
+    def test_empty(self):
+        """A stream with no rows gives an empty array"""
+        result = feed(BinaryCopyInt8Sink(2), binary_copy_stream([]), 100)
+        self.assertEqual(result.shape, (0, 2))
+
+    def test_null_rejected(self):
+        """NULLs change the row width, so are rejected rather than silently misread"""
+        with self.assertRaises(ValueError):
+            feed(BinaryCopyInt8Sink(2), binary_copy_stream([(1, 2), (3, None), (5, 6)]), 100)
+
+    def test_bad_signature(self):
+        """Text / CSV COPY output is rejected"""
+        with self.assertRaises(ValueError):
+            feed(BinaryCopyInt8Sink(2), b'1,2\n3,4\n5,6\n7,8\n9,10\n', 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+"""Tests for layout.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.layout import assign_layers, graph_hash, layered_layout, order_layers, split_long_edges
+from test.test_backend.graph.test_compact_graph import random_dag
+
+
+def count_crossings(u: np.ndarray, v: np.ndarray, layers: np.ndarray, pos: np.ndarray) -> int:
+    """Number of pairs of edges between the same two layers that cross"""
+    crossings = 0
+    for i in np.unique(layers[u]):
+        e = np.flatnonzero(layers[u] == i)
+        a, b = pos[u[e]], pos[v[e]]
+        crossings += int(np.sum((a[:, None] < a[None, :]) & (b[:, None] > b[None, :])))
+    return crossings
+
+
+class TestLayout(unittest.TestCase):
+    """Tests for layered_layout() and its steps"""
+
+    def test_layers_and_bends(self):
+        """Edges point down, and long edges bend once on each layer they cross"""
+        g = CompactConceptGraph.from_edges([5, 1, 1, 2, 3], [1, 2, 4, 3, 4])
+        layout = layered_layout(g, node_sep=2, layer_sep=10)
+        ys = {cid: xy[1] for cid, xy in layout['nodes'].items()}
+        self.assertEqual(ys, {5: 0, 1: 10, 2: 20, 3: 30, 4: 40})
+        self.assertEqual(len(layout['bends']), 1)
+        source, target, points = layout['bends'][0]
+        self.assertEqual((source, target, [p[1] for p in points]), (1, 4, [20, 30]))
+        self.assertEqual((layout['n_layers'], layout['height']), (5, 40))
+
+    def test_crossings_reduced(self):
+        """Barycenter sweeps remove crossings that the initial order has"""
+        g = CompactConceptGraph.from_edges([1, 2], [4, 3])
+        layout = layered_layout(g)
+        self.assertLess(layout['nodes'][1][0], layout['nodes'][2][0])
+        self.assertLess(layout['nodes'][4][0], layout['nodes'][3][0])
+
+        g = CompactConceptGraph.from_networkx(random_dag(n_nodes=300, n_edges=600, seed=5))
+        src, tgt = g.edge_index_array()
+        _kept, u, v, layers, _dummy_start = split_long_edges(src, tgt, assign_layers(g))
+        before = count_crossings(u, v, layers, order_layers(u, v, layers, iterations=0))
+        after = count_crossings(u, v, layers, order_layers(u, v, layers, iterations=4))
+        self.assertLess(after, before)
+
+    def test_positions_are_distinct(self):
+        """No two nodes of a layer share a position, dummy nodes included"""
+        g = CompactConceptGraph.from_networkx(random_dag(n_nodes=200, n_edges=500, seed=6))
+        src, tgt = g.edge_index_array()
+        _kept, u, v, layers, _dummy_start = split_long_edges(src, tgt, assign_layers(g))
+        pos = order_layers(u, v, layers)
+        self.assertEqual(len(set(zip(layers.tolist(), pos.tolist()))), len(layers))
+
+    def test_cycle(self):
+        """Nodes on a cycle are still laid out"""
+        g = CompactConceptGraph.from_edges([1, 2, 3], [2, 3, 2])
+        self.assertEqual(set(layered_layout(g)['nodes']), {1, 2, 3})
+
+    def test_graph_hash(self):
+        """Equal graphs hash the same, and any edge change changes the hash"""
+        g1 = CompactConceptGraph.from_edges([1, 1], [2, 3])
+        self.assertEqual(graph_hash(g1), graph_hash(CompactConceptGraph.from_edges([1, 1], [3, 2])))
+        self.assertNotEqual(graph_hash(g1), graph_hash(CompactConceptGraph.from_edges([1, 2], [2, 3])))
+
+
+if __name__ == '__main__':
+    unittest.main()
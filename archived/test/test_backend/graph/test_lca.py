@@ -0,0 +1,65 @@
+"""Tests for lca.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import random
+import sys
+import unittest
+from pathlib import Path
+
+import networkx as nx
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.lca import connecting_subgraph, lowest_common_ancestors
+from backend.graph.reachability import ReachabilityIndex
+from test.test_backend.graph.test_compact_graph import random_dag
+
+
+class TestLca(unittest.TestCase):
+    """Tests for lowest common ancestors and connecting subgraphs"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nxg = random_dag(n_nodes=300, n_edges=700, seed=7)
+        cls.index = ReachabilityIndex.build(CompactConceptGraph.from_networkx(cls.nxg))
+
+    def expected_lcas(self, nodes):
+        """LCAs via networkx: common ancestors (or selves) with no descendant among the common ancestors"""
+        common = set.intersection(*[nx.ancestors(self.nxg, n) | {n} for n in nodes])
+        return {c for c in common if not nx.descendants(self.nxg, c) & common}
+
+    def test_lowest_common_ancestors(self):
+        """LCAs match networkx, deepest first"""
+        rng = random.Random(8)
+        all_nodes = list(self.nxg.nodes)
+        for _ in range(100):
+            nodes = rng.sample(all_nodes, rng.choice([1, 2, 3]))
+            lcas = lowest_common_ancestors(self.index, nodes)
+            self.assertEqual(set(lcas), self.expected_lcas(nodes))
+            depths = [self.index.depth[self.index.g.to_index([x])[0]] for x in lcas]
+            self.assertEqual(depths, sorted(depths, reverse=True))
+
+    def test_connecting_subgraph(self):
+        """The tree connects each concept to its group's root using graph edges only"""
+        rng = random.Random(9)
+        all_nodes = list(self.nxg.nodes)
+        for _ in range(50):
+            nodes = rng.sample(all_nodes, 4)
+            result = connecting_subgraph(self.index, nodes + [-1])
+            self.assertEqual(result['missing_from_graph'], [-1])
+            self.assertEqual(sorted(sum([grp['concept_ids'] for grp in result['groups']], [])), sorted(nodes))
+            tree = nx.DiGraph(result['edges'])
+            self.assertTrue(set(tree.edges) <= set(self.nxg.edges))
+            for grp in result['groups']:
+                self.assertEqual(set(grp['lowest_common_ancestors']), self.expected_lcas(grp['concept_ids']))
+                for concept_id in grp['concept_ids']:
+                    self.assertTrue(concept_id == grp['root'] or nx.has_path(tree, grp['root'], concept_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
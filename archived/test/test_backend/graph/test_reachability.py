@@ -0,0 +1,98 @@
+"""Tests for reachability.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import random
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import networkx as nx
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.reachability import ReachabilityIndex, merge_intervals
+from backend.graph.snapshot import read_graph_snapshot, write_graph_snapshot
+from test.test_backend.graph.test_compact_graph import random_dag
+
+
+class TestReachabilityIndex(unittest.TestCase):
+    """Tests for ReachabilityIndex, against networkx"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nxg = random_dag(n_nodes=400, n_edges=1000, seed=3)
+        cls.g = CompactConceptGraph.from_networkx(cls.nxg)
+        cls.index = ReachabilityIndex.build(cls.g)
+        cls.sample = random.Random(4).sample(list(cls.nxg.nodes), 60)
+
+    def test_descendants(self):
+        """Full closure matches networkx, for single nodes and for sets"""
+        for node in self.sample:
+            self.assertEqual(set(self.index.descendants([node]).tolist()), nx.descendants(self.nxg, node))
+        nodes = self.sample[:10]
+        expected = set().union(*[nx.descendants(self.nxg, n) for n in nodes])
+        self.assertEqual(set(self.index.descendants(nodes).tolist()), expected)
+        self.assertEqual(set(self.index.descendants(nodes, include_self=True).tolist()), expected.union(nodes))
+
+    def test_ancestors(self):
+        """Ancestors match networkx"""
+        for node in self.sample:
+            self.assertEqual(set(self.index.ancestors([node]).tolist()), nx.ancestors(self.nxg, node))
+
+    def test_depth_limited(self):
+        """max_depth limits results to nodes within that many edges"""
+        for node in self.sample[:20]:
+            for max_depth in (0, 1, 2):
+                within = set(nx.single_source_shortest_path_length(self.nxg, node, cutoff=max_depth)) - {node}
+                self.assertEqual(set(self.index.descendants([node], max_depth=max_depth).tolist()), within)
+                within = set(nx.single_source_shortest_path_length(self.nxg.reverse(), node, cutoff=max_depth))
+                self.assertEqual(
+                    set(self.index.ancestors([node], include_self=True, max_depth=max_depth).tolist()), within)
+
+    def test_is_ancestor(self):
+        """is_ancestor() matches networkx, and is strict"""
+        rng = random.Random(5)
+        nodes = list(self.nxg.nodes)
+        for _ in range(500):
+            a, b = rng.choice(nodes), rng.choice(nodes)
+            self.assertEqual(self.index.is_ancestor(a, b), b in nx.descendants(self.nxg, a))
+        self.assertFalse(self.index.is_ancestor(nodes[0], nodes[0]))
+        self.assertFalse(self.index.is_ancestor(-1, nodes[0]))
+
+    def test_depth(self):
+        """depth is the longest path from a root"""
+        for node in self.sample:
+            i = self.g.to_index([node])[0]
+            parents = self.g.to_index(self.g.predecessors(node))
+            self.assertEqual(self.index.depth[i], self.index.depth[parents].max() + 1 if len(parents) else 0)
+
+    def test_stored_in_snapshot(self):
+        """Labels stored with the graph are saved in its snapshot and mapped from it, not rebuilt"""
+        g = CompactConceptGraph.from_networkx(self.nxg)
+        ReachabilityIndex.build(g).store()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'relationship_graph.bin')
+            write_graph_snapshot(g, path)
+            index = ReachabilityIndex.for_graph(read_graph_snapshot(path))
+            self.assertFalse(index.labels.label_lo.flags.writeable)  # a read-only view of the file
+            for node in self.sample[:10]:
+                np.testing.assert_array_equal(index.descendants([node]), self.index.descendants([node]))
+        # Not carried over to subgraphs, whose node indexes differ
+        self.assertEqual(g.subgraph(self.sample).indexes, {})
+
+    def test_merge_intervals(self):
+        """Overlapping and adjacent intervals merge, per owner"""
+        owners, lo, hi = merge_intervals(
+            np.array([1, 0, 0, 0, 1]), np.array([5, 4, 0, 3, 6]), np.array([6, 9, 1, 3, 9]))
+        self.assertEqual(list(zip(owners.tolist(), lo.tolist(), hi.tolist())), [(0, 0, 1), (0, 3, 9), (1, 5, 9)])
+
+
+if __name__ == '__main__':
+    unittest.main()
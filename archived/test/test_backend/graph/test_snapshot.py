@@ -0,0 +1,79 @@
+"""Tests for snapshot.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.snapshot import SnapshotFormatError, keep_previous_snapshot, previous_snapshot_path, \
+    read_graph_snapshot, read_snapshot_meta, write_graph_snapshot
+
+
+class TestSnapshot(unittest.TestCase):
+    """Tests for graph snapshot files"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'relationship_graph.bin')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        """Graph and header meta survive a write / read round trip"""
+        meta = {'vocab_version': 'v5.0 30-AUG-24', 'last_refreshed_vocab_tables': '2024-09-01T00:00:00-04:00'}
+        g = CompactConceptGraph.from_edges([10, 10, 20], [20, 30, 40], node_ids=[99], meta=meta)
+        write_graph_snapshot(g, self.path)
+
+        self.assertEqual(read_snapshot_meta(self.path)['vocab_version'], meta['vocab_version'])
+        g2 = read_graph_snapshot(self.path)
+        self.assertEqual(g2.meta['last_refreshed_vocab_tables'], meta['last_refreshed_vocab_tables'])
+        for name, arr in g.arrays().items():
+            np.testing.assert_array_equal(g2.arrays()[name], arr)
+        self.assertEqual(g2.edges, g.edges)
+        self.assertEqual(g2.successors_of([10]), {20, 30})
+
+    def test_arrays_are_read_only(self):
+        """Loaded arrays are read-only views of the mapped file"""
+        write_graph_snapshot(CompactConceptGraph.from_edges([1], [2]), self.path)
+        g = read_graph_snapshot(self.path)
+        self.assertFalse(g.indices.flags.writeable)
+        with self.assertRaises(ValueError):
+            g.indices[0] = 5
+
+    def test_keep_previous_snapshot(self):
+        """The previous snapshot is kept as it was, and stays readable, after the snapshot is replaced"""
+        write_graph_snapshot(CompactConceptGraph.from_edges([1], [2], meta={'vocab_version': 'v1'}), self.path)
+        keep_previous_snapshot(self.path)
+        write_graph_snapshot(CompactConceptGraph.from_edges([1, 2], [2, 3], meta={'vocab_version': 'v2'}), self.path)
+        previous = read_graph_snapshot(previous_snapshot_path(self.path))
+        self.assertEqual((previous.meta['vocab_version'], previous.edges), ('v1', [(1, 2)]))
+        self.assertEqual(read_snapshot_meta(self.path)['vocab_version'], 'v2')
+
+    def test_empty_graph(self):
+        """A graph with no edges can be written and read"""
+        write_graph_snapshot(CompactConceptGraph.from_edges([], []), self.path)
+        g = read_graph_snapshot(self.path)
+        self.assertEqual(len(g), 0)
+        self.assertEqual(g.number_of_edges(), 0)
+
+    def test_not_a_snapshot(self):
+        """Files in another format, e.g. an old pickle, are rejected"""
+        with open(self.path, 'wb') as f:
+            f.write(b'\x80\x04\x95 not a snapshot at all')
+        with self.assertRaises(SnapshotFormatError):
+            read_graph_snapshot(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
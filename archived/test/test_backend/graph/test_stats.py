@@ -0,0 +1,77 @@
+"""Tests for stats.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import networkx as nx
+
+THIS_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_DIR.parent.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.reachability import ReachabilityIndex
+from backend.graph.snapshot import read_graph_snapshot, write_graph_snapshot
+from backend.graph.stats import compute_concept_stats, concept_stats, get_concept_stats, has_concept_stats, \
+    store_concept_stats
+from test.test_backend.graph.test_compact_graph import random_dag
+
+
+class TestConceptStats(unittest.TestCase):
+    """Tests for compute_concept_stats() and concept_stats()"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.nxg = random_dag(n_nodes=400, n_edges=900, seed=3)
+        cls.g = CompactConceptGraph.from_networkx(cls.nxg)
+        cls.index = ReachabilityIndex.build(cls.g)
+        cls.stats = compute_concept_stats(cls.index)
+
+    def test_against_networkx(self):
+        """Depth, children and descendants match networkx; each root is an ancestor without parents"""
+        stats = concept_stats(self.g, self.stats, self.g.node_ids)
+        depth = {}
+        for node in nx.topological_sort(self.nxg):
+            depth[node] = max((depth[p] + 1 for p in self.nxg.predecessors(node)), default=0)
+        for node, node_stats in stats.items():
+            self.assertEqual(node_stats['depth'], depth[node])
+            self.assertEqual(node_stats['n_children'], self.nxg.out_degree(node))
+            self.assertEqual(node_stats['n_descendants'], len(nx.descendants(self.nxg, node)))
+            root = node_stats['root']
+            self.assertEqual(self.nxg.in_degree(root), 0)
+            self.assertTrue(root == node or root in nx.ancestors(self.nxg, node))
+
+    def test_roots_follow_first_parents(self):
+        """A concept under several roots is listed under that of its first parent, by concept_id"""
+        g = CompactConceptGraph.from_edges([1, 2, 3, 3], [3, 4, 5, 4])
+        stats = concept_stats(g, compute_concept_stats(ReachabilityIndex.build(g)), [1, 4, 5, 99])
+        self.assertEqual(set(stats), {1, 4, 5})  # 99 isn't in the graph
+        self.assertEqual(stats[4], {'depth': 2, 'n_children': 0, 'n_descendants': 0, 'root': 2})
+        self.assertEqual(stats[5]['root'], 1)
+        self.assertEqual(stats[1], {'depth': 0, 'n_children': 1, 'n_descendants': 3, 'root': 1})
+
+    def test_stored_in_snapshot(self):
+        """Stats stored with the graph are saved in its snapshot and mapped from it, not recomputed"""
+        g = CompactConceptGraph.from_networkx(self.nxg)
+        index = ReachabilityIndex.build(g)
+        index.store()
+        self.assertFalse(has_concept_stats(g))
+        store_concept_stats(g, compute_concept_stats(index))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'relationship_graph.bin')
+            write_graph_snapshot(g, path)
+            g2 = read_graph_snapshot(path)
+            self.assertTrue(has_concept_stats(g2))
+            stats = get_concept_stats(ReachabilityIndex.for_graph(g2))
+            self.assertFalse(stats['n_descendants'].flags.writeable)  # a read-only view of the file
+            sample = self.g.node_ids[:20]
+            self.assertEqual(concept_stats(g2, stats, sample), concept_stats(self.g, self.stats, sample))
+
+
+if __name__ == '__main__':
+    unittest.main()
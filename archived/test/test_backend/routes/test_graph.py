@@ -17,11 +17,18 @@ import json
 import os
 import subprocess
 import sys
+import tempfile
+import threading
 import unittest
+import warnings
 from io import StringIO
 from pathlib import Path
 from typing import Dict, List, Set, Tuple
+from unittest import mock
 
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
 from networkx import DiGraph
 
 THIS_DIR = Path(os.path.dirname(__file__))
@@ -32,7 +39,12 @@ sys.path.insert(0, str(PROJECT_ROOT))
 #  but examining the diff, it's not obvious why. Pickle didn't change. Loading of pickle essentially unchanged. 
 import builtins
 builtins.DONT_LOAD_GRAPH = True
-from backend.routes.graph import concept_graph
+from backend.graph.compact_graph import CompactConceptGraph
+from backend.graph.delta import compute_edge_delta, write_delta
+from backend.graph.snapshot import write_graph_snapshot
+from backend.routes import graph as graph_routes
+from backend.routes.graph import LAYOUT_CACHE, concept_graph, condense_super_nodes, expand_super_node, graph_layout, \
+    get_all_descendants, get_graph_concept_stats, group_concept_ids, wholegraph_response
 # noinspection PyUnresolvedReferences rel_graph_exists_just_not_if_name_eq_main
 REL_GRAPH = DiGraph()
 
@@ -407,6 +419,226 @@ class TestGraph(AsyncTests):
                            ( "321588", "4024552" ), ( "321588", "4027255" ), ( "4027255", "43530856" ) ] )
 
 
+# Heart disease hierarchy, from the 'Is a' / 'Subsumes' relationships in test_wholegraph()
+HEART_EDGES = [(321588, 4024552), (321588, 4027255), (4024552, 316139), (4027255, 43530856), (316139, 43530961),
+               (316139, 45766164)]
+
+
+class TestGraphUtils(unittest.TestCase):
+    """Tests for graph.py functions that only need a graph, not the DB"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.g = CompactConceptGraph.from_edges([e[0] for e in HEART_EDGES], [e[1] for e in HEART_EDGES])
+
+    def test_condense_super_nodes(self):
+        """Nodes with more children than the threshold lose their child edges and are reported with counts"""
+        edges, super_nodes = condense_super_nodes(self.g, threshold=1)
+        self.assertEqual(super_nodes, {316139: 2, 321588: 2})
+        self.assertEqual(sorted(map(tuple, edges.tolist())), [(4024552, 316139), (4027255, 43530856)])
+        edges, super_nodes = condense_super_nodes(self.g, threshold=2)
+        self.assertEqual((len(edges), super_nodes), (len(HEART_EDGES), {}))
+
+    def test_get_all_descendants(self):
+        """Only children, unless all descendants are asked for"""
+        self.assertEqual(get_all_descendants(self.g, {4024552, 99}), {316139})
+        self.assertEqual(get_all_descendants(self.g, {4024552, 99}, transitive=True), {316139, 43530961, 45766164})
+
+    def test_group_concept_ids(self):
+        """Each group of a batch gets its unhidden members and their children or descendants, which may overlap"""
+        group_members = {'a': {4024552}, 'b': {4027255, 316139}, 'c': {4024552, 99}}
+        groups = group_concept_ids(self.g, group_members, {316139})
+        self.assertEqual(groups['a'], [316139, 4024552])
+        self.assertEqual(groups['b'], [4027255, 43530856])  # 316139 is hidden, so not expanded either
+        self.assertEqual(groups['c'], [99] + groups['a'])  # members not in the graph are kept
+        groups = group_concept_ids(self.g, group_members, {316139}, transitive=True)
+        self.assertEqual(groups['a'], [316139, 4024552, 43530961, 45766164])
+        self.assertEqual(groups['b'], [4027255, 43530856])
+
+    def test_graph_layout(self):
+        """Layouts are computed in the process pool, and cached"""
+        layout = asyncio.run(graph_layout(self.g))
+        self.assertEqual(set(layout['nodes']), set(self.g.node_ids.tolist()))
+        hits = LAYOUT_CACHE.hits
+        self.assertEqual(asyncio.run(graph_layout(self.g)), layout)
+        self.assertEqual(LAYOUT_CACHE.hits, hits + 1)
+
+    def test_get_graph_concept_stats(self):
+        """Stats come from the whole graph, whatever concepts are asked for"""
+        stats = get_graph_concept_stats(self.g, [4024552, 99])
+        self.assertEqual(stats, {4024552: {'depth': 1, 'n_children': 1, 'n_descendants': 3, 'root': 321588}})
+
+    def test_expand_super_node(self):
+        """Children come back a page at a time, optionally limited to a subgraph"""
+        page = expand_super_node(self.g, 321588, offset=1, limit=1)
+        self.assertEqual((page['total'], page['children'], page['child_counts']), (2, [4027255], {4027255: 1}))
+        page = expand_super_node(self.g, 321588, subgraph_nodes={321588, 4024552})
+        self.assertEqual((page['total'], page['children']), (1, [4024552]))
+
+    def test_wholegraph_response(self):
+        """Edges stream in each format, in chunks, and revalidation with the ETag gives 304"""
+        app = FastAPI()
+        g = self.g
+
+        @app.get('/wholegraph')
+        def _wholegraph(request: Request):
+            return wholegraph_response(
+                g, request.headers.get('accept', ''), request.headers.get('if-none-match', ''), chunk_size=4)
+
+        client = TestClient(app)
+        expected = sorted(HEART_EDGES)
+        response = client.get('/wholegraph')
+        self.assertEqual(sorted(map(tuple, response.json())), expected)
+        response = client.get('/wholegraph', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(sorted(tuple(json.loads(line)) for line in response.text.splitlines()), expected)
+        response = client.get('/wholegraph', headers={'Accept': 'application/octet-stream'})
+        edges = np.frombuffer(response.content, dtype='<i4').reshape(-1, 2)
+        self.assertEqual(sorted(map(tuple, edges.tolist())), expected)
+
+        etag = response.headers['etag']
+        response = client.get('/wholegraph', headers={'Accept': 'application/octet-stream', 'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.content), (304, b''))
+        response = client.get('/wholegraph', headers={'If-None-Match': etag})  # other format, other ETag
+        self.assertEqual(response.status_code, 200)
+
+    def test_graph_routes_wait_for_graph(self):
+        """Until the graph is loaded, graph routes give 503 with Retry-After; with DONT_LOAD_GRAPH, it never loads"""
+        app = FastAPI()
+        app.include_router(graph_routes.router)
+        self.assertFalse(graph_routes.GRAPH_READY.is_set())
+        self.assertIsNone(graph_routes.start_graph_loading())
+        response = TestClient(app).get('/concept-descendants', params={'concept_ids': [321588]})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['retry-after'], str(graph_routes.GRAPH_RETRY_AFTER_SECONDS))
+        self.assertFalse(response.json()['detail']['ready'])
+
+    def test_graph_publishing(self):
+        """Workers map the snapshot only once the master published it; if publishing fails, they load their own"""
+        env_vars = (graph_routes.SHARED_GRAPH_ENV_VAR, graph_routes.GRAPH_PUBLISH_STATUS_ENV_VAR)
+        for fail in (True, False):
+            with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.dict(os.environ), \
+                    mock.patch.object(graph_routes, 'GRAPH_PUBLISH_POLL_SECONDS', 0.01), \
+                    mock.patch.object(graph_routes.multiprocessing, 'get_context') as get_context, \
+                    mock.patch.object(graph_routes, 'publish_rel_graph') as publish:
+                for var in env_vars:
+                    os.environ.pop(var, None)
+                self.assertFalse(graph_routes.wait_for_published_graph())  # not under gunicorn
+                publish.side_effect = RuntimeError('database is down') if fail else None
+                graph_path, status_path = os.path.join(tmp_dir, 'graph.bin'), os.path.join(tmp_dir, 'status.json')
+                graph_routes.start_graph_publishing(graph_path, status_path)
+                get_context.assert_called_once_with('spawn')  # not a thread of, nor a fork of, the gunicorn master
+                self.assertIs(get_context().Process.call_args.kwargs['target'], graph_routes.run_graph_publisher)
+                self.assertEqual(os.environ[graph_routes.GRAPH_PUBLISH_STATUS_ENV_VAR], status_path)
+                self.assertEqual(graph_routes.read_publish_status(status_path)['state'], 'publishing')
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    # What the publisher process does first
+                    threading.Thread(target=graph_routes._publish_rel_graph, args=(graph_path, status_path)).start()
+                    shared = graph_routes.wait_for_published_graph(timeout=10)
+                status = graph_routes.read_publish_status(status_path)
+                self.assertEqual(status['state'], 'failed' if fail else 'published')
+                self.assertEqual(shared, not fail)
+                self.assertEqual(graph_routes.is_shared_graph_mode(), not fail)
+
+    def test_concept_graph_data_version(self):
+        """The /concept-graph data version is looked up in the background, at most every so often, never in a request"""
+        looked_up = threading.Event()
+        proceed = threading.Event()
+
+        def check_db_status_vars(_names):
+            """Blocks until the test lets it proceed"""
+            looked_up.set()
+            proceed.wait(10)
+            return {'last_refreshed_vocab_tables': 't1', 'last_refresh_success': 't2'}
+
+        graph = CompactConceptGraph.from_edges([1], [2], [1, 2])
+        graph.meta['graph_version'] = 7
+        with mock.patch.object(graph_routes, 'check_db_status_vars', side_effect=check_db_status_vars) as check, \
+                mock.patch.object(graph_routes, 'sync_rel_graph', return_value=graph), \
+                mock.patch.object(graph_routes, '_concept_graph_data_version', [None]), \
+                mock.patch.object(graph_routes, '_concept_graph_version_checker', [None]), \
+                mock.patch.object(graph_routes, '_concept_graph_version_checked_at', [-1000.0]):
+            self.assertIsNone(graph_routes.get_concept_graph_data_version())  # doesn't wait for the lookup
+            self.assertTrue(looked_up.wait(10))
+            self.assertIsNone(graph_routes.get_concept_graph_data_version())  # lookup in progress: not started again
+            proceed.set()
+            graph_routes._concept_graph_version_checker[0].join(10)
+            self.assertEqual(graph_routes.get_concept_graph_data_version(), ('t1', 't2', 7))
+            self.assertEqual(check.call_count, 1)  # checked recently: not looked up again
+
+    def test_sync_rel_graph(self):
+        """A new snapshot is mapped, not replayed; a failed swap is retried; without a snapshot, the delta log is
+        replayed"""
+        v1 = CompactConceptGraph.from_edges([1, 2], [2, 3], meta={'graph_version': 1})
+        v2 = CompactConceptGraph.from_edges([1, 3], [2, 4], meta={'graph_version': 2})
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(graph_routes, 'REL_GRAPH', v1), \
+                mock.patch.object(graph_routes, '_rel_graph_snapshot_mtime', [0.0]), \
+                mock.patch.object(graph_routes, 'catch_up', wraps=graph_routes.catch_up) as catch_up:
+            path = os.path.join(tmp_dir, 'graph.bin')
+            write_graph_snapshot(v2, path)
+            with mock.patch.object(graph_routes, 'read_graph_snapshot', side_effect=OSError('read failed')):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    self.assertIs(graph_routes.sync_rel_graph(path), v1)
+            synced = graph_routes.sync_rel_graph(path)  # retried
+            self.assertEqual((synced.meta['graph_version'], synced.edges), (2, v2.edges))
+            self.assertIs(graph_routes.sync_rel_graph(path), synced)  # unchanged snapshot: kept
+            catch_up.assert_not_called()
+
+            os.remove(path)
+            write_delta(path, 2, compute_edge_delta(v1, v2.edge_array()))
+            graph_routes.REL_GRAPH = v1
+            replayed = graph_routes.sync_rel_graph(path)
+            self.assertEqual((replayed.meta['graph_version'], replayed.edges), (2, v2.edges))
+            self.assertEqual(catch_up.call_count, 1)
+
+    def test_maps_to_index_off_event_loop(self):
+        """The "Maps to" index is loaded in a thread, not on the event loop, and only again for a new vocab version"""
+        threads: List[threading.Thread] = []
+
+        def get_maps_to_edges():
+            """Records the thread it's called in"""
+            threads.append(threading.current_thread())
+            return np.array([(1, 2)])
+
+        g = CompactConceptGraph.from_edges([1], [2], meta={'vocab_version': 'v1'})
+        loop = asyncio.new_event_loop()
+        try:
+            with mock.patch.object(graph_routes, 'get_maps_to_edges', side_effect=get_maps_to_edges), \
+                    mock.patch.object(graph_routes, '_maps_to_index', [None]):
+                index = loop.run_until_complete(graph_routes.async_get_maps_to_index(g))
+                self.assertIs(loop.run_until_complete(graph_routes.async_get_maps_to_index(g)), index)
+                g.meta['vocab_version'] = 'v2'
+                self.assertIsNot(loop.run_until_complete(graph_routes.async_get_maps_to_index(g)), index)
+        finally:
+            loop.close()
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_expand_super_node_uses_concept_graph_cache(self):
+        """Pages of a super node's children reuse the cached /concept-graph response; offset and limit are bounded"""
+        app = FastAPI()
+        app.include_router(graph_routes.router)
+        app.dependency_overrides[graph_routes.require_graph] = lambda: None
+        g = CompactConceptGraph.from_edges([1, 1, 1], [2, 3, 4])
+        params = {'concept_id': 1, 'codeset_ids': [5], 'super_node_threshold': 2}
+        key = graph_routes.concept_graph_cache_key([5], [], ['RxNorm Extension'], False, 2)
+        with mock.patch.object(graph_routes, 'sync_rel_graph', return_value=g), \
+                mock.patch.object(graph_routes.CONCEPT_GRAPH_CACHE, 'get_version', None), \
+                mock.patch.object(graph_routes, 'concept_graph_response') as concept_graph_response:
+            graph_routes.CONCEPT_GRAPH_CACHE.set(key, {'concept_ids': [1, 2, 4]})
+            try:
+                client = TestClient(app)
+                response = client.get('/expand-super-node', params={**params, 'limit': 1, 'offset': 1})
+                self.assertEqual(response.json()['children'], [4])
+                concept_graph_response.assert_not_called()
+                self.assertEqual(client.get('/expand-super-node', params={**params, 'offset': -1}).status_code, 422)
+                self.assertEqual(client.get('/expand-super-node', params={**params, 'limit': 0}).status_code, 422)
+            finally:
+                graph_routes.CONCEPT_GRAPH_CACHE.clear()
+
+
 # Uncomment this and run this file and run directly to run all tests
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,50 @@
+"""Tests for cache.py
+
+How to run:
+    python -m unittest discover
+"""
+import os
+import sys
+import unittest
+from pathlib import Path
+
+THIS_TEST_DIR = Path(os.path.dirname(__file__))
+PROJECT_ROOT = THIS_TEST_DIR.parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+from backend.cache import ResponseCache
+
+
+class TestResponseCache(unittest.TestCase):
+    """Tests for ResponseCache"""
+
+    def test_lru_and_counters(self):
+        """Least recently used entries are evicted, and hits / misses are counted"""
+        cache = ResponseCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), (True, 1))  # 'a' is now most recently used
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), (False, None))
+        self.assertEqual(cache.get('c'), (True, 3))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (2, 1))
+
+    def test_ttl(self):
+        """Expired entries are misses"""
+        cache = ResponseCache(ttl=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(len(cache), 0)
+
+    def test_version_change(self):
+        """Entries are dropped when the data version changes"""
+        version = ['2024-01-01']
+        cache = ResponseCache(get_version=lambda: version[0], version_check_interval=0)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), (True, 1))
+        version[0] = '2024-02-01'
+        self.assertEqual(cache.get('a'), (False, None))
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()